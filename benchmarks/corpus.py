@@ -0,0 +1,52 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Synthetic call recordings laid out the way Amazon Connect writes them: 8 kHz 16-bit stereo
+# PCM WAV files under <prefix>YYYY/MM/DD/, named after a contact id and a timestamp.
+
+import random
+import struct
+import uuid
+
+SAMPLE_RATE = 8000
+CHANNELS = 2
+BITS_PER_SAMPLE = 16
+
+
+def connect_wav_header(data_size):
+    block_align = CHANNELS * BITS_PER_SAMPLE // 8
+    return b''.join([
+        b'RIFF', struct.pack('<I', 36 + data_size), b'WAVE',
+        b'fmt ', struct.pack('<IHHIIHH', 16, 1, CHANNELS, SAMPLE_RATE, SAMPLE_RATE * block_align, block_align, BITS_PER_SAMPLE),
+        b'data', struct.pack('<I', data_size),
+    ])
+
+
+def make_recording(seconds, rng, silence_share=0.0):
+    # The samples are noise, the transcoders cost the same whatever the audio sounds like. A
+    # silence_share of the recording is dead air in the middle, as a call put on hold.
+    block_align = CHANNELS * BITS_PER_SAMPLE // 8
+    frames = int(seconds * SAMPLE_RATE)
+    silent_frames = int(frames * silence_share)
+    speech_frames = frames - silent_frames
+    speech = rng.randbytes(speech_frames * block_align)
+    middle = speech_frames // 2 * block_align
+    data = speech[:middle] + b'\x00' * silent_frames * block_align + speech[middle:]
+    return connect_wav_header(len(data)) + data
+
+
+def recording_key(prefix, day, rng):
+    contact_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+    timestamp = f"{day:%Y%m%d}T{rng.randrange(24):02d}:{rng.randrange(60):02d}_UTC"
+    return f"{prefix}{day:%Y/%m/%d}/{contact_id}_{timestamp}.wav"
+
+
+def generate_corpus(fake_s3, bucket, prefix, day, count, min_seconds, max_seconds, seed=0, silence_share=0.0):
+    # Adds count recordings of the day to the fake bucket and returns the bytes written
+    rng = random.Random(seed)
+    total_size = 0
+    for _ in range(count):
+        body = make_recording(rng.uniform(min_seconds, max_seconds), rng, silence_share)
+        fake_s3.add_object(bucket, recording_key(prefix, day, rng), body, ContentType='audio/wav', Metadata={})
+        total_size += len(body)
+    return total_size
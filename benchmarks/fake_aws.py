@@ -0,0 +1,220 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-process stand-ins for the S3 and SQS calls the Lambda handlers make, so the pipeline can
+# be benchmarked without an AWS account. Only the parameters the handlers pass are supported.
+
+import base64
+import hashlib
+import io
+import threading
+import uuid
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+from boto3.s3.transfer import S3Transfer
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def etag_of(body):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+class StreamingBody(io.BytesIO):
+    # botocore's StreamingBody reads like a file and is closed by the caller
+    pass
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, operation):
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def add_object(self, bucket, key, body, **attributes):
+        self.objects[(bucket, key)] = dict(attributes, Body=bytes(body), ETag=etag_of(body),
+            LastModified=datetime.now(timezone.utc), TagSet=[])
+
+    def get(self, bucket, key, operation):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise client_error('NoSuchKey', operation)
+
+    def head_object(self, Bucket, Key):
+        self.count('HeadObject')
+        obj = self.get(Bucket, Key, 'HeadObject')
+        response = {name: value for name, value in obj.items() if name not in ('Body', 'TagSet')}
+        response['ContentLength'] = len(obj['Body'])
+        response.setdefault('Metadata', {})
+        return response
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.count('GetObject')
+        obj = self.get(Bucket, Key, 'GetObject')
+        if IfMatch is not None and IfMatch != obj['ETag']:
+            raise client_error('PreconditionFailed', 'GetObject')
+        body = obj['Body']
+        if Range:
+            start, end = Range.split('=')[1].split('-')
+            body = body[int(start):int(end) + 1]
+        return {'Body': StreamingBody(body), 'ContentLength': len(body)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.count('PutObject')
+        self.store(Bucket, Key, bytes(Body), kwargs)
+        return {'ETag': self.objects[(Bucket, Key)]['ETag']}
+
+    def store(self, bucket, key, body, kwargs):
+        attributes = {name: kwargs[name] for name in ('ContentType', 'Metadata', 'StorageClass') if name in kwargs}
+        self.add_object(bucket, key, body, **attributes)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        # s3transfer only accepts some of the PutObject arguments
+        for name in ExtraArgs or {}:
+            if name not in S3Transfer.ALLOWED_UPLOAD_ARGS:
+                raise ValueError(f"Invalid extra_args key '{name}'")
+        self.count('PutObject')
+        with open(Filename, 'rb') as f:
+            self.store(Bucket, Key, f.read(), ExtraArgs or {})
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.count('CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {'kwargs': kwargs, 'parts': {}}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ChecksumAlgorithm=None):
+        self.count('UploadPart')
+        self.uploads[UploadId]['parts'][PartNumber] = bytes(Body)
+        checksum = base64.b64encode(zlib.crc32(Body).to_bytes(4, 'big')).decode()
+        return {'ETag': etag_of(Body), 'ChecksumCRC32': checksum}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.count('CompleteMultipartUpload')
+        upload = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        if numbers != sorted(numbers):
+            raise client_error('InvalidPartOrder', 'CompleteMultipartUpload')
+        self.store(Bucket, Key, b''.join(upload['parts'][number] for number in numbers), upload['kwargs'])
+        return {'ETag': self.objects[(Bucket, Key)]['ETag']}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.count('AbortMultipartUpload')
+        self.uploads.pop(UploadId, None)
+
+    def get_object_tagging(self, Bucket, Key):
+        self.count('GetObjectTagging')
+        return {'TagSet': self.get(Bucket, Key, 'GetObjectTagging')['TagSet']}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, StartAfter='', Delimiter=''):
+        self.count('ListObjectsV2')
+        start_after = unquote(ContinuationToken) if ContinuationToken else StartAfter
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix) and key > start_after)
+        if Delimiter and start_after.endswith(Delimiter):
+            # the previous page ended on a common prefix, the keys under it were rolled up already
+            keys = [key for key in keys if not key.startswith(start_after)]
+        contents, common_prefixes = [], []
+        last = ''
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:key.index(Delimiter, len(Prefix)) + 1]
+                if common_prefix in common_prefixes:
+                    continue
+                if len(contents) + len(common_prefixes) == MaxKeys:
+                    break
+                common_prefixes.append(common_prefix)
+                last = common_prefix
+                continue
+            if len(contents) + len(common_prefixes) == MaxKeys:
+                break
+            obj = self.objects[(Bucket, key)]
+            contents.append({'Key': key, 'LastModified': obj['LastModified'], 'ETag': obj['ETag'],
+                'Size': len(obj['Body']), 'StorageClass': obj.get('StorageClass', 'STANDARD')})
+            last = key
+        else:
+            last = ''
+        truncated = bool(last)
+        response = {'IsTruncated': truncated, 'KeyCount': len(contents) + len(common_prefixes), 'Prefix': Prefix, 'MaxKeys': MaxKeys}
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = [{'Prefix': common_prefix} for common_prefix in common_prefixes]
+        if truncated:
+            response['NextContinuationToken'] = quote(last)
+        return response
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        # ffmpeg reads its input over HTTP, served from memory on a local port
+        if self.server is None:
+            self.server = ThreadingHTTPServer(('127.0.0.1', 0), object_handler(self))
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/{quote(Params['Bucket'])}/{quote(Params['Key'])}"
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def object_handler(fake_s3):
+    class ObjectHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            bucket, _, key = unquote(self.path[1:]).partition('/')
+            obj = fake_s3.objects.get((bucket, key))
+            if obj is None:
+                self.send_error(404)
+                return
+            fake_s3.count('GetObject')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(obj['Body'])))
+            self.end_headers()
+            self.wfile.write(obj['Body'])
+
+        def log_message(self, format, *args):
+            pass
+    return ObjectHandler
+
+
+class FakeSQS:
+    def __init__(self):
+        self.messages = []
+        self.requests = {}
+        # visibility timeouts set by receipt handle
+        self.visibility = {}
+        self.lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with self.lock:
+            self.requests['SendMessageBatch'] = self.requests.get('SendMessageBatch', 0) + 1
+            for entry in Entries:
+                message_id = uuid.uuid4().hex
+                self.messages.append({'messageId': message_id, 'receiptHandle': message_id, 'body': entry['MessageBody'],
+                    'messageAttributes': {name: {'stringValue': value['StringValue'], 'dataType': value['DataType']}
+                        for name, value in entry.get('MessageAttributes', {}).items()},
+                    'attributes': {'ApproximateReceiveCount': '1'}})
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self.lock:
+            self.requests['ChangeMessageVisibility'] = self.requests.get('ChangeMessageVisibility', 0) + 1
+            self.visibility[ReceiptHandle] = VisibilityTimeout
+
+    def receive_messages(self, max_messages):
+        with self.lock:
+            batch, self.messages = self.messages[:max_messages], self.messages[max_messages:]
+        return batch
@@ -0,0 +1,408 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Runs the iterator, queue and convert Lambda handlers end to end against in-process S3 and SQS
+# stand-ins and a synthetic corpus of Connect recordings, and reports the throughput, latency,
+# memory and /tmp usage of every stage. Compare against a stored baseline to prove a change to
+# the handlers locally:
+#
+#   python benchmarks/run_benchmark.py --recordings 200 --save-baseline baseline.json
+#   python benchmarks/run_benchmark.py --recordings 200 --baseline baseline.json
+#
+# The cold import of every handler is timed in a fresh interpreter, as in a new execution
+# environment, and --import-budget-ms fails the run when one takes longer.
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from corpus import generate_corpus
+from fake_aws import FakeS3, FakeSQS
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_LAYER_PATH = os.path.join(REPO_ROOT, 'lambda-layers', 'layer-common', 'python')
+BUCKET = 'benchmark-recordings'
+PREFIX = 'connect/benchmark/CallRecordings/'
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/benchmark-convert'
+WORK_BUCKET = 'benchmark-work'
+RUN_ID = 'benchmark'
+STAGES = ('iterator', 'queue', 'convert')
+# metric name and whether a higher value is better
+COMPARED_METRICS = {
+    'items_per_second': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False,
+    'peak_tmp_bytes': False,
+    'import_ms': False,
+}
+SAMPLE_INTERVAL = 0.005
+# cold imports timed per handler, the fastest is kept
+IMPORT_SAMPLES = 3
+IMPORT_TIMER = '''
+import importlib.util, sys, time
+sys.path[:0] = [sys.argv[1], sys.argv[2]]
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler', sys.argv[3])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print((time.perf_counter() - started) * 1000)
+'''
+
+
+def load_handler(name, directory):
+    # every Lambda names its handler lambda-handler.py, so each is loaded under its own name
+    sys.path.insert(0, os.path.join(REPO_ROOT, 'lambdas', directory))
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, 'lambdas', directory, 'lambda-handler.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure_import_ms(directory):
+    # Time to import a handler in a new interpreter, which is what a cold start pays before the
+    # first invocation. The environment is the one the benchmark configured for the handlers.
+    handler_path = os.path.join(REPO_ROOT, 'lambdas', directory)
+    samples = []
+    for _ in range(IMPORT_SAMPLES):
+        output = subprocess.run([sys.executable, '-c', IMPORT_TIMER, COMMON_LAYER_PATH, handler_path,
+            os.path.join(handler_path, 'lambda-handler.py')], check=True, capture_output=True, text=True).stdout
+        samples.append(float(output.split()[-1]))
+    return round(min(samples), 1)
+
+
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class ResourceMonitor(threading.Thread):
+    # samples the resident set size and the bytes under the scratch directory the handlers use
+    # as /tmp, and keeps the peaks since the last reset
+    def __init__(self, scratch_dir):
+        super().__init__(daemon=True)
+        self.scratch_dir = scratch_dir
+        self.stopped = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.peak_rss = current_rss_bytes()
+        self.peak_tmp = directory_size(self.scratch_dir)
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, current_rss_bytes())
+        self.peak_tmp = max(self.peak_tmp, directory_size(self.scratch_dir))
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class FakeContext:
+    def __init__(self, timeout_seconds=900):
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class Stage:
+    def __init__(self, name, monitor):
+        self.name = name
+        self.monitor = monitor
+        self.latencies = []
+        self.items = 0
+        self.bytes = 0
+        self.failures = 0
+        self.peak_rss = 0
+        self.peak_tmp = 0
+        self.import_ms = None
+
+    def invoke(self, handler, event, context=None):
+        self.monitor.reset()
+        started = time.perf_counter()
+        response = handler(event, context)
+        self.latencies.append(time.perf_counter() - started)
+        self.monitor.sample()
+        self.peak_rss = max(self.peak_rss, self.monitor.peak_rss)
+        self.peak_tmp = max(self.peak_tmp, self.monitor.peak_tmp)
+        return response
+
+    def summary(self):
+        seconds = sum(self.latencies)
+        summary = {
+            'invocations': len(self.latencies),
+            'items': self.items,
+            'seconds': round(seconds, 3),
+            'items_per_second': round(self.items / seconds, 1) if seconds else 0.0,
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 2),
+            'peak_rss_mb': round(self.peak_rss / 1024 / 1024, 1),
+            'peak_tmp_bytes': self.peak_tmp,
+        }
+        if self.import_ms is not None:
+            summary['import_ms'] = self.import_ms
+        if self.bytes:
+            summary['mb_per_second'] = round(self.bytes / 1024 / 1024 / seconds, 2) if seconds else 0.0
+        if self.failures:
+            summary['failures'] = self.failures
+        return summary
+
+
+def percentile(values, pct):
+    # nearest rank
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * pct // 100) - 1)]
+
+
+def configure_environment(args, scratch_dir):
+    os.environ.update({
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+        'CONNECT_RECORDING_S3_BUCKET': BUCKET,
+        'CONNECT_RECORDING_CONVERT_QUEUE': QUEUE_URL,
+        'PREFIX': PREFIX,
+        'MAX_KEYS': str(args.max_keys),
+        'NUM_DAYS_AGE': '7',
+        'OVERWRITE_PREVIOUS_CONVERTED': 'false',
+        'S3_STORAGE_TIER': 'GLACIER_IR',
+        'DISPATCH_MODE': 'sqs',
+        'WORK_BUCKET': WORK_BUCKET,
+        'CONVERT_MODE': args.convert_mode,
+        'CONVERT_BACKEND': args.convert_backend,
+        'CODEC_PROFILE': args.codec_profile,
+        'SILENCE_COMPACTION': 'true' if args.silence_compaction else 'false',
+        'EMIT_METRICS': 'true' if args.emit_metrics else 'false',
+        'TMPDIR': scratch_dir,
+    })
+    for name in ('LEDGER_TABLE', 'RUNS_TABLE', 'CHECKPOINTS_TABLE', 'LEDGER_SQLITE_PATH'):
+        os.environ.pop(name, None)
+    if args.ledger:
+        os.environ['LEDGER_SQLITE_PATH'] = os.path.join(scratch_dir, 'ledger.sqlite')
+    tempfile.tempdir = scratch_dir
+
+
+def run(args):
+    scratch_root = tempfile.mkdtemp(prefix='convert-benchmark-')
+    scratch_dir = os.path.join(scratch_root, 'tmp')
+    os.mkdir(scratch_dir)
+    configure_environment(args, scratch_dir)
+    sys.path.insert(0, COMMON_LAYER_PATH)
+
+    # the handlers read their configuration when they load, MAX_WORKERS differs between two of them
+    import_ms = {}
+    os.environ['MAX_WORKERS'] = str(args.queue_workers)
+    import_ms['iterator'] = measure_import_ms('iterator-step')
+    iterator_step = load_handler('iterator_step_handler', 'iterator-step')
+    import_ms['queue'] = measure_import_ms('iterator-queue')
+    iterator_queue = load_handler('iterator_queue_handler', 'iterator-queue')
+    os.environ['MAX_WORKERS'] = str(args.convert_workers)
+    import_ms['convert'] = measure_import_ms('convert')
+    convert = load_handler('convert_handler', 'convert')
+    if args.ffmpeg:
+        import convert_pipeline
+        convert_pipeline.FFMPEG_PATH = args.ffmpeg
+    logging.getLogger().setLevel(logging.WARNING)
+    from listing_pages import page_count
+
+    fake_s3, fake_sqs = FakeS3(), FakeSQS()
+    iterator_step.s3 = iterator_queue.s3 = convert.s3 = fake_s3
+    iterator_queue.sqs = fake_sqs
+
+    day = datetime.now() - timedelta(days=7)
+    corpus_bytes = generate_corpus(fake_s3, BUCKET, PREFIX, day, args.recordings,
+        args.min_seconds, args.max_seconds, args.seed, args.silence_share)
+
+    monitor = ResourceMonitor(scratch_dir)
+    monitor.start()
+    stages = {name: Stage(name, monitor) for name in STAGES}
+    for name, stage in stages.items():
+        stage.import_ms = import_ms[name]
+    started = time.perf_counter()
+    # the largest iterator output the state machine would carry, limited to 256 KB
+    largest_state_bytes = 0
+    try:
+        # the state machine lists a page, hands it to the queue Lambda and lists the next one
+        event = {'NextContinuationToken': '', 'specific_date': day.strftime('%m/%d/%Y'),
+            'day': day.strftime('%Y-%m-%d'), 'run_id': RUN_ID}
+        while True:
+            response = stages['iterator'].invoke(iterator_step.lambda_handler, event, FakeContext())
+            if 'files' not in response:
+                raise RuntimeError(f"iterator failed: {response}")
+            largest_state_bytes = max(largest_state_bytes, len(json.dumps(response)))
+            if response['files']:
+                stages['iterator'].items += page_count(response['files'])
+                queued = stages['queue'].invoke(iterator_queue.lambda_handler, {'iterator': response}, FakeContext())
+                stages['queue'].items += page_count(response['files'])
+                if 'key_count' not in queued:
+                    raise RuntimeError(f"queue failed: {queued}")
+            if not response['NextContinuationToken']:
+                break
+            event = dict(event, NextContinuationToken=response['NextContinuationToken'], shard=response['shard'])
+
+        # the SQS event source delivers convert_batch_size messages per invocation
+        while True:
+            records = fake_sqs.receive_messages(args.convert_batch_size)
+            if not records:
+                break
+            for record in records:
+                key = json.loads(record['body'])
+                stages['convert'].bytes += len(fake_s3.objects[(BUCKET, key)]['Body'])
+            response = stages['convert'].invoke(convert.lambda_handler, {'Records': records}, FakeContext())
+            stages['convert'].items += len(records)
+            stages['convert'].failures += len(response['batchItemFailures'])
+    finally:
+        monitor.stop()
+        fake_s3.close()
+        shutil.rmtree(scratch_root, ignore_errors=True)
+    elapsed = time.perf_counter() - started
+    requests = {'s3': dict(sorted(fake_s3.requests.items())), 'sqs': dict(fake_sqs.requests)}
+
+    # every recording should now be in the format of the codec profile
+    from codec_profiles import get_profile, probe_audio_format, is_profile_output
+    profile = get_profile(args.codec_profile)
+    converted = sum(1 for bucket, key in list(fake_s3.objects) if is_profile_output(probe_audio_format(fake_s3, bucket, key), profile))
+
+    return {
+        'config': {
+            'recordings': args.recordings,
+            'min_seconds': args.min_seconds,
+            'max_seconds': args.max_seconds,
+            'corpus_bytes': corpus_bytes,
+            'max_keys': args.max_keys,
+            'queue_workers': args.queue_workers,
+            'convert_workers': args.convert_workers,
+            'convert_batch_size': args.convert_batch_size,
+            'convert_mode': args.convert_mode,
+            'convert_backend': args.convert_backend,
+            'codec_profile': args.codec_profile,
+            'silence_share': args.silence_share,
+            'silence_compaction': args.silence_compaction,
+            'ledger': args.ledger,
+        },
+        'stages': {name: stage.summary() for name, stage in stages.items()},
+        'total_seconds': round(elapsed, 3),
+        'converted_recordings': converted,
+        'largest_state_bytes': largest_state_bytes,
+        'requests': requests,
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Returns one line per compared metric and the metrics that got worse by more than tolerance
+    lines, regressions = [], []
+    for stage in STAGES:
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old = baseline['stages'].get(stage, {}).get(metric)
+            new = results['stages'][stage].get(metric)
+            if old is None or new is None:
+                continue
+            if old:
+                change = (new - old) / old
+                worse = -change if higher_is_better else change
+            else:
+                change = 0.0 if not new else float('inf')
+                worse = 0.0 if higher_is_better or not new else float('inf')
+            line = f"{stage:<9} {metric:<17} {old:>14} -> {new:>14} {change:+8.1%}"
+            if worse > tolerance:
+                line += "  REGRESSION"
+                regressions.append(f"{stage}.{metric}")
+            lines.append(line)
+    return lines, regressions
+
+
+def print_results(results):
+    print(f"{'stage':<9} {'invocations':>11} {'items':>7} {'items/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'rss MB':>8} {'tmp bytes':>10} {'import ms':>10}")
+    for name, stage in results['stages'].items():
+        print(f"{name:<9} {stage['invocations']:>11} {stage['items']:>7} {stage['items_per_second']:>10} "
+            f"{stage['p50_ms']:>9} {stage['p99_ms']:>9} {stage['peak_rss_mb']:>8} {stage['peak_tmp_bytes']:>10} {stage.get('import_ms', ''):>10}")
+    convert = results['stages']['convert']
+    if 'mb_per_second' in convert:
+        print(f"convert reads {convert['mb_per_second']} MB/s of source recordings")
+    print(f"{results['converted_recordings']} of {results['config']['recordings']} recordings converted")
+    if convert.get('failures'):
+        print(f"{convert['failures']} recordings failed to convert")
+    print(f"largest iterator output {results['largest_state_bytes']} bytes")
+    print(f"requests: {results['requests']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the convert pipeline against local S3 and SQS stand-ins.')
+    parser.add_argument('--recordings', type=int, default=100, help='recordings in the synthetic day')
+    parser.add_argument('--min-seconds', type=float, default=10, help='shortest recording')
+    parser.add_argument('--max-seconds', type=float, default=60, help='longest recording')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--silence-share', type=float, default=0.0, help='share of every recording that is dead air')
+    parser.add_argument('--max-keys', type=int, default=1000, help='keys per listing page, MAX_KEYS of the iterator')
+    parser.add_argument('--queue-workers', type=int, default=32, help='MAX_WORKERS of the queue Lambda')
+    parser.add_argument('--convert-workers', type=int, default=4, help='MAX_WORKERS of the convert Lambda')
+    parser.add_argument('--convert-batch-size', type=int, default=10, help='SQS messages per convert invocation')
+    parser.add_argument('--convert-mode', default='stream', choices=('stream', 'tmp'))
+    parser.add_argument('--convert-backend', default='auto', choices=('auto', 'ffmpeg'))
+    parser.add_argument('--codec-profile', default='alaw-8k', help='CODEC_PROFILE of the handlers, the Opus profiles need --ffmpeg')
+    parser.add_argument('--ffmpeg', help='ffmpeg binary, needed for the ffmpeg backend and the tmp mode')
+    parser.add_argument('--silence-compaction', action='store_true', help='shorten the dead air before encoding')
+    parser.add_argument('--ledger', action='store_true', help='use a SQLite conversion ledger')
+    parser.add_argument('--emit-metrics', action='store_true', help='print the embedded metric format records of the handlers')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results stored in this JSON file')
+    parser.add_argument('--save-baseline', help='store the results as a baseline in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as a regression')
+    parser.add_argument('--import-budget-ms', type=float, help='fail when the cold import of a handler takes longer')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print_results(results)
+    over_budget = []
+    if args.import_budget_ms is not None:
+        over_budget = [name for name, stage in results['stages'].items() if stage['import_ms'] > args.import_budget_ms]
+        if over_budget:
+            print(f"cold import over the {args.import_budget_ms:g} ms budget: {', '.join(over_budget)}")
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != results['config']:
+            print(f"warning: the baseline was run with {baseline['config']}")
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print('\n'.join(lines))
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
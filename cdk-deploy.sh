@@ -2,6 +2,10 @@
 cd lambda-layers/layer-ffmpeg
 ./build_layer_x86.sh
 
+# build the numpy layer used by the in-process A-law transcoder
+cd ../layer-numpy
+./build_layer_x86.sh
+
 cd ../..
 
 # python virtual envirnment
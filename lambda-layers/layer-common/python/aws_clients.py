@@ -0,0 +1,62 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Lazily built, shared boto3 clients. Creating a client loads and parses the service model,
+# which is most of a handler's import time, so nothing is built until a call is made and a
+# client that a code path never uses (s3control outside manifest mode, stepfunctions until a
+# run completes) costs nothing. Clients with the same configuration are built once per
+# execution environment and reused across warm invocations and by every module.
+
+import threading
+
+import boto3
+from botocore.client import Config
+
+_clients = {}
+_lock = threading.Lock()
+# (event name, handler) registered on every shared client, the ones built later included
+_event_handlers = []
+
+
+def shared_client(service, **config):
+    # one client per service and configuration, created on first use
+    key = (service, repr(sorted(config.items())))
+    with _lock:
+        if key not in _clients:
+            client = boto3.client(service, config=Config(**config)) if config else boto3.client(service)
+            for event_name, handler in _event_handlers:
+                client.meta.events.register(event_name, handler)
+            _clients[key] = client
+        return _clients[key]
+
+
+def register_event_handler(event_name, handler):
+    # for hooks that watch every call, like the spans of handler_profiler
+    with _lock:
+        _event_handlers.append((event_name, handler))
+        for client in _clients.values():
+            client.meta.events.register(event_name, handler)
+
+
+class LazyClient:
+    # Stands in for a client at module level, so call sites and tests that replace the module
+    # attribute stay as they are. Event handlers are registered once the client exists.
+
+    def __init__(self, service, event_handlers=None, **config):
+        self._service = service
+        self._config = config
+        self._event_handlers = event_handlers or {}
+        self._client = None
+
+    def _get(self):
+        if self._client is None:
+            client = shared_client(self._service, **self._config)
+            with _lock:
+                if self._client is None:
+                    for event_name, handler in self._event_handlers.items():
+                        client.meta.events.register(event_name, handler)
+                    self._client = client
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
@@ -0,0 +1,97 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# CSV manifests in the S3 Batch Operations format (Bucket,Key with URL-encoded keys). Rows are
+# streamed into chunks of at most chunk_size rows, each chunk becomes one manifest and one batch
+# job, instead of one SQS message per recording.
+
+import csv
+import io
+import os
+import uuid
+from urllib.parse import quote, unquote
+
+MANIFEST_FORMAT = 'S3BatchOperations_CSV_20180820'
+MANIFEST_FIELDS = ['Bucket', 'Key']
+
+
+class ManifestWriter:
+
+    def __init__(self, chunk_size, on_chunk=None):
+        self.chunk_size = chunk_size
+        # called with the descriptor of every manifest written
+        self.on_chunk = on_chunk
+        self.manifests = []
+        self.row_count = 0
+        self.buffer = io.StringIO()
+        self.rows = csv.writer(self.buffer, lineterminator='\n')
+
+    def add(self, bucket, key):
+        self.rows.writerow([bucket, quote(key, safe='/')])
+        self.row_count += 1
+        if self.row_count >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.row_count:
+            return
+        manifest = self.write_chunk(f'{uuid.uuid4()}.csv', self.buffer.getvalue().encode('utf-8'))
+        manifest['rows'] = self.row_count
+        self.manifests.append(manifest)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.row_count = 0
+        if self.on_chunk is not None:
+            self.on_chunk(manifest)
+
+    def close(self):
+        self.flush()
+        return self.manifests
+
+    def write_chunk(self, name, body):
+        raise NotImplementedError
+
+
+class S3ManifestWriter(ManifestWriter):
+
+    def __init__(self, s3, bucket, prefix, chunk_size, on_chunk=None):
+        super().__init__(chunk_size, on_chunk)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def write_chunk(self, name, body):
+        key = self.prefix + name
+        response = self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType='text/csv')
+        return {
+            'bucket': self.bucket,
+            'key': key,
+            'etag': response['ETag'].strip('"'),
+        }
+
+
+class LocalManifestWriter(ManifestWriter):
+    # Writes manifests to a directory, for running the pipeline offline
+
+    def __init__(self, directory, chunk_size, on_chunk=None):
+        super().__init__(chunk_size, on_chunk)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write_chunk(self, name, body):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as manifest_file:
+            manifest_file.write(body)
+        return {'path': path}
+
+
+def read_manifest(lines):
+    # yields (bucket, key) with the key decoded
+    for row in csv.reader(lines):
+        if row:
+            yield row[0], unquote(row[1])
+
+
+def read_local_manifest(path):
+    with open(path, newline='', encoding='utf-8') as manifest_file:
+        yield from read_manifest(manifest_file)
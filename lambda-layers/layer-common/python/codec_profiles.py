@@ -0,0 +1,160 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Output codec profiles of the convert Lambda. A profile fixes the container, codec, sample
+# rate, channels and bitrate of the converted recording, and the content type and extension
+# recorded on the object. The CODEC_PROFILE environment variable selects one, alaw-8k is what
+# the convert Lambda has always written. Converted recordings keep their key, the extension of
+# the format they are in is recorded in their metadata.
+
+import io
+import math
+import os
+import struct
+
+from wav_format import (read_wav_format, build_wav_header, wav_padding, PROBE_SIZE, WAV_HEADER_SIZE,
+    WAVE_FORMAT_ALAW, WAVE_FORMAT_MULAW)
+
+DEFAULT_PROFILE = 'alaw-8k'
+
+PROFILES = {
+    # G.711 in a WAV file, 64 kbps, playable everywhere
+    'alaw-8k': {
+        'name': 'alaw-8k',
+        'container': 'wav',
+        'codec': 'pcm_alaw',
+        'format_tag': WAVE_FORMAT_ALAW,
+        'sample_rate': 8000,
+        'channels': 1,
+        'bitrate': 64000,
+        'content_type': 'audio/wav',
+        'extension': 'wav',
+        # raw samples ffmpeg writes to stdout, the WAV header is added by the uploader
+        'ffmpeg_format': 'alaw',
+        'ffmpeg_options': [],
+    },
+    'ulaw-8k': {
+        'name': 'ulaw-8k',
+        'container': 'wav',
+        'codec': 'pcm_mulaw',
+        'format_tag': WAVE_FORMAT_MULAW,
+        'sample_rate': 8000,
+        'channels': 1,
+        'bitrate': 64000,
+        'content_type': 'audio/wav',
+        'extension': 'wav',
+        'ffmpeg_format': 'mulaw',
+        'ffmpeg_options': [],
+    },
+    # Ogg Opus tuned for speech, about a quarter of the size of G.711
+    'opus-16k': {
+        'name': 'opus-16k',
+        'container': 'ogg',
+        'codec': 'libopus',
+        'sample_rate': 8000,
+        'channels': 1,
+        'bitrate': 16000,
+        'content_type': 'audio/ogg',
+        'extension': 'opus',
+        'ffmpeg_format': 'ogg',
+        'ffmpeg_options': ['-application', 'voip'],
+    },
+    # keeps the agent and the customer on their own channels, for speech analytics
+    'opus-stereo-24k': {
+        'name': 'opus-stereo-24k',
+        'container': 'ogg',
+        'codec': 'libopus',
+        'sample_rate': 8000,
+        'channels': 2,
+        'bitrate': 24000,
+        'content_type': 'audio/ogg',
+        'extension': 'opus',
+        'ffmpeg_format': 'ogg',
+        'ffmpeg_options': ['-application', 'voip'],
+    },
+}
+
+# user metadata on the converted object
+PROFILE_METADATA_KEY = 'codec-profile'
+EXTENSION_METADATA_KEY = 'file-extension'
+
+
+def get_profile(name=None):
+    # the named profile, or the one CODEC_PROFILE selects
+    name = name or os.environ.get('CODEC_PROFILE') or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"unknown codec profile {name}, expected one of {', '.join(PROFILES)}")
+    return PROFILES[name]
+
+
+def ffmpeg_output_args(profile):
+    args = ['-ac', str(profile['channels']), '-ar', str(profile['sample_rate']), '-c:a', profile['codec']]
+    if profile['container'] != 'wav':
+        args += ['-b:a', str(profile['bitrate'])]
+    return args + profile['ffmpeg_options']
+
+
+def output_metadata(profile):
+    return {PROFILE_METADATA_KEY: profile['name'], EXTENSION_METADATA_KEY: profile['extension']}
+
+
+def header_size(profile):
+    # bytes the uploader writes ahead of the encoder output
+    return WAV_HEADER_SIZE if profile['container'] == 'wav' else 0
+
+
+def build_header(profile, data_size):
+    if profile['container'] != 'wav':
+        return b''
+    return build_wav_header(data_size, profile['format_tag'], profile['channels'], profile['sample_rate'], 8)
+
+
+def build_padding(profile, data_size):
+    return wav_padding(data_size) if profile['container'] == 'wav' else b''
+
+
+def estimate_output_size(profile, seconds):
+    return header_size(profile) + math.ceil(seconds * profile['bitrate'] / 8)
+
+
+def output_seconds(profile, size):
+    return max(size - header_size(profile), 0) * 8 / profile['bitrate']
+
+
+def read_audio_format(data):
+    # The format of a WAV or Ogg Opus file from its first bytes, or None. Ogg files are
+    # recognised from the OpusHead packet of their first page.
+    if data[:4] == b'OggS':
+        head = data.find(b'OpusHead')
+        if head < 0 or len(data) < head + 16:
+            return None
+        sample_rate, = struct.unpack('<I', data[head + 12:head + 16])
+        return {'container': 'ogg', 'codec': 'opus', 'channels': data[head + 9], 'sample_rate': sample_rate}
+    try:
+        return read_wav_format(io.BytesIO(data))
+    except ValueError:
+        return None
+
+
+def probe_audio_format(s3, bucket, key, probe_size=PROBE_SIZE):
+    # Reads the format from the first bytes of an object with a ranged GET instead of a full
+    # download, a WAV header or the Opus header of an Ogg profile. None when it is neither.
+    body = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes=0-{probe_size - 1}')['Body']
+    try:
+        return read_audio_format(body.read())
+    finally:
+        body.close()
+
+
+def is_profile_output(audio_format, profile):
+    # whether a recording is already in the format of the profile
+    if audio_format is None or audio_format.get('container', 'wav') != profile['container']:
+        return False
+    if profile['container'] == 'wav':
+        return (audio_format['format_tag'] == profile['format_tag']
+            and audio_format['channels'] == profile['channels']
+            and audio_format['sample_rate'] == profile['sample_rate']
+            and audio_format['bits_per_sample'] == 8)
+    return (audio_format['codec'] == 'opus'
+        and audio_format['channels'] == profile['channels']
+        and audio_format['sample_rate'] == profile['sample_rate'])
@@ -0,0 +1,264 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Ledger of converted recordings, keyed by object key and the ETag of the converted object.
+# It answers "is this key already converted" for a whole listing page at once, instead of one
+# GetObjectTagging call per key. An object whose ETag no longer matches its record has been
+# replaced since it was converted and is converted again.
+#
+# The ledger also hands out leases, so that one version of a recording is queued and converted
+# once however many executions list it. The queue Lambda claims a key and ETag as 'queued' before
+# sending it, the convert Lambda claims it as 'converting' before it transcodes. A claim fails
+# while another owner holds an unexpired lease on the same version or once that version is
+# converted, and the key is dropped there. The record of the conversion replaces the lease.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+from aws_clients import LazyClient
+
+STATUS_CONVERTED = 'converted'
+# the header probe found the object already in the target format
+STATUS_ALREADY_TARGET = 'already-target'
+
+# leases, held by lease_owner until lease_expires_at
+STATUS_QUEUED = 'queued'
+STATUS_CONVERTING = 'converting'
+
+DONE_STATUSES = (STATUS_CONVERTED, STATUS_ALREADY_TARGET)
+LEASE_STATUSES = (STATUS_QUEUED, STATUS_CONVERTING)
+
+LEDGER_FIELDS = ('key', 'etag', 'status', 'original_size', 'converted_size', 'converted_at', 'lease_owner', 'lease_expires_at')
+
+
+def ledger_record(key, etag, status, original_size, converted_size):
+    return {
+        'key': key,
+        'etag': etag,
+        'status': status,
+        'original_size': original_size,
+        'converted_size': converted_size,
+        'converted_at': datetime.now(timezone.utc).isoformat(),
+        'lease_owner': None,
+        'lease_expires_at': None,
+    }
+
+
+def lease_record(key, etag, status, owner, lease_seconds, size):
+    return dict(ledger_record(key, etag, status, size, None), lease_owner=owner, lease_expires_at=int(time.time()) + lease_seconds)
+
+
+def is_converted(record, etag):
+    return record is not None and record['status'] in DONE_STATUSES and record['etag'] == etag
+
+
+def can_claim(record, etag, status, owner, now=None):
+    # Whether owner may lease this version of the key as status. The same condition guards the
+    # write in DynamoDB, so checking it first on the records of a page saves the failed writes.
+    if record is None or record['etag'] != etag:
+        return True
+    if record['status'] not in LEASE_STATUSES:
+        return False
+    # a queued key is taken over by the first convert Lambda that gets its message
+    return record['lease_owner'] == owner or (record['lease_expires_at'] or 0) < (now or time.time()) \
+        or (record['status'] == STATUS_QUEUED and status == STATUS_CONVERTING)
+
+
+def dispatch_key(key, etag):
+    # names one version of one recording, the same whichever execution lists it
+    return hashlib.sha256(f"{key}\n{etag}".encode()).hexdigest()[:32]
+
+
+class ConversionLedger:
+
+    def get_many(self, keys):
+        # returns {key: record} for the keys that have a record
+        raise NotImplementedError
+
+    def put(self, record):
+        raise NotImplementedError
+
+    def claim(self, key, etag, status, owner, lease_seconds, size):
+        # Leases the version of the key to owner, returns False when it is already converted or
+        # leased by another owner
+        raise NotImplementedError
+
+    def release(self, key, etag, owner):
+        # gives up the lease of owner, a later claim does not have to wait for it to expire
+        raise NotImplementedError
+
+
+class SQLiteLedger(ConversionLedger):
+    # Local backend for tests and offline runs
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # a commit per claim and per record, without waiting for the disk on every one of them
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS ledger (key TEXT PRIMARY KEY, etag TEXT, status TEXT, '
+            'original_size INTEGER, converted_size INTEGER, converted_at TEXT, lease_owner TEXT, lease_expires_at INTEGER)')
+        # ledgers written before there were leases
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(ledger)')]
+        for column, column_type in (('lease_owner', 'TEXT'), ('lease_expires_at', 'INTEGER')):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE ledger ADD COLUMN {column} {column_type}')
+        self.connection.commit()
+
+    def get_many(self, keys):
+        with self.lock:
+            return self.get_many_locked(keys)
+
+    def get_many_locked(self, keys):
+        keys = list(keys)
+        records = {}
+        # stay below SQLite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT {', '.join(LEDGER_FIELDS)} FROM ledger WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            for row in rows:
+                records[row[0]] = dict(zip(LEDGER_FIELDS, row))
+        return records
+
+    def put(self, record):
+        with self.lock:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO ledger ({', '.join(LEDGER_FIELDS)}) VALUES ({', '.join('?' * len(LEDGER_FIELDS))})",
+                [record[field] for field in LEDGER_FIELDS])
+            self.connection.commit()
+
+    def claim(self, key, etag, status, owner, lease_seconds, size):
+        with self.lock:
+            if not can_claim(self.get_many_locked([key]).get(key), etag, status, owner):
+                return False
+            record = lease_record(key, etag, status, owner, lease_seconds, size)
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO ledger ({', '.join(LEDGER_FIELDS)}) VALUES ({', '.join('?' * len(LEDGER_FIELDS))})",
+                [record[field] for field in LEDGER_FIELDS])
+            self.connection.commit()
+            return True
+
+    def release(self, key, etag, owner):
+        with self.lock:
+            self.connection.execute(
+                f"DELETE FROM ledger WHERE key = ? AND etag = ? AND lease_owner = ? AND status IN ({', '.join('?' * len(LEASE_STATUSES))})",
+                [key, etag, owner, *LEASE_STATUSES])
+            self.connection.commit()
+
+
+class DynamoDBLedger(ConversionLedger):
+    # Items are partitioned by the key's prefix (the recording day) and sorted by file name, so
+    # the records for a listing page, which shares one prefix, come back from a single Query.
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or LazyClient('dynamodb')
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def get_many(self, keys):
+        names_by_prefix = {}
+        for key in keys:
+            prefix, name = split_key(key)
+            names_by_prefix.setdefault(prefix, set()).add(name)
+        records = {}
+        for prefix, names in names_by_prefix.items():
+            for item in self.query_range(prefix, min(names), max(names)):
+                record = self.deserialize(item)
+                if split_key(record['key'])[1] in names:
+                    records[record['key']] = record
+        return records
+
+    def query_range(self, prefix, first_name, last_name):
+        query = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#prefix = :prefix AND #name BETWEEN :first AND :last',
+            'ExpressionAttributeNames': {'#prefix': 'prefix', '#name': 'name'},
+            'ExpressionAttributeValues': {
+                ':prefix': {'S': prefix},
+                ':first': {'S': first_name},
+                ':last': {'S': last_name},
+            },
+        }
+        while True:
+            response = self.client.query(**query)
+            yield from response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def put(self, record, **condition):
+        prefix, name = split_key(record['key'])
+        item = dict(record, prefix=prefix, name=name)
+        self.client.put_item(TableName=self.table_name,
+            Item={field: self.serializer.serialize(value) for field, value in item.items() if value is not None}, **condition)
+
+    def claim(self, key, etag, status, owner, lease_seconds, size):
+        # the condition of can_claim, evaluated by DynamoDB against the current item
+        condition = 'attribute_not_exists(#name) OR etag <> :etag OR (#status IN (:queued, :converting) AND ' \
+            '(lease_owner = :owner OR lease_expires_at < :now'
+        condition += ' OR #status = :queued))' if status == STATUS_CONVERTING else '))'
+        try:
+            self.put(lease_record(key, etag, status, owner, lease_seconds, size),
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#name': 'name', '#status': 'status'},
+                ExpressionAttributeValues={
+                    ':etag': {'S': etag},
+                    ':queued': {'S': STATUS_QUEUED},
+                    ':converting': {'S': STATUS_CONVERTING},
+                    ':owner': {'S': owner},
+                    ':now': {'N': str(int(time.time()))},
+                })
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    def release(self, key, etag, owner):
+        prefix, name = split_key(key)
+        try:
+            self.client.delete_item(TableName=self.table_name,
+                Key={'prefix': {'S': prefix}, 'name': {'S': name}},
+                ConditionExpression='etag = :etag AND lease_owner = :owner AND #status IN (:queued, :converting)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':etag': {'S': etag},
+                    ':owner': {'S': owner},
+                    ':queued': {'S': STATUS_QUEUED},
+                    ':converting': {'S': STATUS_CONVERTING},
+                })
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def deserialize(self, item):
+        record = {field: self.deserializer.deserialize(value) for field, value in item.items()}
+        for field in ('original_size', 'converted_size', 'lease_expires_at'):
+            if record.get(field) is not None:
+                record[field] = int(record[field])
+        return {field: record.get(field) for field in LEDGER_FIELDS}
+
+
+def split_key(key):
+    prefix, _, name = key.rpartition('/')
+    return prefix + '/', name
+
+
+def open_ledger():
+    # LEDGER_TABLE selects DynamoDB, LEDGER_SQLITE_PATH a local file, neither disables the ledger
+    if os.environ.get('LEDGER_TABLE'):
+        return DynamoDBLedger(os.environ['LEDGER_TABLE'])
+    if os.environ.get('LEDGER_SQLITE_PATH'):
+        return SQLiteLedger(os.environ['LEDGER_SQLITE_PATH'])
+    return None
@@ -0,0 +1,105 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# CloudWatch embedded metric format records. Lambda sends every stdout line to CloudWatch Logs
+# as is, and CloudWatch extracts the metrics of the JSON records written here without any
+# PutMetricData calls. Values that are not metrics, like the key, are kept as properties and
+# can be searched with Logs Insights.
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ConnectRecordingConvert')
+EMIT_METRICS = os.environ.get('EMIT_METRICS', 'true').lower() == 'true'
+
+# records from worker threads must not interleave
+_write_lock = threading.Lock()
+
+
+class MetricsRecord:
+
+    def __init__(self, stage, **dimensions):
+        self.dimensions = dict(Stage=stage, **dimensions)
+        self.metrics = {}
+        self.properties = {}
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = value
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def put_metric(self, name, value, unit='Count'):
+        self.metrics[name] = (value, unit)
+
+    def add_metric(self, name, value, unit='Count'):
+        # accumulates stages that run more than once, like the upload of every part
+        previous, _ = self.metrics.get(name, (0, unit))
+        self.metrics[name] = (previous + value, unit)
+
+    def put_rate(self, name, count, seconds):
+        self.put_metric(name, count / max(seconds, 0.001), 'Count/Second')
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_metric(name, (time.perf_counter() - started) * 1000, 'Milliseconds')
+
+    def timed(self, chunks, name):
+        # time spent producing the chunks of a generator, excluding the consumer's own work
+        chunks = iter(chunks)
+        while True:
+            with self.timer(name):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def to_emf(self):
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in self.metrics.items()]
+                }]
+            }
+        }
+        record.update(self.properties)
+        record.update(self.dimensions)
+        record.update((name, round(value, 3)) for name, (value, _) in self.metrics.items())
+        return record
+
+    def emit(self):
+        if not EMIT_METRICS or not self.metrics:
+            return
+        line = json.dumps(self.to_emf(), default=str) + '\n'
+        with _write_lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+
+class TimedReader:
+    # Wraps a streaming body so the time spent waiting on S3 is told apart from the CPU time
+    # of whoever reads it
+    def __init__(self, body, metrics, name):
+        self.body = body
+        self.metrics = metrics
+        self.name = name
+
+    def read(self, *args):
+        with self.metrics.timer(self.name):
+            data = self.body.read(*args)
+        self.metrics.add_metric(self.name.replace('Time', 'Bytes'), len(data), 'Bytes')
+        return data
+
+    def close(self):
+        self.body.close()
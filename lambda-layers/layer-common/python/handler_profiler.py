@@ -0,0 +1,294 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# On demand profiles of single invocations. A handler wrapped with profiled() is profiled when
+# its event asks for it, with "profile": true in the event (or in the iterator output handed to
+# the queue Lambda) or a "profile" message attribute on one of its SQS records, and otherwise at
+# random for PROFILE_SAMPLE_RATE of the invocations. A profile holds:
+#
+#   - the wall clock stacks of every thread, sampled every PROFILE_INTERVAL_MS, so time spent
+#     waiting on S3 or on ffmpeg shows up as much as time spent computing
+#   - a cProfile of the thread that runs the handler
+#   - a span for every AWS API call of the shared clients and every ffmpeg run, with the
+#     -benchmark times ffmpeg reports about itself
+#
+# It is written gzipped to PROFILE_BUCKET under PROFILE_PREFIX, or to PROFILE_DIR for local
+# runs, and a one line summary is logged. tools/aggregate_profiles.py merges many of them into
+# collapsed stacks for a flame graph.
+
+import cProfile
+import gzip
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+from aws_clients import register_event_handler, shared_client
+
+logger = logging.getLogger()
+
+PROFILE_FORMAT = 'handler-profile-v1'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS') or 10)
+PROFILE_BUCKET = os.environ.get('PROFILE_BUCKET')
+PROFILE_PREFIX = os.environ.get('PROFILE_PREFIX', 'profiles/')
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+# functions of the cProfile kept in the artifact, by cumulative time
+CPROFILE_TOP = 300
+# deepest stack kept per sample, the frames closest to the root are dropped first
+MAX_STACK_DEPTH = 128
+
+# the profile of the invocation in progress, an execution environment runs one at a time
+_active = None
+_hooks_registered = False
+_hooks_lock = threading.Lock()
+
+
+class Profile:
+
+    def __init__(self, stage, trigger, request_id):
+        self.stage = stage
+        self.trigger = trigger
+        self.request_id = request_id
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.sample_count = 0
+        self.spans = []
+        self.stopping = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name='profile-sampler', daemon=True)
+        self.cprofile = cProfile.Profile()
+
+    def start(self):
+        self.sampler.start()
+        self.cprofile.enable()
+
+    def stop(self):
+        self.cprofile.disable()
+        self.stopping.set()
+        self.sampler.join()
+        self.wall_seconds = time.perf_counter() - self.started
+
+    def sample(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        own_id = threading.get_ident()
+        while not self.stopping.wait(interval):
+            names = {thread.ident: thread_group(thread.name) for thread in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks.append(collapse_stack(names.get(thread_id, 'thread'), frame))
+            with self.lock:
+                self.sample_count += 1
+                for stack in stacks:
+                    self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def add_span(self, category, name, started, seconds, **attributes):
+        span = [category, name, round((started - self.started) * 1000, 3), round(seconds * 1000, 3),
+            thread_group(threading.current_thread().name)]
+        if attributes:
+            span.append(attributes)
+        with self.lock:
+            self.spans.append(span)
+
+    def cprofile_rows(self):
+        # [function, primitive calls, calls, own seconds, cumulative seconds] of the costliest functions
+        stats = pstats.Stats(self.cprofile).stats
+        rows = [[function_label(*function), primitive_calls, calls, round(own, 6), round(cumulative, 6)]
+            for function, (primitive_calls, calls, own, cumulative, _) in stats.items()]
+        rows.sort(key=lambda row: row[4], reverse=True)
+        return rows[:CPROFILE_TOP]
+
+    def artifact(self):
+        return {
+            'format': PROFILE_FORMAT,
+            'stage': self.stage,
+            'trigger': self.trigger,
+            'request_id': self.request_id,
+            'function': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', self.stage),
+            'started_at': self.started_at.isoformat(),
+            'wall_ms': round(self.wall_seconds * 1000, 3),
+            'interval_ms': PROFILE_INTERVAL_MS,
+            'sample_count': self.sample_count,
+            'samples': self.samples,
+            'cprofile': self.cprofile_rows(),
+            'spans': self.spans,
+        }
+
+
+def thread_group(name):
+    # pool threads are told apart by a counter, their stacks are merged
+    return re.sub(r'[-_]?\d+(_\d+)?$', '', name) or 'thread'
+
+
+def function_label(filename, line, function):
+    if filename == '~':
+        # built in functions
+        return function
+    return f"{function} ({os.path.basename(filename)}:{line})"
+
+
+def collapse_stack(root, frame):
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append(function_label(frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name))
+        frame = frame.f_back
+    frames.append(root)
+    # collapsed stack format, root first, frames separated by semicolons
+    return ';'.join(label.replace(';', ':') for label in reversed(frames))
+
+
+def is_active():
+    return _active is not None
+
+
+def add_span(category, name, started, seconds, **attributes):
+    profile = _active
+    if profile is not None:
+        profile.add_span(category, name, started, seconds, **attributes)
+
+
+@contextmanager
+def span(category, name, **attributes):
+    # attributes may be added to while the span is open
+    started = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        add_span(category, name, started, time.perf_counter() - started, **attributes)
+
+
+def before_call(model=None, context=None, **kwargs):
+    # on before-parameter-build, which every handler gets, unlike before-call
+    if _active is not None and context is not None:
+        context['profile_span'] = (f"{model.service_model.service_name}.{model.name}", time.perf_counter())
+
+
+def after_call(context=None, http_response=None, exception=None, **kwargs):
+    started = (context or {}).pop('profile_span', None)
+    if started is None:
+        return
+    name, started_at = started
+    attributes = {}
+    if http_response is not None:
+        attributes['status'] = http_response.status_code
+    if exception is not None:
+        attributes['error'] = type(exception).__name__
+    add_span('aws', name, started_at, time.perf_counter() - started_at, **attributes)
+
+
+def register_hooks():
+    # the first profile hooks the shared clients, every later call checks for an active profile
+    global _hooks_registered
+    with _hooks_lock:
+        if not _hooks_registered:
+            register_event_handler('before-parameter-build', before_call)
+            register_event_handler('after-call', after_call)
+            register_event_handler('after-call-error', after_call)
+            _hooks_registered = True
+
+
+def profile_requested(event):
+    if not isinstance(event, dict):
+        return False
+    if event.get('profile') or (isinstance(event.get('iterator'), dict) and event['iterator'].get('profile')):
+        return True
+    return any(record.get('messageAttributes', {}).get('profile', {}).get('stringValue', '').lower() == 'true'
+        for record in event.get('Records') or [])
+
+
+def profile_trigger(event):
+    if profile_requested(event):
+        return 'event'
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+def profiled(stage):
+    # wraps a lambda_handler, costs one check per invocation when it is not profiled
+    def decorate(handler):
+        @wraps(handler)
+        def wrapper(event, context):
+            global _active
+            trigger = profile_trigger(event)
+            if trigger is None or _active is not None:
+                return handler(event, context)
+            register_hooks()
+            request_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+            profile = Profile(stage, trigger, request_id)
+            _active = profile
+            profile.start()
+            try:
+                return handler(event, context)
+            finally:
+                profile.stop()
+                _active = None
+                write_profile(profile)
+        return wrapper
+    return decorate
+
+
+def write_profile(profile):
+    # a profile that cannot be written is logged and otherwise ignored
+    try:
+        artifact = profile.artifact()
+        body = gzip.compress(json.dumps(artifact, separators=(',', ':')).encode())
+        name = f"{profile.stage}/{profile.started_at:%Y/%m/%d}/{profile.started_at:%H%M%S}-{profile.request_id}.json.gz"
+        if PROFILE_BUCKET:
+            key = f"{PROFILE_PREFIX}{name}"
+            shared_client('s3').put_object(Bucket=PROFILE_BUCKET, Key=key, Body=body,
+                ContentType='application/json', ContentEncoding='gzip')
+            location = f"s3://{PROFILE_BUCKET}/{key}"
+        elif PROFILE_DIR:
+            path = os.path.join(PROFILE_DIR, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(body)
+            location = path
+        else:
+            location = None
+        logger.info(json.dumps({'profile': location, **summary(artifact)}))
+    except Exception as e:
+        logger.error(f"unable to write the profile of {profile.request_id}: {e}")
+
+
+def summary(artifact):
+    # the costliest functions of the handler thread and the time of every kind of span
+    spans = {}
+    for category, name, _, milliseconds, *_ in artifact['spans']:
+        count, total = spans.get(f"{category}:{name}", (0, 0))
+        spans[f"{category}:{name}"] = (count + 1, round(total + milliseconds, 3))
+    return {
+        'stage': artifact['stage'],
+        'trigger': artifact['trigger'],
+        'request_id': artifact['request_id'],
+        'wall_ms': artifact['wall_ms'],
+        'samples': artifact['sample_count'],
+        'top_own_seconds': [[row[0], row[3]] for row in sorted(artifact['cprofile'], key=lambda row: row[3], reverse=True)[:5]],
+        'spans': spans,
+    }
+
+
+# ffmpeg -benchmark prints lines like "bench: utime=0.120s stime=0.012s rtime=0.141s" and
+# "bench: maxrss=24576KiB" at the info log level
+FFMPEG_BENCH = re.compile(r'(utime|stime|rtime|maxrss)=([\d.]+)')
+
+
+def ffmpeg_benchmark(stderr_lines):
+    stats = {}
+    for line in stderr_lines:
+        line = line.decode(errors='replace') if isinstance(line, bytes) else line
+        if line.startswith('bench:'):
+            stats.update((name, float(value)) for name, value in FFMPEG_BENCH.findall(line))
+    return stats
@@ -0,0 +1,207 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Durable listing checkpoints, one item per recording day and listing shard. Once a page is
+# enqueued (or written to a manifest) the checkpoint moves past its last key and counts it, so an
+# execution that fails or times out halfway through a heavy day leaves behind how far it got.
+#
+# The execution that lists the first page of a shard claims its checkpoint. When the checkpoint
+# belongs to an earlier execution that is no longer running, the new execution takes it over and
+# lists from after the last key handled instead of from the start of the shard. An execution
+# still running keeps its checkpoint, the new one lists the whole shard without checkpointing it.
+#
+# Every page is hashed from its keys and ETags. A page whose hash matches the last one recorded
+# is not counted twice when a step is retried, and the chain of page hashes tells whether two
+# executions saw the same listing.
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from aws_clients import LazyClient, shared_client
+
+logger = logging.getLogger()
+
+STATUS_LISTING = 'listing'
+STATUS_LISTED = 'listed'
+# checkpoints of days nobody converts again expire with the DynamoDB time to live
+CHECKPOINT_TTL_DAYS = 30
+RUNNING = 'RUNNING'
+
+
+def shard_id(listing_shard):
+    # stable name of a shard, the same for every execution that plans the day the same way
+    description = json.dumps([listing_shard['prefix'], listing_shard['start_after'], listing_shard['end_before'],
+        listing_shard['delimiter']])
+    return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+
+def page_hash(objects):
+    digest = hashlib.sha256()
+    for obj in objects:
+        digest.update(f"{obj['Key']}\n{obj.get('ETag', '')}\n".encode())
+    return digest.hexdigest()
+
+
+def chain_hash(previous, page):
+    return hashlib.sha256(f"{previous}{page}".encode()).hexdigest()
+
+
+class ListingCheckpoints:
+
+    def __init__(self, table_name, execution_arn_prefix=None, client=None, stepfunctions=None):
+        self.table_name = table_name
+        # the ARN of an execution is this prefix, a colon and the run id
+        self.execution_arn_prefix = execution_arn_prefix
+        self.client = client or LazyClient('dynamodb')
+        self.stepfunctions = stepfunctions
+
+    def start(self, run_id, day, listing_shard, restart=False):
+        # Claims the checkpoint of the shard for run_id and returns it, with the key to list
+        # after in 'last_key'. Returns None when another execution still running holds it.
+        # restart lists the shard from its start, with a new checkpoint.
+        key = checkpoint_key(day, listing_shard)
+        item = self.get(key)
+        if item is None or restart:
+            checkpoint = new_checkpoint(run_id, day, listing_shard)
+            condition = {} if restart else {'ConditionExpression': 'attribute_not_exists(#day)',
+                'ExpressionAttributeNames': {'#day': 'day'}}
+            try:
+                self.client.put_item(TableName=self.table_name, Item=serialize(dict(checkpoint, **key)), **condition)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # another execution claimed it first
+                return self.start(run_id, day, listing_shard)
+            return checkpoint
+        if item['run_id'] == run_id:
+            # a retried step of the execution that holds it
+            return item
+        if self.is_running(item['run_id']):
+            logger.info(f"shard {key['shard']} of {day} is listed by {item['run_id']} which is still running")
+            return None
+        try:
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key=serialize(key),
+                UpdateExpression='SET run_id = :run_id, resumed_from = :previous, updated_at = :updated_at',
+                ConditionExpression='run_id = :previous',
+                ExpressionAttributeValues=serialize({
+                    ':run_id': run_id,
+                    ':previous': item['run_id'],
+                    ':updated_at': now(),
+                }),
+                ReturnValues='ALL_NEW',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # taken over by another execution in the meantime
+            return self.start(run_id, day, listing_shard)
+        checkpoint = deserialize(response['Attributes'])
+        logger.info(f"run {run_id} resumes shard {key['shard']} of {day} from {item['run_id']} after {checkpoint.get('last_key') or 'its start'}")
+        return checkpoint
+
+    def advance(self, run_id, day, listing_shard, last_key, page, continuation_token, keys_listed, keys_enqueued, pages=1):
+        # Moves the checkpoint past the pages listed by one step once their keys are enqueued.
+        # page is the page_hash of the page, or the chain_hash of the pages. Returns False when
+        # the checkpoint belongs to another execution or the page was already recorded.
+        key = checkpoint_key(day, listing_shard)
+        item = self.get(key)
+        if item is None:
+            return False
+        values = {
+            ':run_id': run_id,
+            ':status': STATUS_LISTING if continuation_token else STATUS_LISTED,
+            ':token': continuation_token or '',
+            ':page': page,
+            ':chain': chain_hash(item.get('page_chain', ''), page),
+            ':updated_at': now(),
+            ':expires_at': expires_at(),
+            ':listed': keys_listed,
+            ':enqueued': keys_enqueued,
+            ':pages': pages,
+        }
+        assignments = ['#status = :status', 'continuation_token = :token', 'last_page_hash = :page', 'page_chain = :chain',
+            'updated_at = :updated_at', 'expires_at = :expires_at']
+        if last_key:
+            values[':last_key'] = last_key
+            assignments.append('last_key = :last_key')
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key=serialize(key),
+                UpdateExpression=f"SET {', '.join(assignments)} ADD keys_listed :listed, keys_enqueued :enqueued, pages :pages",
+                ConditionExpression='run_id = :run_id AND (attribute_not_exists(last_page_hash) OR last_page_hash <> :page)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues=serialize(values),
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.info(f"checkpoint of shard {key['shard']} of {day} not advanced by {run_id}")
+            return False
+        return True
+
+    def get(self, key):
+        response = self.client.get_item(TableName=self.table_name, Key=serialize(key), ConsistentRead=True)
+        return deserialize(response['Item']) if 'Item' in response else None
+
+    def is_running(self, run_id):
+        # an execution that cannot be described is not coming back to its checkpoint
+        if self.execution_arn_prefix is None:
+            return False
+        if self.stepfunctions is None:
+            self.stepfunctions = shared_client('stepfunctions')
+        try:
+            response = self.stepfunctions.describe_execution(executionArn=f"{self.execution_arn_prefix}:{run_id}")
+        except ClientError as e:
+            logger.info(f"unable to describe execution {run_id}: {e}")
+            return False
+        return response['status'] == RUNNING
+
+
+def checkpoint_key(day, listing_shard):
+    return {'day': day, 'shard': shard_id(listing_shard)}
+
+
+def new_checkpoint(run_id, day, listing_shard):
+    return {
+        'run_id': run_id,
+        'status': STATUS_LISTING,
+        'prefix': listing_shard['prefix'],
+        'last_key': '',
+        'continuation_token': '',
+        'keys_listed': 0,
+        'keys_enqueued': 0,
+        'pages': 0,
+        'page_chain': '',
+        'updated_at': now(),
+        'expires_at': expires_at(),
+    }
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def expires_at():
+    return int((datetime.now(timezone.utc) + timedelta(days=CHECKPOINT_TTL_DAYS)).timestamp())
+
+
+def serialize(values):
+    return {name: {'N': str(value)} if isinstance(value, int) else {'S': value} for name, value in values.items()}
+
+
+def deserialize(item):
+    return {name: int(value['N']) if 'N' in value else value['S'] for name, value in item.items()}
+
+
+def open_listing_checkpoints():
+    if os.environ.get('CHECKPOINTS_TABLE'):
+        return ListingCheckpoints(os.environ['CHECKPOINTS_TABLE'], os.environ.get('EXECUTION_ARN_PREFIX'))
+    return None
@@ -0,0 +1,86 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Compact form of a listing page, handed from the iterator Lambda to the queue Lambda through the
+# state machine. Only the key, size and ETag of every object travel, column by column. Keys are
+# front coded: each one keeps the length of the prefix it shares with the key before it and the
+# rest, so the day prefix of a Connect recording is written once. ETags lose their quotes.
+#
+#   {"format": "front-coded-v1", "count": 2, "shared": [0, 39], "suffixes": [...], "sizes": [...], "etags": [...]}
+#
+# A state is limited to 256 KB, a page whose encoding is larger than the inline limit is
+# written to the work bucket and the state only carries where it is:
+#
+#   {"format": "front-coded-v1", "count": 5000, "location": {"bucket": "...", "key": "..."}}
+
+import json
+
+PAGE_FORMAT = 'front-coded-v1'
+# leaves room in the state for the rest of the iterator output
+INLINE_PAGE_BYTES = 192 * 1024
+
+
+def encode_page(objects):
+    shared = []
+    suffixes = []
+    previous = ''
+    for obj in objects:
+        key = obj['Key']
+        common = shared_prefix_length(previous, key)
+        shared.append(common)
+        suffixes.append(key[common:])
+        previous = key
+    return {
+        'format': PAGE_FORMAT,
+        'count': len(objects),
+        'shared': shared,
+        'suffixes': suffixes,
+        'sizes': [obj['Size'] for obj in objects],
+        'etags': [obj['ETag'].strip('"') for obj in objects],
+    }
+
+
+def decode_page(page):
+    objects = []
+    previous = ''
+    for common, suffix, size, etag in zip(page['shared'], page['suffixes'], page['sizes'], page['etags']):
+        previous = previous[:common] + suffix
+        objects.append({'Key': previous, 'Size': size, 'ETag': f'"{etag}"'})
+    return objects
+
+
+def shared_prefix_length(a, b):
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def store_page(objects, s3, bucket, key, inline_limit=INLINE_PAGE_BYTES):
+    # The page to put in the state: inline, or a pointer to the page written to bucket/key when
+    # its encoding is too large and there is a bucket to write it to
+    page = encode_page(objects)
+    body = json.dumps(page, separators=(',', ':'))
+    if bucket is None or len(body) <= inline_limit:
+        return page
+    s3.put_object(Bucket=bucket, Key=key, Body=body.encode(), ContentType='application/json')
+    return {'format': PAGE_FORMAT, 'count': page['count'], 'location': {'bucket': bucket, 'key': key}}
+
+
+def load_page(files, s3):
+    # The objects of a page in the state, read from the work bucket when it was too large to
+    # inline. A plain list is a page from before the compact form and is returned as is.
+    if isinstance(files, list):
+        return files
+    if 'location' in files:
+        body = s3.get_object(Bucket=files['location']['bucket'], Key=files['location']['key'])['Body']
+        try:
+            files = json.loads(body.read())
+        finally:
+            body.close()
+    return decode_page(files)
+
+
+def page_count(files):
+    return len(files) if isinstance(files, list) else files['count']
@@ -0,0 +1,165 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Index of the recordings still to convert, written as they are created. S3 announces every
+# object written under the recordings prefix with an Object Created event, and the ingest Lambda
+# adds its key, size and ETag to the index, in the partition of the day it was created on and
+# sorted by creation time. The scheduled execution reads the recordings created in a window that
+# ends NUM_DAYS_AGE days ago straight from the index, without listing the bucket, so finding the
+# work costs in proportion to the recordings written that day rather than to the bucket.
+#
+# The window is cut at the hour, so a recording is converted once it is NUM_DAYS_AGE days old
+# instead of with the rest of its day prefix, and an execution run again within the hour reads
+# the same shards and resumes from their listing checkpoints.
+#
+# A day is spread over PENDING_INDEX_PARTITIONS partitions by a hash of the key, which keeps the
+# writes of a busy instance within the throughput of a partition and gives the execution as many
+# shards to read in parallel. Changing it leaves the entries already written unread.
+
+import hashlib
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from aws_clients import LazyClient
+
+# how the execution finds the recordings of a day, in the work items of plan_days
+SOURCE_LISTING = 'listing'
+SOURCE_INDEX = 'index'
+
+PENDING_INDEX_PARTITIONS = int(os.environ.get('PENDING_INDEX_PARTITIONS') or 4)
+# entries are kept this long after they are due, for executions that are run again
+PENDING_RETENTION_DAYS = 14
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+SHARD_PREFIX = 'pending-index/'
+
+# BatchWriteItem accepts at most 25 items
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_ATTEMPTS = 8
+
+
+def format_time(moment):
+    return moment.astimezone(timezone.utc).strftime(TIME_FORMAT)
+
+
+def parse_time(value):
+    return datetime.strptime(value, TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def partition_of(key, created_at):
+    # created_at is a TIME_FORMAT string, its first ten characters are the day
+    number = int(hashlib.sha256(key.encode()).hexdigest()[:8], 16) % PENDING_INDEX_PARTITIONS
+    return f"{created_at[:10]}#{number}"
+
+
+def pending_entry(key, size, etag, created_at, age_days):
+    # an index item, sorted by creation time and then key within its partition
+    return {
+        'day': partition_of(key, created_at),
+        'created': f"{created_at}#{key}",
+        'key': key,
+        'size': size,
+        'etag': etag,
+        'expires_at': int((parse_time(created_at) + timedelta(days=age_days + PENDING_RETENTION_DAYS)).timestamp()),
+    }
+
+
+def due_window(age_days, window_hours, overlap_hours, now=None):
+    # The creation times due for conversion: the window_hours up to the last full hour at least
+    # age_days ago, extended back by overlap_hours so a late or early schedule leaves no gap.
+    end = ((now or datetime.now(timezone.utc)) - timedelta(days=age_days)).replace(minute=0, second=0, microsecond=0)
+    return end - timedelta(hours=window_hours + overlap_hours), end
+
+
+def index_shard(partition, start, end):
+    # reads like a listing shard, from start (inclusive) to end (exclusive) in creation time
+    return {
+        'prefix': f"{SHARD_PREFIX}{partition}",
+        'start_after': start,
+        'end_before': end,
+        'delimiter': '',
+        'partition': partition,
+    }
+
+
+def index_shards(start, end):
+    # every partition of every day the window touches
+    shards = []
+    day = start.date()
+    while day <= (end - timedelta(seconds=1)).date():
+        for number in range(PENDING_INDEX_PARTITIONS):
+            shards.append(index_shard(f"{day:%Y-%m-%d}#{number}", format_time(start), format_time(end)))
+        day += timedelta(days=1)
+    return shards
+
+
+def is_index_shard(listing_shard):
+    return bool(listing_shard) and 'partition' in listing_shard
+
+
+class PendingIndex:
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or LazyClient('dynamodb')
+
+    def add(self, entries):
+        # Writes the entries, 25 per request. An entry of a key written twice in one second
+        # replaces the first, the ETag of the later write wins.
+        entries = list({(entry['day'], entry['created']): entry for entry in entries}.values())
+        for i in range(0, len(entries), BATCH_WRITE_SIZE):
+            requests = [{'PutRequest': {'Item': serialize(entry)}} for entry in entries[i:i + BATCH_WRITE_SIZE]]
+            for attempt in range(BATCH_WRITE_ATTEMPTS):
+                if attempt:
+                    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+                requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                if not requests:
+                    break
+            else:
+                raise RuntimeError(f"{len(requests)} pending index entries not written after {BATCH_WRITE_ATTEMPTS} attempts")
+
+    def list_page(self, listing_shard, max_keys, exclusive_start=''):
+        # Reads up to max_keys entries of an index shard, in the objects of a listing page.
+        # exclusive_start is the sort key to continue after, a continuation token or a
+        # checkpoint. Returns the objects and the token to continue from, '' at the end.
+        query = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#day = :day AND #created BETWEEN :start AND :end',
+            'ExpressionAttributeNames': {'#day': 'day', '#created': 'created'},
+            'ExpressionAttributeValues': {
+                ':day': {'S': listing_shard['partition']},
+                # a sort key is a time and a key, the end time alone sorts before every entry created then
+                ':start': {'S': listing_shard['start_after']},
+                ':end': {'S': listing_shard['end_before']},
+            },
+        }
+        if exclusive_start:
+            query['ExclusiveStartKey'] = {'day': {'S': listing_shard['partition']}, 'created': {'S': exclusive_start}}
+        objects = []
+        while True:
+            query['Limit'] = max_keys - len(objects)
+            response = self.client.query(**query)
+            for item in response['Items']:
+                entry = deserialize(item)
+                objects.append({'Key': entry['key'], 'Size': entry['size'], 'ETag': entry['etag']})
+            if 'LastEvaluatedKey' not in response:
+                return objects, ''
+            if len(objects) >= max_keys:
+                return objects, response['LastEvaluatedKey']['created']['S']
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def serialize(values):
+    return {name: {'N': str(value)} if isinstance(value, int) else {'S': value} for name, value in values.items()}
+
+
+def deserialize(item):
+    return {name: int(value['N']) if 'N' in value else value['S'] for name, value in item.items()}
+
+
+def open_pending_index():
+    if os.environ.get('PENDING_TABLE'):
+        return PendingIndex(os.environ['PENDING_TABLE'])
+    return None
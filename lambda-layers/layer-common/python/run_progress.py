@@ -0,0 +1,173 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Progress of a workflow execution, one item per recording day, in the runs table. The state
+# machine marks a day as listing and listed, the Lambdas add their counters as they go.
+#
+# The run item tracks completion: the queue Lambda adds the recordings it enqueued to
+# 'expected', the convert Lambda adds every recording it finished to 'completed' or, once SQS
+# gives up on it, to 'failed'. When everything is enqueued the state machine parks a task
+# token on the item, and whichever update makes the counts meet resumes the execution.
+#
+# Both sides count versions of recordings, by their dispatch key, once. A retried queue step
+# sends a page again, and a version can be sent twice or finished by more than one message, so
+# the queue Lambda keeps the dispatch keys of every page it enqueued in a page item and the
+# convert Lambda writes a version item for every version it finished. Only the first write of
+# a dispatch key is counted. These items expire with the DynamoDB time to live.
+
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from aws_clients import LazyClient, shared_client
+
+logger = logging.getLogger()
+
+RUN_ITEM = 'run'
+COMPLETION_COUNTERS = ('expected', 'completed', 'failed')
+# page and version items are kept this long, longer than an execution waits for its recordings
+COUNTED_TTL_DAYS = 30
+
+
+class RunProgress:
+
+    def __init__(self, table_name, client=None, stepfunctions=None):
+        self.table_name = table_name
+        self.client = client or LazyClient('dynamodb')
+        self.stepfunctions = stepfunctions
+
+    def add_day_counters(self, run_id, day, **counters):
+        counters = {name: value for name, value in counters.items() if value}
+        if not counters:
+            return
+        self.client.update_item(
+            TableName=self.table_name,
+            Key={'run_id': {'S': run_id}, 'item': {'S': day_item(day)}},
+            UpdateExpression='ADD ' + ', '.join(f'#{name} :{name}' for name in counters),
+            ExpressionAttributeNames={f'#{name}': name for name in counters},
+            ExpressionAttributeValues={f':{name}': {'N': str(value)} for name, value in counters.items()},
+        )
+
+
+    def add_run_counters(self, run_id, **counters):
+        # Adds to the completion counters of the run and resumes the execution when they meet
+        counters = {name: value for name, value in counters.items() if value}
+        if not counters:
+            return
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key=run_key(run_id),
+            UpdateExpression='ADD ' + ', '.join(f'#{name} :{name}' for name in counters),
+            ExpressionAttributeNames={f'#{name}': name for name in counters},
+            ExpressionAttributeValues={f':{name}': {'N': str(value)} for name, value in counters.items()},
+            ReturnValues='ALL_NEW',
+        )
+        self.notify_if_complete(run_id, response['Attributes'])
+
+    def add_expected_versions(self, run_id, page, versions):
+        # Adds the versions of a page to 'expected' before they are sent, the ones a retried step
+        # sends again are not counted twice. page is the page_hash of the listing page.
+        versions = set(versions)
+        if not versions:
+            return
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key={'run_id': {'S': run_id}, 'item': {'S': page_item(page)}},
+            UpdateExpression='ADD versions :versions SET expires_at = :expires_at',
+            ExpressionAttributeValues={':versions': {'SS': sorted(versions)}, ':expires_at': {'N': str(expires_at())}},
+            ReturnValues='UPDATED_OLD',
+        )
+        enqueued = set(response.get('Attributes', {}).get('versions', {}).get('SS', []))
+        self.add_run_counters(run_id, expected=len(versions - enqueued))
+
+    def finish_versions(self, run_id, outcomes):
+        # Adds the versions to 'completed' or 'failed' by their outcome, {dispatch key: counter}.
+        # The first message of a version to finish counts it, the others are ignored.
+        counters = {}
+        for version, outcome in outcomes.items():
+            try:
+                self.client.put_item(
+                    TableName=self.table_name,
+                    Item={'run_id': {'S': run_id}, 'item': {'S': version_item(version)}, 'outcome': {'S': outcome},
+                        'expires_at': {'N': str(expires_at())}},
+                    ConditionExpression='attribute_not_exists(#item)',
+                    ExpressionAttributeNames={'#item': 'item'},
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                continue
+            counters[outcome] = counters.get(outcome, 0) + 1
+        self.add_run_counters(run_id, **counters)
+
+    def await_completion(self, run_id, task_token):
+        # Called once every recording of the run is enqueued, no more is added to 'expected'
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key=run_key(run_id),
+            UpdateExpression='SET task_token = :task_token, listed_at = :listed_at',
+            ExpressionAttributeValues={
+                ':task_token': {'S': task_token},
+                ':listed_at': {'S': datetime.now(timezone.utc).isoformat()},
+            },
+            ReturnValues='ALL_NEW',
+        )
+        self.notify_if_complete(run_id, response['Attributes'])
+
+    def notify_if_complete(self, run_id, attributes):
+        if 'task_token' not in attributes:
+            return
+        counts = {name: int(attributes.get(name, {'N': '0'})['N']) for name in COMPLETION_COUNTERS}
+        if counts['completed'] + counts['failed'] < counts['expected']:
+            return
+        # only one of the Lambdas that see the counts meet sends the task success
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key=run_key(run_id),
+                UpdateExpression='SET completed_at = :completed_at',
+                ConditionExpression='attribute_not_exists(completed_at)',
+                ExpressionAttributeValues={':completed_at': {'S': datetime.now(timezone.utc).isoformat()}},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            raise
+        if self.stepfunctions is None:
+            self.stepfunctions = shared_client('stepfunctions')
+        try:
+            self.stepfunctions.send_task_success(taskToken=attributes['task_token']['S'], output=json.dumps(counts))
+        except ClientError as e:
+            # the execution timed out or was stopped in the meantime
+            logger.error(f"unable to resume run {run_id}: {e}")
+            return
+        logger.info(f"run {run_id} complete: {counts}")
+
+
+def run_key(run_id):
+    return {'run_id': {'S': run_id}, 'item': {'S': RUN_ITEM}}
+
+
+def day_item(day):
+    return f'day#{day}'
+
+
+def page_item(page):
+    return f'page#{page}'
+
+
+def version_item(version):
+    return f'version#{version}'
+
+
+def expires_at():
+    return int((datetime.now(timezone.utc) + timedelta(days=COUNTED_TTL_DAYS)).timestamp())
+
+
+def open_run_progress():
+    if os.environ.get('RUNS_TABLE'):
+        return RunProgress(os.environ['RUNS_TABLE'])
+    return None
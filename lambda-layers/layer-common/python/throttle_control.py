@@ -0,0 +1,156 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Fleet wide throttle control for the convert Lambda. Every invocation counts the S3 requests it
+# made and how many of them were throttled, S3 SlowDown and the KMS throttling S3 passes on
+# for encrypted recordings included, and adds them to a shared window in the runs table. When
+# the window closes, the number of conversions in flight across the fleet is adjusted the AIMD
+# way: halved when more than THROTTLE_RATIO of the requests were throttled, raised by a small
+# step otherwise. That number is split into the workers of each invocation and the maximum
+# concurrency of the SQS event source mapping, so the fleet settles just under the rate the
+# bucket and the key sustain instead of flooding them and backing off in lockstep.
+
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from aws_clients import LazyClient, shared_client
+
+logger = logging.getLogger()
+
+THROTTLE_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'KMS.ThrottlingException', 'ServiceUnavailable')
+STATE_KEY = {'run_id': {'S': 'fleet'}, 'item': {'S': 'throttle'}}
+# the lowest maximum concurrency an SQS event source mapping accepts
+MIN_CONCURRENCY = 2
+
+
+def is_throttle_error(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLE_ERROR_CODES
+
+
+class ThrottleObserver:
+    # Counts every attempt of the clients on_response is registered on, retries made by botocore
+    # included. The clients are built lazily, on_response goes in the event_handlers of their LazyClient.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttles = 0
+
+    def on_response(self, parsed_response=None, response_dict=None, exception=None, **kwargs):
+        status = (response_dict or {}).get('status_code')
+        code = (parsed_response or {}).get('Error', {}).get('Code')
+        with self.lock:
+            self.requests += 1
+            if code in THROTTLE_ERROR_CODES or status == 503:
+                self.throttles += 1
+
+    def drain(self):
+        with self.lock:
+            counts = self.requests, self.throttles
+            self.requests = self.throttles = 0
+        return counts
+
+
+class AimdController:
+
+    def __init__(self, table_name, max_workers, max_concurrency, client=None, lambda_client=None,
+            window_seconds=60, increase=2, decrease=0.5, throttle_ratio=0.01, cache_seconds=15):
+        self.table_name = table_name
+        self.max_workers = max_workers
+        self.max_concurrency = max(max_concurrency, MIN_CONCURRENCY)
+        self.client = client or LazyClient('dynamodb')
+        self.lambda_client = lambda_client
+        self.window_seconds = window_seconds
+        self.increase = increase
+        self.decrease = decrease
+        self.throttle_ratio = throttle_ratio
+        self.cache_seconds = cache_seconds
+        self.cached_in_flight = None
+        self.cached_at = 0
+        self.event_source_mapping_id = None
+
+    def max_in_flight(self):
+        return self.max_workers * self.max_concurrency
+
+    def split(self, in_flight):
+        # workers per invocation and invocations that carry in_flight conversions between them
+        workers = max(1, min(self.max_workers, in_flight))
+        concurrency = min(self.max_concurrency, max(MIN_CONCURRENCY, math.ceil(in_flight / workers)))
+        return workers, concurrency
+
+    def workers(self):
+        # the worker count for this invocation, read from the shared state now and then
+        if self.cached_in_flight is None or time.monotonic() - self.cached_at > self.cache_seconds:
+            response = self.client.get_item(TableName=self.table_name, Key=STATE_KEY, ConsistentRead=False)
+            item = response.get('Item', {})
+            self.cached_in_flight = int(item['in_flight']['N']) if 'in_flight' in item else self.max_in_flight()
+            self.cached_at = time.monotonic()
+        return self.split(self.cached_in_flight)[0]
+
+    def report(self, requests, throttles, function_name, queue_arn):
+        if not requests:
+            return
+        now = int(time.time())
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key=STATE_KEY,
+            UpdateExpression='ADD window_requests :requests, window_throttles :throttles SET window_start = if_not_exists(window_start, :now)',
+            ExpressionAttributeValues={':requests': {'N': str(requests)}, ':throttles': {'N': str(throttles)}, ':now': {'N': str(now)}},
+            ReturnValues='ALL_NEW',
+        )
+        state = response['Attributes']
+        window_start = int(state['window_start']['N'])
+        if now - window_start < self.window_seconds:
+            return
+        window_requests = int(state['window_requests']['N'])
+        window_throttles = int(state['window_throttles']['N'])
+        in_flight = int(state['in_flight']['N']) if 'in_flight' in state else self.max_in_flight()
+        if window_throttles > window_requests * self.throttle_ratio:
+            new_in_flight = max(1, math.floor(in_flight * self.decrease))
+        else:
+            new_in_flight = min(self.max_in_flight(), in_flight + self.increase)
+        # only the invocation that closes the window applies the change
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key=STATE_KEY,
+                UpdateExpression='SET window_start = :now, window_requests = :zero, window_throttles = :zero, in_flight = :in_flight',
+                ConditionExpression='window_start = :window_start',
+                ExpressionAttributeValues={':now': {'N': str(now)}, ':zero': {'N': '0'},
+                    ':in_flight': {'N': str(new_in_flight)}, ':window_start': {'N': str(window_start)}},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            raise
+        self.cached_in_flight, self.cached_at = new_in_flight, time.monotonic()
+        logger.info(f"{window_throttles} of {window_requests} requests throttled, {in_flight} -> {new_in_flight} conversions in flight")
+        if self.split(new_in_flight)[1] != self.split(in_flight)[1]:
+            self.set_event_source_concurrency(self.split(new_in_flight)[1], function_name, queue_arn)
+
+    def set_event_source_concurrency(self, concurrency, function_name, queue_arn):
+        if self.lambda_client is None:
+            self.lambda_client = shared_client('lambda')
+        if self.event_source_mapping_id is None:
+            mappings = self.lambda_client.list_event_source_mappings(FunctionName=function_name, EventSourceArn=queue_arn)
+            self.event_source_mapping_id = mappings['EventSourceMappings'][0]['UUID']
+        self.lambda_client.update_event_source_mapping(UUID=self.event_source_mapping_id,
+            ScalingConfig={'MaximumConcurrency': concurrency})
+
+
+def open_throttle_controller(max_workers):
+    if os.environ.get('RUNS_TABLE') and os.environ.get('MAX_CONCURRENCY'):
+        return AimdController(os.environ['RUNS_TABLE'], max_workers, int(os.environ['MAX_CONCURRENCY']))
+    return None
+
+
+def jittered_backoff(attempt, base, cap):
+    # full jitter, the delays of throttled retries spread out instead of arriving together
+    return random.uniform(0, min(cap, base * 2 ** attempt))
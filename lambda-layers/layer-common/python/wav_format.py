@@ -0,0 +1,86 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import struct
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_ALAW = 0x0006
+WAVE_FORMAT_MULAW = 0x0007
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# data chunk size written by streaming muxers that could not seek back
+WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+# RIFF/WAVE + fmt (WAVEFORMATEX, 18 bytes) + fact + data chunk headers
+WAV_HEADER_SIZE = 12 + (8 + 18) + (8 + 4) + 8
+
+
+def build_wav_header(data_size, format_tag=WAVE_FORMAT_ALAW, channels=1, sample_rate=8000, bits_per_sample=8):
+    # Same layout ffmpeg writes for pcm_alaw on a seekable output, so the sizes are correct
+    # without a second pass over the file. Odd sized data chunks are padded to an even length.
+    block_align = channels * bits_per_sample // 8
+    byte_rate = sample_rate * block_align
+    sample_count = data_size // block_align
+    pad = data_size & 1
+    riff_size = WAV_HEADER_SIZE - 8 + data_size + pad
+    return (
+        b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHHH', 18, format_tag, channels, sample_rate, byte_rate, block_align, bits_per_sample, 0)
+        + b'fact' + struct.pack('<II', 4, sample_count)
+        + b'data' + struct.pack('<I', data_size)
+    )
+
+
+def wav_padding(data_size):
+    return b'\x00' * (data_size & 1)
+
+
+def read_exact(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_wav_format(stream):
+    # Walks the RIFF chunks up to the start of the data chunk and returns the audio format.
+    # The stream is left positioned at the first sample. Raises ValueError for anything that
+    # is not a RIFF/WAVE file.
+    riff = read_exact(stream, 12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError("not a RIFF/WAVE file")
+    wav_format = None
+    while True:
+        chunk_header = read_exact(stream, 8)
+        if len(chunk_header) < 8:
+            raise ValueError("no data chunk")
+        chunk_id = chunk_header[:4]
+        chunk_size, = struct.unpack('<I', chunk_header[4:])
+        if chunk_id == b'data':
+            if wav_format is None:
+                raise ValueError("data chunk before fmt chunk")
+            wav_format['data_size'] = None if chunk_size in (0, WAV_UNKNOWN_SIZE) else chunk_size
+            return wav_format
+        body = read_exact(stream, chunk_size + (chunk_size & 1))
+        if len(body) < chunk_size:
+            raise ValueError("truncated chunk")
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise ValueError("short fmt chunk")
+            format_tag, channels, sample_rate, byte_rate, block_align, bits_per_sample = struct.unpack('<HHIIHH', body[:16])
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # the first two bytes of the SubFormat GUID carry the real format tag
+                format_tag, = struct.unpack('<H', body[24:26])
+            wav_format = {
+                'format_tag': format_tag,
+                'channels': channels,
+                'sample_rate': sample_rate,
+                'block_align': block_align,
+                'bits_per_sample': bits_per_sample,
+            }
+
+
+# bytes fetched by a header probe, enough for the RIFF, fmt and a small LIST chunk
+PROBE_SIZE = 4096
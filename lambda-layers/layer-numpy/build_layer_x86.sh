@@ -0,0 +1,8 @@
+#!/bin/bash -x
+
+rm -fr python numpy_layer.zip
+
+pip install numpy --target python/ --platform manylinux2014_x86_64 --implementation cp --python-version 3.9 --only-binary=:all:
+
+zip -r numpy_layer.zip python
+rm -fr python/
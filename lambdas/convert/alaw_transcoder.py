@@ -0,0 +1,128 @@
+# In-process PCM WAV to G.711 A-law or mu-law transcoder. Produces the same bytes as
+# `ffmpeg -ac 1 -ar 8000 -c:a pcm_alaw` (or pcm_mulaw) for the 16-bit PCM recordings Amazon
+# Connect writes, without forking ffmpeg. Anything else is left to the ffmpeg backend.
+
+import numpy as np
+
+from wav_format import read_exact, WAVE_FORMAT_PCM, WAVE_FORMAT_ALAW, WAVE_FORMAT_MULAW
+
+TARGET_SAMPLE_RATE = 8000
+# frames decoded per numpy block
+CHUNK_FRAMES = 64 * 1024
+
+
+def alaw_to_linear(a_val):
+    # alaw2linear() from libavcodec/pcm_tablegen.h
+    a_val ^= 0x55
+    t = a_val & 0x0f
+    seg = (a_val & 0x70) >> 4
+    if seg:
+        t = (t + t + 1 + 32) << (seg + 2)
+    else:
+        t = (t + t + 1) << 3
+    return t if a_val & 0x80 else -t
+
+
+def ulaw_to_linear(u_val):
+    # ulaw2linear() from libavcodec/pcm_tablegen.h
+    bias = 0x84
+    u_val = ~u_val & 0xff
+    t = ((u_val & 0x0f) << 3) + bias
+    t <<= (u_val & 0x70) >> 4
+    return bias - t if u_val & 0x80 else t - bias
+
+
+def build_xlaw_table(xlaw_to_linear, mask):
+    # build_xlaw_table() from libavcodec/pcm_tablegen.h: 14-bit linear index to A-law or mu-law
+    # byte, each step placed on the midpoint between two decoded levels.
+    table = np.zeros(16384, dtype=np.uint8)
+    table[8192] = mask
+    j = 1
+    for i in range(127):
+        v1 = xlaw_to_linear(i ^ mask)
+        v2 = xlaw_to_linear((i + 1) ^ mask)
+        v = (v1 + v2 + 4) >> 3
+        while j < v:
+            table[8192 - j] = i ^ (mask ^ 0x80)
+            table[8192 + j] = i ^ mask
+            j += 1
+    while j < 8192:
+        table[8192 - j] = 127 ^ (mask ^ 0x80)
+        table[8192 + j] = 127 ^ mask
+        j += 1
+    table[0] = table[1]
+    return table
+
+
+LINEAR_TO_ALAW = build_xlaw_table(alaw_to_linear, 0xd5)
+LINEAR_TO_ULAW = build_xlaw_table(ulaw_to_linear, 0xff)
+# encoder table per WAV format tag of the output
+G711_TABLES = {WAVE_FORMAT_ALAW: LINEAR_TO_ALAW, WAVE_FORMAT_MULAW: LINEAR_TO_ULAW}
+
+
+def can_transcode(wav_format):
+    return (wav_format['format_tag'] == WAVE_FORMAT_PCM
+        and wav_format['bits_per_sample'] == 16
+        and wav_format['channels'] in (1, 2)
+        and wav_format['block_align'] == 2 * wav_format['channels']
+        and wav_format['sample_rate'] == TARGET_SAMPLE_RATE)
+
+
+def encode_g711(samples, table=LINEAR_TO_ALAW):
+    # pcm_encode_frame(): linear_to_alaw[(v + 32768) >> 2], and the same index into linear_to_ulaw
+    return table[(samples.astype(np.int32) + 32768) >> 2]
+
+
+def downmix_to_mono(frames):
+    # swresample's integer stereo to mono matrix: both coefficients 0.5 in Q15, rounded
+    frames = frames.astype(np.int32)
+    return (frames[:, 0] * 16384 + frames[:, 1] * 16384 + 16384) >> 15
+
+
+def read_pcm_blocks(stream, wav_format, chunk_frames=CHUNK_FRAMES):
+    # Yields (frames, channels) int16 blocks read from a stream positioned at the start of the
+    # data chunk.
+    channels = wav_format['channels']
+    block_align = wav_format['block_align']
+    remaining = wav_format['data_size']
+    while remaining is None or remaining > 0:
+        read_size = chunk_frames * block_align
+        if remaining is not None:
+            read_size = min(read_size, remaining)
+        data = read_exact(stream, read_size)
+        if remaining is not None:
+            remaining -= len(data)
+        # a trailing partial frame is dropped, as ffmpeg does
+        data = data[:len(data) - len(data) % block_align]
+        if not data:
+            break
+        yield np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+
+
+def encode_blocks(blocks, table=LINEAR_TO_ALAW):
+    # mono A-law or mu-law bytes of every frame block
+    for frames in blocks:
+        mono = frames[:, 0] if frames.shape[1] == 1 else downmix_to_mono(frames)
+        yield encode_g711(mono, table).tobytes()
+
+
+class PcmReader:
+    # File-like view of frame blocks as 16-bit little endian bytes, to feed them to ffmpeg's stdin
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            frames = next(self.blocks, None)
+            if frames is None:
+                break
+            self.buffer += frames.astype('<i2', copy=False).tobytes()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.blocks.close()
@@ -0,0 +1,283 @@
+# Storage independent core of the convert Lambda. A recording is read through a storage backend
+# (S3Storage in the Lambda, LocalStorage for offline runs, see recording_storage.py), checked
+# against the ledger and its own header, decoded and encoded in process or by ffmpeg, and written
+# back through the same backend. The Lambda and tools/convert_local.py both run this code, so a
+# recording converts to the same bytes wherever it is stored.
+
+import json
+import logging
+import subprocess
+import threading
+import time
+
+import handler_profiler
+from wav_format import read_wav_format
+from codec_profiles import ffmpeg_output_args, is_profile_output, output_seconds
+from conversion_ledger import is_converted, ledger_record, STATUS_CONVERTED, STATUS_ALREADY_TARGET, STATUS_CONVERTING, DONE_STATUSES
+from embedded_metrics import TimedReader
+
+# numpy comes from an optional layer, without it every file goes through ffmpeg
+try:
+    import alaw_transcoder
+    import silence_compactor
+except ImportError:
+    alaw_transcoder = None
+    silence_compactor = None
+
+logger = logging.getLogger()
+
+FFMPEG_PATH = '/opt/bin/ffmpeg'
+# bytes read from the ffmpeg stdout pipe at a time
+STREAM_CHUNK_SIZE = 256 * 1024
+
+DEFAULT_OPTIONS = {
+    # 'auto' transcodes in process when the input allows it, 'ffmpeg' always forks ffmpeg
+    'backend': 'auto',
+    # recordings already in the format of the codec profile are recognised from their first few kilobytes
+    'header_probe': True,
+    # too small for the conversion to pay for itself
+    'min_convert_bytes': 0,
+    # SilenceCompactor keyword arguments, None leaves silence as it is
+    'silence_compaction': None,
+    'silence_index_suffix': '.silence.json',
+    # how long the lease on a recording being converted keeps other converters away from it
+    'lease_seconds': 1800,
+}
+
+
+class ConvertError(Exception):
+    pass
+
+
+def convert_recording(storage, key, profile, metrics, ledger=None, options=None, transcode=None, lease_owner=None):
+    # Converts one recording and returns its outcome, the ETag now stored under the key and the
+    # sizes before and after. transcode replaces the streaming encode and write, the Lambda's
+    # tmp mode uses it. With a lease_owner the recording is leased in the ledger first and left
+    # to whoever else is converting it.
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    # metadata, content type and encryption of the original carry over to the converted object
+    with metrics.timer('HeadTime'):
+        source = storage.stat(key)
+    metrics.put_metric('InputBytes', source['ContentLength'], 'Bytes')
+    result = {'outcome': None, 'etag': source['ETag'], 'source_etag': source['ETag'],
+        'input_bytes': source['ContentLength'], 'output_bytes': source['ContentLength']}
+    if ledger is not None and lease_owner is not None:
+        with metrics.timer('LedgerTime'):
+            leased = ledger.claim(key, source['ETag'], STATUS_CONVERTING, lease_owner, options['lease_seconds'], source['ContentLength'])
+            record = None if leased else ledger.get_many([key]).get(key)
+        if is_converted(record, source['ETag']):
+            logger.info(f"already converted: {storage.describe(key)}")
+            return dict(result, outcome='already-converted')
+        if not leased:
+            # the caller tries again, at the latest when the lease of the other worker runs out
+            logger.info(f"being converted by another worker: {storage.describe(key)}")
+            return dict(result, outcome='in-flight', lease_expires_at=(record or {}).get('lease_expires_at'))
+        try:
+            result = convert_unconverted(storage, key, source, result, profile, metrics, ledger, options, transcode)
+        except Exception:
+            ledger.release(key, source['ETag'], lease_owner)
+            raise
+        if result['outcome'] not in DONE_STATUSES:
+            ledger.release(key, source['ETag'], lease_owner)
+        return result
+    if ledger is not None:
+        with metrics.timer('LedgerTime'):
+            converted = is_converted(ledger.get_many([key]).get(key), source['ETag'])
+        if converted:
+            logger.info(f"already converted: {storage.describe(key)}")
+            return dict(result, outcome='already-converted')
+    return convert_unconverted(storage, key, source, result, profile, metrics, ledger, options, transcode)
+
+
+def convert_unconverted(storage, key, source, result, profile, metrics, ledger, options, transcode):
+    # too small for the conversion to pay for itself, not recorded in the ledger so that a lower
+    # threshold picks it up later
+    if source['ContentLength'] < options['min_convert_bytes']:
+        logger.info(f"below the minimum size to convert: {storage.describe(key)}")
+        return dict(result, outcome='below-threshold')
+    # recordings already in the format of the codec profile, converted by another tool or copied
+    # without tags, are recognised from their first few kilobytes
+    if options['header_probe']:
+        with metrics.timer('ProbeTime'):
+            target = is_profile_output(storage.probe(key), profile)
+        if target:
+            logger.info(f"already {profile['name']}: {storage.describe(key)}")
+            if ledger is not None:
+                ledger.put(ledger_record(key, source['ETag'], STATUS_ALREADY_TARGET, source['ContentLength'], source['ContentLength']))
+            return dict(result, outcome=STATUS_ALREADY_TARGET)
+    logger.info("starting convert process")
+    logger.info(storage.describe(key))
+    if transcode is not None:
+        converted_etag, converted_size = transcode(storage, key, source, profile, metrics)
+    else:
+        converted_etag, converted_size = encode_and_write(storage, key, source, profile, metrics, options)
+    if ledger is not None:
+        with metrics.timer('LedgerTime'):
+            ledger.put(ledger_record(key, converted_etag, STATUS_CONVERTED, source['ContentLength'], converted_size))
+    metrics.put_metric('OutputBytes', converted_size, 'Bytes')
+    metrics.put_metric('BytesSaved', source['ContentLength'] - converted_size, 'Bytes')
+    metrics.put_metric('CompressionRatio', source['ContentLength'] / max(converted_size, 1), 'None')
+    # from the bitrate of the profile, exact for the constant bitrate G.711 profiles
+    metrics.put_metric('AudioSeconds', output_seconds(profile, converted_size), 'Seconds')
+    logger.info(f"converted the file: {storage.describe(key)}")
+    return dict(result, outcome=STATUS_CONVERTED, etag=converted_etag, output_bytes=converted_size)
+
+
+def encode_and_write(storage, key, source, profile, metrics, options):
+    # Single pass from the source to the destination. The numpy encoder runs when the profile and
+    # the input allow it, otherwise ffmpeg. Silence compaction decodes in process either way and
+    # pipes the compacted samples to ffmpeg when the profile needs it.
+    table = in_process_encoder_table(profile)
+    compaction = options['silence_compaction']
+    encode_time = 'EncodeTime'
+    extra_metadata = {}
+    decoded = None
+    if alaw_transcoder is not None and ((options['backend'] != 'ffmpeg' and table is not None) or compaction is not None):
+        decoded = decode_in_process(TimedReader(storage.open(key, source), metrics, 'DownloadTime'))
+    if decoded is not None:
+        wav_format, pcm_blocks = decoded
+        compactor = None
+        if compaction is not None:
+            compactor = silence_compactor.SilenceCompactor(wav_format['sample_rate'], **compaction)
+            pcm_blocks = compactor.compact(pcm_blocks)
+            extra_metadata['silence-index'] = options['silence_index_suffix']
+        if options['backend'] != 'ffmpeg' and table is not None:
+            metrics.set_dimension('Backend', 'numpy')
+            audio_chunks = metrics.timed(alaw_transcoder.encode_blocks(pcm_blocks, table), 'EncodeTime')
+        else:
+            metrics.set_dimension('Backend', 'ffmpeg')
+            encode_time = 'TranscodeTime'
+            audio_chunks = metrics.timed(stream_convert_audio_file(alaw_transcoder.PcmReader(pcm_blocks), metrics, profile,
+                pcm_input_args(wav_format)), 'TranscodeTime')
+        if compactor is not None:
+            audio_chunks = write_silence_index_when_done(audio_chunks, compactor, storage, key + options['silence_index_suffix'],
+                source, metrics)
+    else:
+        metrics.set_dimension('Backend', 'ffmpeg')
+        encode_time = 'TranscodeTime'
+        audio_chunks = metrics.timed(stream_convert_audio_file(storage.ffmpeg_input(key, source, metrics), metrics, profile),
+            'TranscodeTime')
+    converted_etag, converted_size = storage.write(key, audio_chunks, source, profile, metrics, extra_metadata)
+    if 'DownloadTime' in metrics.metrics:
+        # the in-process decoder reads the recording as it goes, keep only the encoder's own time
+        encode_seconds, unit = metrics.metrics[encode_time]
+        metrics.put_metric(encode_time, encode_seconds - metrics.metrics['DownloadTime'][0], unit)
+    return converted_etag, converted_size
+
+
+def in_process_encoder_table(profile):
+    # the numpy encoder table of a mono 8 kHz G.711 profile, None when the profile needs ffmpeg
+    if alaw_transcoder is None or profile['channels'] != 1 or profile['sample_rate'] != alaw_transcoder.TARGET_SAMPLE_RATE:
+        return None
+    return alaw_transcoder.G711_TABLES.get(profile.get('format_tag'))
+
+
+def decode_in_process(body):
+    # Returns the format and a generator of PCM frame blocks, or None when the recording needs ffmpeg
+    try:
+        wav_format = read_wav_format(body)
+    except ValueError as e:
+        logger.info(f"falling back to ffmpeg: {e}")
+        body.close()
+        return None
+    if not alaw_transcoder.can_transcode(wav_format):
+        logger.info(f"falling back to ffmpeg for {wav_format}")
+        body.close()
+        return None
+    return wav_format, close_when_done(alaw_transcoder.read_pcm_blocks(body, wav_format), body)
+
+
+def pcm_input_args(wav_format):
+    # decoded frame blocks fed to ffmpeg's stdin
+    return ['-f', 's16le', '-ar', str(wav_format['sample_rate']), '-ac', str(wav_format['channels'])]
+
+
+def close_when_done(chunks, body):
+    try:
+        yield from chunks
+    finally:
+        body.close()
+
+
+def write_silence_index_when_done(audio_chunks, compactor, storage, index_key, source, metrics=None):
+    # The index is written once the last chunk is encoded, before the write that replaces the
+    # recording completes, so a compacted recording never goes without its index
+    yield from audio_chunks
+    storage.put_sidecar(index_key, json.dumps(compactor.index()).encode(), source)
+    if metrics is not None:
+        metrics.put_metric('SilenceRemovedSeconds', compactor.removed_seconds(), 'Seconds')
+        metrics.put_metric('SilenceCuts', len(compactor.cuts))
+
+
+def stream_convert_audio_file(source_input, metrics=None, profile=None, input_args=()):
+    # Single decode/encode pass. For the WAV profiles ffmpeg writes raw samples to stdout and the
+    # RIFF header is added by the storage backend once the data length is known, streamable
+    # containers such as Ogg come out complete. Nothing touches /tmp. The input is a URL or path
+    # ffmpeg reads itself, or a reader whose bytes are fed to its stdin, described by input_args
+    # when they are raw samples.
+    feed_stdin = not isinstance(source_input, str)
+    # a profiled invocation gets the times ffmpeg measures itself, printed at the info level
+    profiling = handler_profiler.is_active()
+    log_args = ['-loglevel', 'info', '-benchmark'] if profiling else ['-loglevel', 'error']
+    cmd = [FFMPEG_PATH, '-hide_banner'] + log_args + list(input_args) + ['-i', 'pipe:0' if feed_stdin else source_input] \
+        + ffmpeg_output_args(profile) + ['-f', profile['ffmpeg_format'], 'pipe:1']
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE if feed_stdin else subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # drain stderr on a thread so a chatty ffmpeg can never block on a full pipe
+    stderr_lines = []
+    stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr))
+    stderr_reader.start()
+    feed_errors = []
+    if feed_stdin:
+        stdin_writer = threading.Thread(target=write_to_stdin, args=(source_input, process.stdin, feed_errors))
+        stdin_writer.start()
+    output_size = 0
+    try:
+        while True:
+            chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            output_size += len(chunk)
+            yield chunk
+        returncode = process.wait()
+        stderr_reader.join()
+        if feed_stdin:
+            stdin_writer.join()
+        if metrics is not None:
+            metrics.set_property('ffmpeg_exit_status', returncode)
+        if profiling:
+            handler_profiler.add_span('ffmpeg', profile['name'], started, time.perf_counter() - started, exit_status=returncode,
+                output_bytes=output_size, **handler_profiler.ffmpeg_benchmark(stderr_lines))
+        if feed_errors:
+            raise feed_errors[0]
+        if returncode != 0:
+            raise ConvertError(f"ffmpeg exited with {returncode}: {b''.join(stderr_lines).decode(errors='replace')}")
+        if output_size == 0:
+            raise ConvertError("ffmpeg produced no audio")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if feed_stdin:
+            stdin_writer.join()
+            source_input.close()
+
+
+def write_to_stdin(reader, stdin, errors):
+    try:
+        while True:
+            chunk = reader.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            stdin.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg stopped reading, its exit status tells why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
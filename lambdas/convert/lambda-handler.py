@@ -1,63 +1,349 @@
-import boto3
-import json
 import os
 import subprocess
 import logging
+import time
 from botocore.exceptions import ClientError
-from botocore.client import Config
-from urllib.parse import unquote_plus
+from urllib.parse import unquote, unquote_plus
+import shutil
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from codec_profiles import get_profile, ffmpeg_output_args
+from conversion_ledger import open_ledger, DONE_STATUSES
+from embedded_metrics import MetricsRecord
+from run_progress import open_run_progress
+from aws_clients import LazyClient
+from throttle_control import ThrottleObserver, open_throttle_controller, is_throttle_error, jittered_backoff
+from convert_pipeline import convert_recording, ConvertError
+from recording_storage import S3Storage, build_upload_args
+from handler_profiler import profiled, span
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
 
+# Configuration is read once per execution environment, not on every invocation
+CONNECT_RECORDING_S3_BUCKET = os.environ['CONNECT_RECORDING_S3_BUCKET']
+# accepted values are 'STANDARD' |'REDUCED_REDUNDANCY'|'STANDARD_IA'|'ONEZONE_IA'|'INTELLIGENT_TIERING'|'GLACIER'
+S3_STORAGE_TIER = os.environ['S3_STORAGE_TIER']
+# container, codec, sample rate, channels and bitrate of the converted recordings
+CODEC_PROFILE = get_profile()
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 4))
+# 'stream' pipes ffmpeg straight into a multipart upload, 'tmp' converts through /tmp
+CONVERT_MODE = os.environ.get('CONVERT_MODE', 'stream')
+# 'auto' transcodes in process when the input allows it, 'ffmpeg' always forks ffmpeg
+CONVERT_BACKEND = os.environ.get('CONVERT_BACKEND', 'auto')
+# recordings already in the target format are recognised from their first few kilobytes
+HEADER_PROBE = os.environ.get('HEADER_PROBE', 'true').lower() == 'true'
+# too small for the conversion to pay for itself
+MIN_CONVERT_BYTES = int(os.environ.get('MIN_CONVERT_BYTES') or 0)
+MULTIPART_PART_SIZE = int(os.environ.get('MULTIPART_PART_SIZE', 8 * 1024 * 1024))
+CONVERT_QUEUE_ARN = os.environ.get('CONVERT_QUEUE_ARN')
+CONNECT_RECORDING_CONVERT_QUEUE = os.environ.get('CONNECT_RECORDING_CONVERT_QUEUE')
+# recordings of at least this size are downloaded as parallel byte ranges, by
+# RANGED_GET_PARALLELISM requests of RANGED_GET_PART_SIZE bytes at a time
+RANGED_GET_THRESHOLD = int(os.environ.get('RANGED_GET_THRESHOLD', 64 * 1024 * 1024))
+RANGED_GET_PART_SIZE = int(os.environ.get('RANGED_GET_PART_SIZE', 8 * 1024 * 1024))
+RANGED_GET_PARALLELISM = int(os.environ.get('RANGED_GET_PARALLELISM', 4))
+# Shorten silence and hold music longer than SILENCE_MIN_SECONDS to SILENCE_KEEP_SECONDS before
+# encoding, and store the cuts in a sidecar index next to the recording. Needs numpy and the
+# stream mode, the recording is decoded in process and fed to ffmpeg for the Opus profiles.
+SILENCE_COMPACTION = os.environ.get('SILENCE_COMPACTION', 'false').lower() == 'true'
+SILENCE_THRESHOLD_DBFS = float(os.environ.get('SILENCE_THRESHOLD_DBFS', -45))
+SILENCE_MIN_SECONDS = float(os.environ.get('SILENCE_MIN_SECONDS', 2))
+SILENCE_KEEP_SECONDS = float(os.environ.get('SILENCE_KEEP_SECONDS', 0.5))
+SILENCE_DETECT_MUSIC = os.environ.get('SILENCE_DETECT_MUSIC', 'true').lower() == 'true'
+SILENCE_INDEX_SUFFIX = os.environ.get('SILENCE_INDEX_SUFFIX', '.silence.json')
+# lease every recording in the ledger before converting it, and drop the messages of versions
+# another worker is converting or has converted
+DEDUP_DISPATCH = os.environ.get('DEDUP_DISPATCH', 'true').lower() == 'true'
+# longer than the Lambda timeout, a lease left by a worker that died runs out after it
+CONVERT_LEASE_SECONDS = int(os.environ.get('CONVERT_LEASE_SECONDS', 1800))
+# dispatch keys of the versions converted by this execution environment, the messages of a
+# version enqueued twice are dropped without a request
+COMPLETED_VERSIONS_SIZE = 10000
+
+CONVERT_OPTIONS = {
+    'backend': CONVERT_BACKEND,
+    'header_probe': HEADER_PROBE,
+    'min_convert_bytes': MIN_CONVERT_BYTES,
+    'silence_compaction': {
+        'threshold_dbfs': SILENCE_THRESHOLD_DBFS,
+        'min_seconds': SILENCE_MIN_SECONDS,
+        'keep_seconds': SILENCE_KEEP_SECONDS,
+        'detect_music': SILENCE_DETECT_MUSIC,
+    } if SILENCE_COMPACTION else None,
+    'silence_index_suffix': SILENCE_INDEX_SUFFIX,
+    'lease_seconds': CONVERT_LEASE_SECONDS,
+}
+
+# adaptive retries rate limit the client itself once S3 starts throttling it, and the pool holds
+# a connection for every range of every recording converted at once
+throttle_observer = ThrottleObserver()
+s3 = LazyClient('s3', event_handlers={'response-received': throttle_observer.on_response},
+    signature_version='s3v4', retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=max(10, MAX_WORKERS * RANGED_GET_PARALLELISM))
+sqs = LazyClient('sqs')
+
+ledger = open_ledger()
+run_progress = open_run_progress()
+# deliveries after which SQS moves a message to the dead letter queue
+MAX_RECEIVE_COUNT = int(os.environ.get('MAX_RECEIVE_COUNT', 5))
+throttle_controller = open_throttle_controller(MAX_WORKERS)
+# a throttled recording comes back after a jittered delay of up to this many seconds
+THROTTLE_BACKOFF_BASE = 30
+THROTTLE_BACKOFF_CAP = 900
+# the recording is converted, by this message or an earlier one
+CONVERTED_OUTCOMES = DONE_STATUSES + ('already-converted',)
+# created on the first conversion through /tmp
+scratch_root = None
+completed_versions = OrderedDict()
+
+# error codes worth retrying when a batch job task fails
+RETRYABLE_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestTimeout', 'InternalError', 'ServiceUnavailable')
+
+
+@profiled('convert')
 def lambda_handler(event, context):
+    if 'tasks' in event:
+        try:
+            return convert_batch_operations_tasks(event, S3_STORAGE_TIER)
+        finally:
+            report_throttles(context)
+    # SQS batches are converted on a bounded worker pool so the download, transcode and upload
+    # of different recordings overlap. Only the records that failed are reported back, the rest
+    # of the batch is deleted from the queue.
+    max_workers = MAX_WORKERS
+    if throttle_controller is not None:
+        # the share of the fleet's conversions in flight this invocation may run
+        try:
+            max_workers = throttle_controller.workers()
+        except ClientError as e:
+            logger.error(f"unable to read the throttle state: {e}")
+    records = event['Records']
+    batch_item_failures = []
+    # versions finished per workflow execution, completed or failed for the last time
+    run_outcomes = {}
+    duplicates, deferred, records_to_convert = split_duplicate_records(records)
+    for record in duplicates:
+        count_run_outcome(run_outcomes, record, 'completed')
+    for record in deferred:
+        # another message of the version is converted in this batch, this one comes back after it
+        batch_item_failures.append({'itemIdentifier': record['messageId']})
+        delay_record(record, receive_count_of(record))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(records_to_convert) or 1))) as executor:
+        futures = {executor.submit(convert_record, record, CONNECT_RECORDING_S3_BUCKET, S3_STORAGE_TIER): record for record in records_to_convert}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                result = future.result()
+                if result is not None and result['outcome'] == 'in-flight':
+                    # Another message holds the lease on the version. This one is kept until the
+                    # holder is done or its lease runs out, in case the holder fails.
+                    batch_item_failures.append({'itemIdentifier': record['messageId']})
+                    delay_record(record, receive_count_of(record), result['lease_expires_at'])
+                    continue
+                if result is not None and result['outcome'] in CONVERTED_OUTCOMES:
+                    remember_completed(record)
+                outcome = 'completed'
+            except Exception as e:
+                logger.error(f"unable to convert {record['body']}: {e}")
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+                receive_count = receive_count_of(record)
+                if receive_count < MAX_RECEIVE_COUNT:
+                    if is_throttle_error(e):
+                        delay_record(record, receive_count)
+                    continue
+                outcome = 'failed'
+            count_run_outcome(run_outcomes, record, outcome)
+    logger.info(f"converted {len(records) - len(batch_item_failures)} of {len(records)} files, {len(duplicates)} duplicates dropped, {len(deferred)} deferred")
+    report_throttles(context)
+    if run_progress is not None:
+        for run_id, outcomes in run_outcomes.items():
+            try:
+                run_progress.finish_versions(run_id, outcomes)
+            except ClientError as e:
+                # the recordings are converted, the execution ends at its completion timeout
+                logger.error(f"unable to count {len(outcomes)} recordings for run {run_id}: {e}")
+    return {
+        'batchItemFailures': batch_item_failures
+    }
+
+
+def message_attribute(record, name):
+    return record.get('messageAttributes', {}).get(name, {}).get('stringValue')
+
+
+def count_run_outcome(run_outcomes, record, outcome):
+    # a version is counted once per run, whichever of its messages finishes first
+    run_id = message_attribute(record, 'run_id')
+    if run_id:
+        version = message_attribute(record, 'dispatch_key') or record['messageId']
+        run_outcomes.setdefault(run_id, {}).setdefault(version, outcome)
+
 
+def receive_count_of(record):
+    return int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+
+
+def split_duplicate_records(records):
+    # Messages for a version already converted by this execution environment, to drop, messages
+    # for a version already in the batch, to try again once it is converted, and the records left
+    # to convert. The queue Lambda sets the dispatch key.
+    if not DEDUP_DISPATCH:
+        return [], [], records
+    duplicates, deferred, records_to_convert = [], [], []
+    seen = set()
+    for record in records:
+        version = message_attribute(record, 'dispatch_key')
+        if version is not None and version in completed_versions:
+            logger.info(f"dropped duplicate message {record['messageId']} for {record['body']}")
+            duplicates.append(record)
+            continue
+        if version is not None and version in seen:
+            deferred.append(record)
+            continue
+        seen.add(version)
+        records_to_convert.append(record)
+    return duplicates, deferred, records_to_convert
+
+
+def remember_completed(record):
+    # only for versions the ledger holds as converted, a message dropped for it is not needed
+    version = message_attribute(record, 'dispatch_key')
+    if version is None:
+        return
+    completed_versions[version] = True
+    if len(completed_versions) > COMPLETED_VERSIONS_SIZE:
+        completed_versions.popitem(last=False)
+
+
+def report_throttles(context):
+    requests, throttles = throttle_observer.drain()
+    if throttle_controller is None or context is None:
+        return
     try:
-        if event['Records'][0]['body']:
-            s3_source_bucket = os.environ['CONNECT_RECORDING_S3_BUCKET']
-            s3_source_key = unquote_plus(event['Records'][0]['body'])
-            s3_source_key  = s3_source_key.strip('"')
-            # accepted values are 'STANDARD' |'REDUCED_REDUNDANCY'|'STANDARD_IA'|'ONEZONE_IA'|'INTELLIGENT_TIERING'|'GLACIER'
-            s3_storage_tier= os.environ['S3_STORAGE_TIER']
-            # Fetch existing object tags and check if already converted
-            tags = s3.get_object_tagging(Bucket=s3_source_bucket, Key=s3_source_key)["TagSet"]
-            logger.info("starting convert process")
-            logger.info(s3_source_bucket + s3_source_key)
-            input_file_path, output_file_path = create_temp_directory()
-            s3_source_signed_url = get_audio_file_presigned_url_from_s3(s3_source_bucket, s3_source_key)
-            convert_audio_file(s3_source_signed_url,input_file_path, output_file_path)
-            upload_audio_file_to_s3(output_file_path,s3_source_bucket, s3_source_key, s3_storage_tier)
-            tag_audio_file_in_s3(s3_source_bucket, s3_source_key)
-            remove_temp_directory(input_file_path, output_file_path)
-            logger.info(f"converted the file: {s3_source_bucket}/{ s3_source_key}")
-        return {
-            "convert": {
-            'file': s3_source_key,
-            }
-        }
+        throttle_controller.report(requests, throttles, context.function_name, CONVERT_QUEUE_ARN)
     except ClientError as e:
-        logger.error(e)
-        return {
-            "convert": {
-            'statusCode': 500
-            }
-        }
-    
-def create_temp_directory( ):
-    workdir = tempfile.mkdtemp()
-    input_file_path = os.path.join(workdir, 'input.wav')
-    output_file_path = os.path.join(workdir, 'outout.wav')
+        logger.error(f"unable to report {throttles} throttles: {e}")
+
+
+def delay_record(record, receive_count, not_after=None):
+    # Brings the message back after a jittered backoff instead of the whole visibility timeout,
+    # later for every delivery that was throttled or deferred again, and no later than not_after
+    delay = jittered_backoff(receive_count, THROTTLE_BACKOFF_BASE, THROTTLE_BACKOFF_CAP)
+    if not_after is not None:
+        delay = min(delay, max(not_after - time.time(), 1))
+    try:
+        sqs.change_message_visibility(QueueUrl=CONNECT_RECORDING_CONVERT_QUEUE,
+            ReceiptHandle=record['receiptHandle'],
+            VisibilityTimeout=int(delay))
+    except ClientError as e:
+        logger.error(f"unable to delay {record['messageId']}: {e}")
+
+
+def convert_batch_operations_tasks(event, s3_storage_tier):
+    # S3 Batch Operations LambdaInvoke, one manifest row per task
+    results = []
+    for task in event['tasks']:
+        s3_source_bucket = task['s3BucketArn'].split(':::')[-1]
+        s3_source_key = unquote(task['s3Key'])
+        try:
+            result = convert_audio_object(s3_source_bucket, s3_source_key, s3_storage_tier, task['taskId'])
+            result_code, result_string = 'Succeeded', s3_source_key
+            if result['outcome'] == 'in-flight':
+                # tried again by the job, the worker holding the lease may fail
+                result_code, result_string = 'TemporaryFailure', f"{s3_source_key} is being converted by another worker"
+        except ClientError as e:
+            logger.error(e)
+            retryable = e.response['Error']['Code'] in RETRYABLE_ERROR_CODES
+            result_code, result_string = 'TemporaryFailure' if retryable else 'PermanentFailure', str(e)
+        except ConvertError as e:
+            logger.error(e)
+            result_code, result_string = 'PermanentFailure', str(e)
+        results.append({'taskId': task['taskId'], 'resultCode': result_code, 'resultString': result_string})
+    return {
+        'invocationSchemaVersion': event['invocationSchemaVersion'],
+        'treatMissingKeysAs': 'PermanentFailure',
+        'invocationId': event['invocationId'],
+        'results': results
+    }
+
+
+def convert_record(record, s3_source_bucket, s3_storage_tier):
+    if not record['body']:
+        return None
+    s3_source_key = unquote_plus(record['body'])
+    s3_source_key  = s3_source_key.strip('"')
+    # redeliveries of the message keep its id, and with it the lease
+    return convert_audio_object(s3_source_bucket, s3_source_key, s3_storage_tier, record['messageId'])
+
+
+def convert_audio_object(s3_source_bucket, s3_source_key, s3_storage_tier, lease_owner=None):
+    # Returns the result of convert_recording, with one metrics record per recording and the
+    # time and bytes of every stage
+    metrics = MetricsRecord('convert', Backend='none')
+    metrics.set_property('key', s3_source_key)
+    try:
+        with metrics.timer('TotalTime'):
+            result = convert_audio_object_with_metrics(s3_source_bucket, s3_source_key, s3_storage_tier, metrics, lease_owner)
+        metrics.set_property('outcome', result['outcome'])
+    except Exception as e:
+        metrics.set_property('outcome', 'failed')
+        metrics.set_property('error', str(e))
+        metrics.put_metric('Failed', 1)
+        raise
+    finally:
+        metrics.emit()
+    return result
+
+
+def convert_audio_object_with_metrics(s3_source_bucket, s3_source_key, s3_storage_tier, metrics, lease_owner=None):
+    storage = S3Storage(s3, s3_source_bucket, s3_storage_tier, MULTIPART_PART_SIZE,
+        RANGED_GET_THRESHOLD, RANGED_GET_PART_SIZE, RANGED_GET_PARALLELISM)
+    transcode = convert_through_tmp if CONVERT_MODE == 'tmp' else None
+    return convert_recording(storage, s3_source_key, CODEC_PROFILE, metrics, ledger, CONVERT_OPTIONS, transcode,
+        lease_owner if DEDUP_DISPATCH else None)
+
+
+def convert_through_tmp(storage, s3_source_key, source, profile, metrics):
+    # ffmpeg reads the presigned URL into /tmp and the file is uploaded from there
+    metrics.set_dimension('Backend', 'ffmpeg-tmp')
+    with metrics.timer('PresignTime'):
+        s3_source_signed_url = storage.presigned_url(s3_source_key)
+    input_file_path, output_file_path = create_temp_directory(profile['extension'])
+    try:
+        with metrics.timer('TranscodeTime'):
+            exit_status = convert_audio_file(s3_source_signed_url,input_file_path, output_file_path, profile)
+        metrics.set_property('ffmpeg_exit_status', exit_status)
+        # nothing is uploaded or recorded for a failed run, the lease is released and the message retried
+        if exit_status != 0:
+            raise ConvertError(f"ffmpeg exited with {exit_status}")
+        if not os.path.exists(output_file_path) or os.path.getsize(output_file_path) == 0:
+            raise ConvertError("ffmpeg produced no audio")
+        with metrics.timer('UploadTime'):
+            upload_audio_file_to_s3(output_file_path, storage.bucket, s3_source_key, build_upload_args(source, storage.storage_tier, profile))
+        converted = s3.head_object(Bucket=storage.bucket, Key=s3_source_key)
+    finally:
+        remove_temp_directory(input_file_path, output_file_path)
+    return converted['ETag'], converted['ContentLength']
+
+
+def get_scratch_root():
+    # one scratch directory per execution environment, reused by every warm invocation
+    global scratch_root
+    if scratch_root is None or not os.path.isdir(scratch_root):
+        scratch_root = tempfile.mkdtemp(prefix='convert-')
+    return scratch_root
+
+
+def create_temp_directory(extension='wav'):
+    # a directory of its own for every recording converted at the same time, ffmpeg picks the
+    # container from the extension
+    workdir = tempfile.mkdtemp(dir=get_scratch_root())
+    input_file_path = os.path.join(workdir, f'input.{extension}')
+    output_file_path = os.path.join(workdir, f'outout.{extension}')
     return input_file_path, output_file_path
 
-def get_audio_file_presigned_url_from_s3(s3_source_bucket, s3_source_key):
-    signed_url_timeout = 60
-    s3_source_signed_url = s3.generate_presigned_url('get_object',
-        Params={'Bucket': s3_source_bucket, 'Key': s3_source_key},
-        ExpiresIn=signed_url_timeout)
-    return s3_source_signed_url
-    
 def retrieve_audio_file_from_s3(s3_source_bucket, s3_source_key,input_file_path):
     try:
         s3.Bucket(s3_source_bucket).download_file(s3_source_key, input_file_path)
@@ -70,68 +356,43 @@ def retrieve_audio_file_from_s3(s3_source_bucket, s3_source_key,input_file_path)
     
 
     
-def convert_audio_file(s3_source_signed_url,input_file_path, output_file_path):
-    cmd = ['/opt/bin/ffmpeg' ,  '-y','-i', s3_source_signed_url,'-hide_banner', '-ac','1','-ar', '8000','-c:a','pcm_alaw',input_file_path]
-    subprocess.run(cmd,shell=False)
+def convert_audio_file(s3_source_signed_url,input_file_path, output_file_path, profile):
+    # returns the exit status of the first ffmpeg run that failed, or 0
+    output_args = ffmpeg_output_args(profile)
+    cmd = ['/opt/bin/ffmpeg' ,  '-y','-i', s3_source_signed_url,'-hide_banner'] + output_args + [input_file_path]
     # Convert again to fix the header file mismatch related to using tmp storage to convert in and out.
-    cmd = ['/opt/bin/ffmpeg' , '-y', '-i', input_file_path,'-hide_banner','-ac','1','-ar', '8000','-c:a','pcm_alaw', output_file_path]
-    subprocess.run(cmd,shell=False)
+    cmd_fix_header = ['/opt/bin/ffmpeg' , '-y', '-i', input_file_path,'-hide_banner'] + output_args + [output_file_path]
+    commands = (cmd, cmd_fix_header)
+    if profile['container'] != 'wav':
+        # only WAV headers need fixing, a second lossy encode would cost quality
+        commands = (cmd[:-1] + [output_file_path],)
+    for command in commands:
+        with span('ffmpeg', profile['name']) as attributes:
+            result = subprocess.run(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            attributes['exit_status'] = result.returncode
+        if result.returncode != 0:
+            logger.error(f"ffmpeg exited with {result.returncode}: {result.stderr.decode(errors='replace')}")
+            return result.returncode
+    return 0
 
 
-def upload_audio_file_to_s3(output_file_path,s3_source_bucket, s3_source_key, s3_storage_tier):
+def upload_audio_file_to_s3(output_file_path,s3_source_bucket, s3_source_key, upload_args):
      # upload to s3
     if os.path.exists(output_file_path):
         try:
-            s3.upload_file(output_file_path,s3_source_bucket,s3_source_key)
-        except botocore.exceptions.ClientError as e:
+            s3.upload_file(output_file_path,s3_source_bucket,s3_source_key, ExtraArgs=upload_args)
+        except ClientError as e:
             if e.response['Error']['Code'] == "404":
                 logger.error("Unable to uypload the file to S3.")
             else:
                 raise    
-        # set the storage tier
-        copy_source = {
-            'Bucket': s3_source_bucket,
-            'Key': s3_source_key
-        }
-        try:
-            s3.copy(
-                copy_source, s3_source_bucket,s3_source_key,
-                ExtraArgs = {
-                'StorageClass': s3_storage_tier,
-                'MetadataDirective': 'COPY'
-                }
-            )
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                logger.error("Unable to copy the file to S3.")
-            else:
-                raise
-            
-    
-def tag_audio_file_in_s3(s3_source_bucket, s3_source_key):
-    try:
-        s3.put_object_tagging(
-            Bucket=s3_source_bucket,
-            Key=s3_source_key,    
-            Tagging={
-                'TagSet': [
-                    {
-                        'Key': 'convert-batch',
-                        'Value': 'true',
-                    }
-            
-                ]
-            }
-        )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            logger.error("Unable to copy the file to S3.")
-        else:
-            raise
+
     
 def remove_temp_directory(input_file_path, output_file_path):
     if os.path.exists(input_file_path):
         os.remove(input_file_path)
      # cleanup tmp directory          
     if os.path.exists(output_file_path):
-        os.remove(output_file_path)
\ No newline at end of file
+        os.remove(output_file_path)
+    # the per recording directory too, /tmp would otherwise fill up with them on warm environments
+    shutil.rmtree(os.path.dirname(output_file_path), ignore_errors=True)
\ No newline at end of file
@@ -0,0 +1,63 @@
+# Downloads a large recording as concurrent byte ranges and hands them to the decoder in order.
+# At most `parallelism` parts are in flight or waiting to be read, so memory stays bounded at
+# parallelism x part_size however long the recording is, and every range is pinned to the ETag
+# that was probed so an object replaced mid-read fails instead of mixing two versions.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RangedReader:
+
+    def __init__(self, s3, bucket, key, size, etag, part_size, parallelism):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        self.executor = ThreadPoolExecutor(max_workers=parallelism)
+        self.parallelism = parallelism
+        self.pending = deque()
+        self.next_offset = 0
+        self.buffer = memoryview(b'')
+        for _ in range(parallelism):
+            self.submit_next()
+
+    def submit_next(self):
+        if self.next_offset >= self.size:
+            return
+        end = min(self.next_offset + self.part_size, self.size) - 1
+        self.pending.append(self.executor.submit(self.get_range, self.next_offset, end))
+        self.next_offset = end + 1
+
+    def get_range(self, start, end):
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end}', IfMatch=self.etag)
+        body = response['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def read(self, size=-1):
+        chunks = []
+        while size < 0 or size > 0:
+            if not self.buffer:
+                if not self.pending:
+                    break
+                # the next part in order, and a new one queued in the slot it frees
+                self.buffer = memoryview(self.pending.popleft().result())
+                self.submit_next()
+            take = len(self.buffer) if size < 0 else min(size, len(self.buffer))
+            chunks.append(self.buffer[:take])
+            self.buffer = self.buffer[take:]
+            if size > 0:
+                size -= take
+        return b''.join(chunks)
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.buffer = memoryview(b'')
+        self.executor.shutdown(wait=True)
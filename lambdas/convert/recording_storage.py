@@ -0,0 +1,258 @@
+# Where convert_pipeline reads recordings from and writes them back to. S3Storage is what the
+# convert Lambda uses. LocalStorage converts a directory tree for bulk offline runs
+# (tools/convert_local.py), optionally into a second tree. Both lay the converted file out the
+# same way, header, encoder output and padding, so the bytes are identical.
+#
+# A storage has:
+#   describe(key)                     -> name for the logs
+#   stat(key)                         -> {'ContentLength', 'ETag', ...} of the recording
+#   probe(key)                        -> audio format from the first few kilobytes, or None
+#   open(key, source)                 -> reader over the whole recording
+#   ffmpeg_input(key, source, metrics) -> URL, path or reader ffmpeg converts from
+#   write(key, chunks, source, profile, metrics, extra_metadata) -> (ETag, size) of the converted file
+#   put_sidecar(key, body, source)    -> stores a small file next to the recording
+
+import logging
+import os
+import stat
+import tempfile
+from contextlib import nullcontext
+from urllib.parse import urlencode
+
+from wav_format import PROBE_SIZE
+from codec_profiles import output_metadata, header_size, build_header, build_padding, probe_audio_format, read_audio_format
+from ranged_download import RangedReader
+
+CONVERT_BATCH_KEY = 'convert-batch'
+PRESIGNED_URL_TIMEOUT = 60
+# bytes copied at a time
+LOCAL_CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger()
+
+
+def build_upload_args(source, s3_storage_tier, profile):
+    # Everything the converted object needs is set by the one write that creates it: storage
+    # class, the convert-batch tag and the original metadata. No copy onto itself to change the
+    # tier and no separate tagging call. The content type and the codec profile and extension in
+    # the metadata describe the format the recording is now in.
+    upload_args = {
+        'StorageClass': s3_storage_tier,
+        'Tagging': urlencode({CONVERT_BATCH_KEY: 'true'}),
+        'Metadata': dict(source.get('Metadata', {}), **output_metadata(profile)),
+        'ContentType': profile['content_type'],
+        'ChecksumAlgorithm': 'CRC32',
+    }
+    # BucketKeyEnabled is left to the writes that accept it, s3transfer's upload_file rejects it
+    # and the object then gets the bucket key setting of the bucket
+    if source.get('ServerSideEncryption') == 'aws:kms':
+        upload_args['ServerSideEncryption'] = 'aws:kms'
+        upload_args['SSEKMSKeyId'] = source['SSEKMSKeyId']
+    return upload_args
+
+
+class S3Storage:
+
+    def __init__(self, s3, bucket, storage_tier, part_size, ranged_get_threshold, ranged_get_part_size, ranged_get_parallelism):
+        self.s3 = s3
+        self.bucket = bucket
+        self.storage_tier = storage_tier
+        self.part_size = part_size
+        self.ranged_get_threshold = ranged_get_threshold
+        self.ranged_get_part_size = ranged_get_part_size
+        self.ranged_get_parallelism = ranged_get_parallelism
+
+    def describe(self, key):
+        return f"{self.bucket}/{key}"
+
+    def stat(self, key):
+        return self.s3.head_object(Bucket=self.bucket, Key=key)
+
+    def probe(self, key):
+        return probe_audio_format(self.s3, self.bucket, key)
+
+    def open(self, key, source):
+        # large recordings are fetched as parallel ranges of the version that was probed
+        if source['ContentLength'] >= self.ranged_get_threshold:
+            return RangedReader(self.s3, self.bucket, key, source['ContentLength'], source['ETag'],
+                self.ranged_get_part_size, self.ranged_get_parallelism)
+        return self.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def presigned_url(self, key):
+        return self.s3.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key},
+            ExpiresIn=PRESIGNED_URL_TIMEOUT)
+
+    def ffmpeg_input(self, key, source, metrics):
+        if source['ContentLength'] >= self.ranged_get_threshold:
+            # a single HTTP stream is slow for long recordings and could outlive the presigned URL
+            return self.open(key, source)
+        with metrics.timer('PresignTime'):
+            return self.presigned_url(key)
+
+    def write(self, key, audio_chunks, source, profile, metrics=None, extra_metadata=None):
+        upload_args = build_upload_args(source, self.storage_tier, profile)
+        upload_args['Metadata'].update(extra_metadata or {})
+        if source.get('ServerSideEncryption') == 'aws:kms' and source.get('BucketKeyEnabled'):
+            # PutObject and CreateMultipartUpload keep the bucket key of the original
+            upload_args['BucketKeyEnabled'] = True
+        return upload_audio_stream_to_s3(self.s3, audio_chunks, self.bucket, key, self.part_size, upload_args, metrics, profile)
+
+    def put_sidecar(self, key, body, source):
+        encryption_args = {name: source[name] for name in ('ServerSideEncryption', 'SSEKMSKeyId', 'BucketKeyEnabled')
+            if name in source and source.get('ServerSideEncryption') == 'aws:kms'}
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType='application/json', **encryption_args)
+
+
+def upload_audio_stream_to_s3(s3, audio_chunks, s3_source_bucket, s3_source_key, part_size, upload_args, metrics, profile):
+    # Part 1 starts with the RIFF header, so it is held back in memory and uploaded last, once the
+    # data size is known. Every other part is uploaded as soon as it fills up. Profiles whose
+    # encoder output is complete have no header, part 1 is still uploaded last.
+    reserved = header_size(profile)
+    first_part = bytearray()
+    buffer = bytearray()
+    data_size = 0
+    upload_id = None
+    parts = []
+    # time spent in the S3 requests of the upload, apart from producing the audio
+    upload_timer = metrics.timer if metrics is not None else lambda name: nullcontext()
+    try:
+        for chunk in audio_chunks:
+            data_size += len(chunk)
+            room = part_size - reserved - len(first_part)
+            if room > 0:
+                first_part.extend(chunk[:room])
+                chunk = chunk[room:]
+            buffer.extend(chunk)
+            while len(buffer) >= part_size:
+                with upload_timer('UploadTime'):
+                    if upload_id is None:
+                        upload_id = s3.create_multipart_upload(Bucket=s3_source_bucket, Key=s3_source_key, **upload_args)['UploadId']
+                    parts.append(upload_part_to_s3(s3, s3_source_bucket, s3_source_key, upload_id, len(parts) + 2, buffer[:part_size]))
+                del buffer[:part_size]
+        header = build_header(profile, data_size)
+        padding = build_padding(profile, data_size)
+        buffer.extend(padding)
+        if upload_id is None:
+            # small enough for a single request
+            with upload_timer('UploadTime'):
+                response = s3.put_object(Bucket=s3_source_bucket, Key=s3_source_key, Body=bytes(header + first_part + buffer), **upload_args)
+            return response['ETag'], len(header) + len(first_part) + len(buffer)
+        with upload_timer('UploadTime'):
+            if buffer:
+                parts.append(upload_part_to_s3(s3, s3_source_bucket, s3_source_key, upload_id, len(parts) + 2, buffer))
+            parts.insert(0, upload_part_to_s3(s3, s3_source_bucket, s3_source_key, upload_id, 1, header + first_part))
+            response = s3.complete_multipart_upload(Bucket=s3_source_bucket, Key=s3_source_key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        return response['ETag'], len(header) + data_size + len(padding)
+    except Exception:
+        # never leave a half written recording behind, the original stays in place
+        if upload_id is not None:
+            try:
+                s3.abort_multipart_upload(Bucket=s3_source_bucket, Key=s3_source_key, UploadId=upload_id)
+            except Exception as e:
+                # the error of the upload is the one to report. The parts stay until an
+                # AbortIncompleteMultipartUpload lifecycle rule of the bucket removes them.
+                logger.error(f"unable to abort the upload {upload_id} of {s3_source_key}: {e}")
+        raise
+
+
+def upload_part_to_s3(s3, s3_source_bucket, s3_source_key, upload_id, part_number, body):
+    response = s3.upload_part(Bucket=s3_source_bucket, Key=s3_source_key, UploadId=upload_id,
+        PartNumber=part_number, Body=bytes(body), ChecksumAlgorithm='CRC32')
+    return {'ETag': response['ETag'], 'ChecksumCRC32': response['ChecksumCRC32'], 'PartNumber': part_number}
+
+
+class LocalStorage:
+    # Keys are paths relative to root. Converted files replace the originals, or go to the same
+    # relative path under output_root. There is no object metadata on disk, the ETag stands in
+    # for a version: modification time and size, which every write changes.
+
+    def __init__(self, root, output_root=None):
+        self.root = os.path.abspath(root)
+        self.output_root = os.path.abspath(output_root or root)
+
+    def describe(self, key):
+        return self.path(key)
+
+    def path(self, key, root=None):
+        return os.path.join(root or self.root, *key.split('/'))
+
+    def output_path(self, key):
+        return self.path(key, self.output_root)
+
+    def stat(self, key):
+        return local_file_stat(self.path(key))
+
+    def probe(self, key):
+        with open(self.path(key), 'rb') as f:
+            return read_audio_format(f.read(PROBE_SIZE))
+
+    def open(self, key, source):
+        return open(self.path(key), 'rb')
+
+    def ffmpeg_input(self, key, source, metrics):
+        return self.path(key)
+
+    def write(self, key, audio_chunks, source, profile, metrics=None, extra_metadata=None):
+        # Same layout as the upload: the header is written last, over the room reserved for it,
+        # once the data size is known. The file replaces the original only when complete.
+        output_path = self.output_path(key)
+        reserved = header_size(profile)
+        data_size = 0
+        with AtomicFile(output_path, source['Mode']) as f:
+            f.write(b'\x00' * reserved)
+            for chunk in audio_chunks:
+                data_size += len(chunk)
+                f.write(chunk)
+            padding = build_padding(profile, data_size)
+            f.write(padding)
+            f.seek(0)
+            f.write(build_header(profile, data_size))
+        converted = local_file_stat(output_path)
+        return converted['ETag'], converted['ContentLength']
+
+    def put_sidecar(self, key, body, source):
+        with AtomicFile(self.output_path(key), source['Mode']) as f:
+            f.write(body)
+
+    def copy(self, key):
+        # copies a recording left as it is into the output tree
+        output_path = self.output_path(key)
+        if output_path == self.path(key):
+            return
+        with open(self.path(key), 'rb') as source_file, AtomicFile(output_path, os.fstat(source_file.fileno()).st_mode) as f:
+            while True:
+                chunk = source_file.read(LOCAL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+
+class AtomicFile:
+    # A file written next to path and renamed over it once closed without an error, with the
+    # permissions of the recording it comes from
+
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temporary_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path) + '.')
+        self.file = os.fdopen(fd, 'wb')
+        return self.file
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.chmod(self.temporary_path, stat.S_IMODE(self.mode))
+            os.replace(self.temporary_path, self.path)
+        else:
+            os.remove(self.temporary_path)
+        return False
+
+
+def local_file_stat(path):
+    file_stat = os.stat(path)
+    return {'ContentLength': file_stat.st_size, 'ETag': f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"', 'Mode': file_stat.st_mode}
@@ -0,0 +1,156 @@
+# Shortens long stretches without speech (silence, and hold music or IVR prompts that the
+# energy pattern gives away) in decoded PCM before it is encoded. Frames of 20 ms are
+# classified by their energy, vectorized with numpy, and a non-speech run longer than
+# min_seconds keeps only keep_seconds, split between its start and its end. The blocks are
+# processed as they stream through, so at most min_seconds of audio is held back. The index
+# lists every cut, so that a time in the compacted recording maps back to the original:
+#
+#   original = compacted + removed seconds of every cut at or before it
+
+import numpy as np
+
+FRAME_SECONDS = 0.02
+# frames per window of the music test
+WINDOW_FRAMES = 50
+# Low short-time energy ratio: the share of frames below half the mean energy of their window.
+# Speech keeps dipping between syllables and words, music and tones hardly do.
+MUSIC_MAX_LOW_ENERGY_RATIO = 0.05
+INDEX_VERSION = 1
+
+
+class SilenceCompactor:
+
+    def __init__(self, sample_rate, threshold_dbfs=-45.0, min_seconds=2.0, keep_seconds=0.5, detect_music=True):
+        self.sample_rate = sample_rate
+        self.frame_size = max(1, int(sample_rate * FRAME_SECONDS))
+        self.window_size = self.frame_size * WINDOW_FRAMES
+        # mean square of a full scale 16-bit sample at the threshold
+        self.threshold = (10 ** (threshold_dbfs / 20) * 32768) ** 2
+        self.min_samples = int(min_seconds * sample_rate)
+        keep_samples = int(keep_seconds * sample_rate)
+        self.keep_head = keep_samples // 2
+        self.keep_tail = keep_samples - self.keep_head
+        self.detect_music = detect_music
+        self.carry = None
+        self.pending = []
+        self.pending_size = 0
+        self.cutting = False
+        self.tail = None
+        self.dropped = 0
+        self.cut_at = 0
+        self.read = 0
+        self.emitted = 0
+        self.removed = 0
+        self.cuts = []
+
+    def compact(self, blocks):
+        # Yields the frame blocks, (frames, channels) int16 arrays, with long non-speech runs
+        # shortened
+        for frames in self.compact_blocks(blocks):
+            if len(frames):
+                yield frames
+
+    def compact_blocks(self, blocks):
+        # only whole music windows are classified, the rest waits for the next block
+        for block in blocks:
+            self.read += len(block)
+            if self.carry is not None:
+                block = np.concatenate((self.carry, block))
+            whole = len(block) // self.window_size * self.window_size
+            self.carry = block[whole:]
+            if whole:
+                yield from self.compact_frames(block[:whole], self.classify(block[:whole]))
+        if self.carry is not None and len(self.carry):
+            yield from self.compact_frames(self.carry, self.classify(self.carry))
+        yield from self.end_run()
+
+    def classify(self, frames):
+        # True for every sample of a non-speech frame. A trailing partial frame counts as speech.
+        count = len(frames) // self.frame_size
+        samples = frames[:count * self.frame_size].astype(np.float32).reshape(count, self.frame_size, frames.shape[1])
+        # mean square per frame and channel, speech on either channel keeps the frame
+        energy = np.einsum('ijk,ijk->ik', samples, samples).max(axis=1) / self.frame_size
+        non_speech = energy < self.threshold
+        if self.detect_music:
+            windows = len(energy) // WINDOW_FRAMES
+            if windows:
+                window_energy = energy[:windows * WINDOW_FRAMES].reshape(windows, WINDOW_FRAMES)
+                mean_energy = window_energy.mean(axis=1, keepdims=True)
+                low_energy_ratio = (window_energy < mean_energy / 2).mean(axis=1)
+                music = (mean_energy[:, 0] >= self.threshold) & (low_energy_ratio < MUSIC_MAX_LOW_ENERGY_RATIO)
+                non_speech[:windows * WINDOW_FRAMES] |= np.repeat(music, WINDOW_FRAMES)
+        mask = np.zeros(len(frames), dtype=bool)
+        mask[:count * self.frame_size] = np.repeat(non_speech, self.frame_size)
+        return mask
+
+    def compact_frames(self, frames, mask):
+        edges = np.flatnonzero(np.diff(mask.view(np.int8))) + 1
+        starts = np.concatenate(([0], edges))
+        ends = np.concatenate((edges, [len(frames)]))
+        for start, end in zip(starts, ends):
+            if mask[start]:
+                yield from self.add_non_speech(frames[start:end])
+            else:
+                yield from self.end_run()
+                yield self.emit(frames[start:end])
+
+    def add_non_speech(self, frames):
+        if self.cutting:
+            self.keep_last(frames)
+            return
+        self.pending.append(frames)
+        self.pending_size += len(frames)
+        if self.pending_size <= self.min_samples:
+            return
+        # long enough to cut: the head goes out now, the end of the run is kept as it goes by
+        run = np.concatenate(self.pending)
+        self.pending, self.pending_size = [], 0
+        self.cutting = True
+        self.tail = run[:0]
+        self.dropped = 0
+        yield self.emit(run[:self.keep_head])
+        self.cut_at = self.emitted
+        self.keep_last(run[self.keep_head:])
+
+    def keep_last(self, frames):
+        frames = np.concatenate((self.tail, frames))
+        keep = min(self.keep_tail, len(frames))
+        self.dropped += len(frames) - keep
+        self.tail = frames[len(frames) - keep:]
+
+    def end_run(self):
+        if self.pending:
+            yield self.emit(np.concatenate(self.pending))
+            self.pending, self.pending_size = [], 0
+        if self.cutting:
+            self.cuts.append({
+                'compacted': round(self.cut_at / self.sample_rate, 3),
+                'original': round((self.cut_at + self.removed) / self.sample_rate, 3),
+                'removed': round(self.dropped / self.sample_rate, 3),
+            })
+            self.removed += self.dropped
+            self.cutting = False
+            yield self.emit(self.tail)
+
+    def emit(self, frames):
+        self.emitted += len(frames)
+        return frames
+
+    def removed_seconds(self):
+        return self.removed / self.sample_rate
+
+    def index(self):
+        # sidecar stored next to the compacted recording
+        return {
+            'version': INDEX_VERSION,
+            'sample_rate': self.sample_rate,
+            'original_seconds': round(self.read / self.sample_rate, 3),
+            'compacted_seconds': round(self.emitted / self.sample_rate, 3),
+            'removed_seconds': round(self.removed / self.sample_rate, 3),
+            'cuts': self.cuts,
+        }
+
+
+def original_time(index, compacted_seconds):
+    # maps a time in the compacted recording to the original recording
+    return compacted_seconds + sum(cut['removed'] for cut in index['cuts'] if cut['compacted'] <= compacted_seconds)
@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import logging
+import time
+from urllib.parse import unquote_plus
+from conversion_ledger import open_ledger, is_converted, STATUS_CONVERTING
+from pending_index import open_pending_index, pending_entry, format_time, parse_time
+from embedded_metrics import MetricsRecord
+from handler_profiler import profiled
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# the configuration does not change between invocations, read it once per container
+PREFIX = os.environ.get('PREFIX', '')
+NUM_DAYS_AGE = int(os.environ.get('NUM_DAYS_AGE', 0))
+
+ledger = open_ledger()
+pending_index = open_pending_index()
+
+
+def object_created(message):
+    # the key, size, ETag and creation time of an EventBridge Object Created event, which
+    # reaches the ingest queue as the body of the message
+    event = json.loads(message['body'])
+    obj = event['detail']['object']
+    # S3 listings quote the ETag, the event does not
+    return obj['key'], obj.get('size', 0), f"\"{obj.get('etag', '')}\"", format_time(parse_time(event['time']))
+
+
+def is_own_write(record, etag, now):
+    # The convert Lambda writes the converted recording over the original while it holds the
+    # lease on the original, and records the ETag of the converted one right after
+    if record is None:
+        return False
+    if is_converted(record, etag):
+        return True
+    return record['status'] == STATUS_CONVERTING and record['etag'] != etag and (record['lease_expires_at'] or 0) >= now
+
+
+@profiled('ingest')
+def lambda_handler(event, context):
+    started = time.monotonic()
+    created = [object_created(message) for message in event['Records']]
+    # convert wav files only
+    recordings = [(key, size, etag, created_at) for key, size, etag, created_at in created
+        if key.startswith(PREFIX) and unquote_plus(key).endswith("wav")]
+    key_count_skipped_notwav = len(created) - len(recordings)
+
+    if ledger is not None:
+        # the converted recordings are announced too, they are not work
+        records = ledger.get_many(unquote_plus(key) for key, _, _, _ in recordings)
+        now = time.time()
+        recordings = [(key, size, etag, created_at) for key, size, etag, created_at in recordings
+            if not is_own_write(records.get(unquote_plus(key)), etag, now)]
+    key_count_skipped_converted = len(created) - key_count_skipped_notwav - len(recordings)
+
+    pending_index.add(pending_entry(key, size, etag, created_at, NUM_DAYS_AGE) for key, size, etag, created_at in recordings)
+
+    elapsed = time.monotonic() - started
+    logger.info(f"indexed {len(recordings)} of {len(created)} keys, skipped {key_count_skipped_converted} converted and {key_count_skipped_notwav} not wav")
+    metrics = MetricsRecord('ingest')
+    metrics.put_metric('KeysIndexed', len(recordings))
+    metrics.put_metric('KeysSkipped', len(created) - len(recordings))
+    metrics.put_metric('IngestTime', elapsed * 1000, 'Milliseconds')
+    metrics.emit()
+    return {
+        'key_count': len(recordings),
+        'key_count_skipped_converted': key_count_skipped_converted,
+        'key_count_skipped_notwav': key_count_skipped_notwav,
+        'elapsed_seconds': round(elapsed, 3)
+    }
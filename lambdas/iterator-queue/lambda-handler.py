@@ -1,21 +1,69 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import json
 import os
 import logging
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 from botocore.exceptions import ClientError
-from botocore.client import Config
 from urllib.parse import unquote_plus
+from conversion_ledger import open_ledger, is_converted, can_claim, dispatch_key, ledger_record, STATUS_ALREADY_TARGET, STATUS_QUEUED
+from codec_profiles import get_profile, probe_audio_format, is_profile_output
+from run_progress import open_run_progress
+from listing_checkpoints import open_listing_checkpoints, page_hash
+from listing_pages import load_page
+from pending_index import is_index_shard
+from embedded_metrics import MetricsRecord
+from aws_clients import LazyClient
+from handler_profiler import profiled
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
-sqs = boto3.client('sqs')
+
+# tag checks and SQS batches in flight at once, the clients pool as many connections
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 32))
+s3 = LazyClient('s3', signature_version='s3v4', max_pool_connections=MAX_WORKERS)
+sqs = LazyClient('sqs', max_pool_connections=MAX_WORKERS)
+
+# the configuration does not change between invocations, read it once per container
+CONNECT_RECORDING_CONVERT_QUEUE = os.environ.get('CONNECT_RECORDING_CONVERT_QUEUE')
+CONNECT_RECORDING_S3_BUCKET = os.environ.get('CONNECT_RECORDING_S3_BUCKET')
+# Set to True to overwrite the existing file
+# Set to False not to convert existing tagged files
+OVERWRITE_PREVIOUS_CONVERTED = os.environ.get('OVERWRITE_PREVIOUS_CONVERTED', 'false').lower() == 'true'
+# also check the tag of keys missing from the ledger, for objects converted before it existed
+LEDGER_TAG_FALLBACK = os.environ.get('LEDGER_TAG_FALLBACK', 'false').lower() == 'true'
+# probe the header of every key still to convert and drop the ones already in the target format
+HEADER_PROBE = os.environ.get('HEADER_PROBE', 'false').lower() == 'true'
+# recordings smaller than this cost more to convert than they save, see the savings planner
+MIN_CONVERT_BYTES = int(os.environ.get('MIN_CONVERT_BYTES') or 0)
+# the format the convert Lambda writes, recordings already in it are not enqueued
+CODEC_PROFILE = get_profile()
+# lease every key in the ledger before sending it, keys another execution has queued or is
+# converting are dropped
+DEDUP_DISPATCH = os.environ.get('DEDUP_DISPATCH', 'true').lower() == 'true'
+# how long a queued key is left to the execution that queued it, at least as long as its
+# message is expected to wait in the queue
+QUEUE_LEASE_SECONDS = int(os.environ.get('QUEUE_LEASE_SECONDS', 6 * 3600))
 
 CONVER_BATCH_KEY = 'convert-batch'
+# SendMessageBatch accepts at most 10 entries
+SQS_BATCH_SIZE = 10
+SQS_SEND_ATTEMPTS = 5
+
+ledger = open_ledger()
+run_progress = open_run_progress()
+checkpoints = open_listing_checkpoints()
+
+
+class ConvertRetry(Exception):
+    # raised when messages still fail after retrying, the state machine retries the whole step
+    pass
+
 
 def check_converted_tag(object_tags):
     for tag_set in object_tags:
@@ -25,50 +73,136 @@ def check_converted_tag(object_tags):
 
 
 
+@profiled('enqueue')
 def lambda_handler(event, context):
+    # the leased keys and the dispatch keys of the messages sent, the leases of the keys not sent
+    # are given up when the step fails
+    leased_objects = []
+    sent_versions = set()
     try:
-        CONNECT_RECORDING_CONVERT_QUEUE = os.environ['CONNECT_RECORDING_CONVERT_QUEUE']
-        CONNECT_RECORDING_S3_BUCKET = os.environ['CONNECT_RECORDING_S3_BUCKET']
-        # Set to True to overwrite the existing file
-        # Set to False not to convert existing tagged files
-        #Agnel : convert this to env variable
-        overwrite_previous_converted = os.environ['OVERWRITE_PREVIOUS_CONVERTED']
-        
-        key_count = 1
-        key_count_skipped_tag = 1
-        key_count_skipped_notwav = 1 
-        
-        for obj in event['iterator']['files']:
-            s3_source_key = unquote_plus(obj["Key"])
-
-                # convert wav files only
-            if s3_source_key.endswith("wav"):
-                tags = s3_get_object_tagging(CONNECT_RECORDING_S3_BUCKET, s3_source_key)
-                
-                # is not tagged converted already or we want to convert
-                if check_converted_tag(tags) is False or overwrite_previous_converted is True:
-                    s3_key_prefix,s3_key_object = os.path.split(s3_source_key)
-                    convert_key = json.dumps(obj["Key"])
-                    # Send message to SQS queue
-                    sqs_send_message(CONNECT_RECORDING_CONVERT_QUEUE, convert_key)
-                    key_count +=  1
-                else:
-                    key_count_skipped_tag += 1
-            else:
+        started = time.monotonic()
+        key_count_skipped_notwav = 0
+        key_count_skipped_small = 0
+        key_count_skipped_inflight = 0
+        run_id = event['iterator'].get('run_id')
+        profile = bool(event['iterator'].get('profile'))
+        # a retried step of the same execution sends the keys it queued again
+        lease_owner = run_id or str(uuid.uuid4())
+
+        # the page of the iterator, inline or in the work bucket
+        files = load_page(event['iterator']['files'], s3)
+
+        # convert wav files only
+        wav_objects = []
+        for obj in files:
+            if not unquote_plus(obj["Key"]).endswith("wav"):
                 key_count_skipped_notwav += 1
-                
-        logger.info(f"key_count is {key_count}")    
-        logger.info(f"key_count_skipped_tag is {key_count_skipped_tag}")  
-        logger.info(f"key_count_skipped_notwav is {key_count_skipped_notwav}")  
-        
-    except ClientError as e:
-        logging.error(e)
+            elif obj["Size"] < MIN_CONVERT_BYTES:
+                key_count_skipped_small += 1
+            else:
+                wav_objects.append(obj)
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            if OVERWRITE_PREVIOUS_CONVERTED:
+                convert_objects = wav_objects
+            else:
+                # is not converted already, by the ledger when there is one or else by the tag
+                convert_objects = wav_objects
+                if ledger is not None:
+                    records = ledger.get_many(unquote_plus(obj["Key"]) for obj in wav_objects)
+                    convert_objects = [obj for obj in wav_objects if not is_converted(records.get(unquote_plus(obj["Key"])), obj["ETag"])]
+                    if DEDUP_DISPATCH:
+                        # queued or being converted by another execution, nothing to write for these
+                        claimable = [obj for obj in convert_objects
+                            if can_claim(records.get(unquote_plus(obj["Key"])), obj["ETag"], STATUS_QUEUED, lease_owner)]
+                        key_count_skipped_inflight += len(convert_objects) - len(claimable)
+                        convert_objects = claimable
+                # recordings read from the pending index were created since the ledger, they have no tag
+                if ledger is None or (LEDGER_TAG_FALLBACK and not is_index_shard(event['iterator'].get('shard'))):
+                    source_keys = [unquote_plus(obj["Key"]) for obj in convert_objects]
+                    converted = executor.map(lambda key: check_converted_tag(s3_get_object_tagging(CONNECT_RECORDING_S3_BUCKET, key)), source_keys)
+                    convert_objects = [obj for obj, tagged in zip(convert_objects, converted) if not tagged]
+                if HEADER_PROBE:
+                    source_keys = [unquote_plus(obj["Key"]) for obj in convert_objects]
+                    targets = list(executor.map(lambda key: is_profile_output(probe_audio_format(s3, CONNECT_RECORDING_S3_BUCKET, key), CODEC_PROFILE), source_keys))
+                    for obj, source_key, target in zip(convert_objects, source_keys, targets):
+                        if target and ledger is not None:
+                            ledger.put(ledger_record(source_key, obj["ETag"], STATUS_ALREADY_TARGET, obj["Size"], obj["Size"]))
+                    convert_objects = [obj for obj, target in zip(convert_objects, targets) if not target]
+                if ledger is not None and DEDUP_DISPATCH:
+                    # the lease is only taken by one execution, the others drop the key here
+                    claimed = list(executor.map(lambda obj: ledger.claim(unquote_plus(obj["Key"]), obj["ETag"], STATUS_QUEUED, lease_owner,
+                        QUEUE_LEASE_SECONDS, obj["Size"]), convert_objects))
+                    key_count_skipped_inflight += claimed.count(False)
+                    convert_objects = [obj for obj, leased in zip(convert_objects, claimed) if leased]
+                    leased_objects = convert_objects
+
+            # Send messages to SQS queue, 10 per request
+            # the dispatch key of the version lets the convert Lambda drop duplicates before any request
+            convert_keys = [(json.dumps(obj["Key"]), dispatch_key(unquote_plus(obj["Key"]), obj["ETag"])) for obj in convert_objects]
+            if run_progress is not None and run_id:
+                # counted before they are sent, a retried step sends them again without counting them
+                run_progress.add_expected_versions(run_id, page_hash(files), [version for _, version in convert_keys])
+            batches = [convert_keys[i:i + SQS_BATCH_SIZE] for i in range(0, len(convert_keys), SQS_BATCH_SIZE)]
+            def send(batch):
+                sqs_send_message_batch(CONNECT_RECORDING_CONVERT_QUEUE, batch, run_id, profile)
+                sent_versions.update(version for _, version in batch)
+            list(executor.map(send, batches))
+
+        elapsed = time.monotonic() - started
+        key_count = len(convert_objects)
+        key_count_skipped_tag = len(wav_objects) - key_count - key_count_skipped_inflight
+        logger.info(f"key_count is {key_count}")
+        logger.info(f"key_count_skipped_tag is {key_count_skipped_tag}")
+        logger.info(f"key_count_skipped_inflight is {key_count_skipped_inflight}")
+        logger.info(f"key_count_skipped_notwav is {key_count_skipped_notwav}")
+        logger.info(f"key_count_skipped_small is {key_count_skipped_small}")
+        logger.info(f"checked {len(wav_objects)} keys in {elapsed:.2f}s, {len(wav_objects) / max(elapsed, 0.001):.0f} keys/s")
+        metrics = MetricsRecord('enqueue')
+        metrics.put_metric('KeysListed', len(files))
+        metrics.put_metric('KeysEnqueued', key_count)
+        metrics.put_metric('KeysSkipped', len(files) - key_count)
+        metrics.put_rate('KeysCheckedPerSecond', len(wav_objects), elapsed)
+        metrics.put_rate('KeysEnqueuedPerSecond', key_count, elapsed)
+        metrics.put_metric('EnqueueTime', elapsed * 1000, 'Milliseconds')
+        metrics.emit()
+        if run_progress is not None and run_id:
+            run_progress.add_day_counters(run_id, event['iterator']['day'],
+                keys_listed=len(files), keys_enqueued=key_count, keys_skipped=key_count_skipped_tag + key_count_skipped_inflight + key_count_skipped_notwav + key_count_skipped_small)
+        if checkpoints is not None and run_id:
+            # every key of the page is enqueued or skipped, a later execution resumes after it
+            checkpoints.advance(run_id, event['iterator']['day'], event['iterator']['shard'], files[-1]['Key'], page_hash(files),
+                event['iterator']['NextContinuationToken'], len(files), key_count)
         return {
-            "convert": {
-            'statusCode': 500
-            }
+            'key_count': key_count,
+            'key_count_skipped_tag': key_count_skipped_tag,
+            'key_count_skipped_notwav': key_count_skipped_notwav,
+            'key_count_skipped_small': key_count_skipped_small,
+            'key_count_skipped_inflight': key_count_skipped_inflight,
+            'elapsed_seconds': round(elapsed, 3)
         }
-        
+
+    except ClientError as e:
+        logger.error(e)
+        release_unsent(leased_objects, sent_versions, lease_owner)
+        # the state machine retries the step, the page is enqueued again
+        raise ConvertRetry(f"page not enqueued: {e}") from e
+    except ConvertRetry:
+        release_unsent(leased_objects, sent_versions, lease_owner)
+        raise
+
+
+def release_unsent(leased_objects, sent_versions, lease_owner):
+    # A failed step leaves its page to a retry of the step, or to a later execution that resumes
+    # from the checkpoint. Neither has to wait for the leases of the keys that were not sent.
+    for obj in leased_objects:
+        key = unquote_plus(obj["Key"])
+        if dispatch_key(key, obj["ETag"]) not in sent_versions:
+            try:
+                ledger.release(key, obj["ETag"], lease_owner)
+            except ClientError as e:
+                logger.error(f"unable to release {key}: {e}")
+
 def s3_get_object_tagging(CONNECT_RECORDING_S3_BUCKET, s3_source_key):
     try:
         tags = s3.get_object_tagging(Bucket=CONNECT_RECORDING_S3_BUCKET, Key=s3_source_key)["TagSet"]
@@ -76,18 +210,42 @@ def s3_get_object_tagging(CONNECT_RECORDING_S3_BUCKET, s3_source_key):
         logger.error("Unavle to tag S3 object")
         logger.error(e)
         raise
-    return tags        
-         
-    
-def sqs_send_message(CONNECT_RECORDING_CONVERT_QUEUE,convert_key):
-    try:
-        sqs.send_message(
-            QueueUrl=CONNECT_RECORDING_CONVERT_QUEUE,
-            MessageBody=(
-                convert_key
+    return tags
+
+
+def sqs_send_message_batch(CONNECT_RECORDING_CONVERT_QUEUE, convert_keys, run_id=None, profile=False):
+    # convert_keys are (message body, dispatch key) pairs. Entries that fail inside an otherwise successful batch are retried on their own with
+    # jittered backoff, the ones that went through are not sent again.
+    entries = [{'Id': str(i), 'MessageBody': convert_key,
+        'MessageAttributes': {'dispatch_key': {'DataType': 'String', 'StringValue': version}}}
+        for i, (convert_key, version) in enumerate(convert_keys)]
+    if run_id:
+        # tells the convert Lambda which execution to report the recording to
+        for entry in entries:
+            entry['MessageAttributes']['run_id'] = {'DataType': 'String', 'StringValue': run_id}
+    if profile:
+        # the convert Lambda profiles the invocations that get these messages
+        for entry in entries:
+            entry['MessageAttributes']['profile'] = {'DataType': 'String', 'StringValue': 'true'}
+    for attempt in range(SQS_SEND_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=CONNECT_RECORDING_CONVERT_QUEUE,
+                Entries=entries
             )
-        )
-    except ClientError as e:
-        logger.error("Unavle to sent Message through SQS")
-        logger.error(e)
-        raise
\ No newline at end of file
+        except ClientError as e:
+            logger.error("Unavle to sent Message through SQS")
+            logger.error(e)
+            raise
+        failed = response.get('Failed', [])
+        if not failed:
+            return
+        for failure in failed:
+            logger.warning(f"SQS entry failed: {failure}")
+        failed_ids = {failure['Id'] for failure in failed if not failure.get('SenderFault')}
+        if len(failed_ids) < len(failed):
+            raise ConvertRetry(f"SQS rejected messages: {failed}")
+        entries = [entry for entry in entries if entry['Id'] in failed_ids]
+    raise ConvertRetry(f"{len(entries)} messages not sent after {SQS_SEND_ATTEMPTS} attempts")
@@ -2,15 +2,64 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
-import boto3
 import os
 import logging
+import time
+import uuid
 from datetime import date, datetime, timedelta
 from botocore.exceptions import ClientError
+from batch_manifest import S3ManifestWriter, MANIFEST_FORMAT, MANIFEST_FIELDS
+from conversion_ledger import open_ledger, is_converted
+from listing_shards import plan_shards, clip_to_shard, shard, DEFAULT_SHARD_BOUNDARIES
+from run_progress import open_run_progress
+from listing_checkpoints import open_listing_checkpoints, page_hash, chain_hash, STATUS_LISTED
+from listing_pages import store_page
+from pending_index import open_pending_index, due_window, index_shards, is_index_shard, SOURCE_INDEX, SOURCE_LISTING
+from savings_planner import new_group, add_object, merge_groups, build_report, DEFAULT_PRICES
+from codec_profiles import get_profile, probe_audio_format
+from embedded_metrics import MetricsRecord
+from aws_clients import LazyClient
+from handler_profiler import profiled
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3 = boto3.client('s3')
+# the clients are only built by the actions that use them
+s3 = LazyClient('s3')
+s3control = LazyClient('s3control')
+
+ledger = open_ledger()
+run_progress = open_run_progress()
+checkpoints = open_listing_checkpoints()
+pending_index = open_pending_index()
+
+# the configuration does not change between invocations, read it once per container
+CONNECT_RECORDING_S3_BUCKET = os.environ.get('CONNECT_RECORDING_S3_BUCKET')
+# keys handed to the queue Lambda per page, a page larger than one LIST call is filled by several
+MAX_KEYS = int(os.environ.get('MAX_KEYS', 1000))
+PREFIX = os.environ.get('PREFIX', '')
+NUM_DAYS_AGE = int(os.environ.get('NUM_DAYS_AGE', 0))
+SHARD_BOUNDARIES = os.environ.get('SHARD_BOUNDARIES') or DEFAULT_SHARD_BOUNDARIES
+# 'sqs' hands each page to the queue Lambda, 'manifest' writes S3 Batch Operations manifests
+DISPATCH_MODE = os.environ.get('DISPATCH_MODE', 'sqs')
+WORK_BUCKET = os.environ.get('WORK_BUCKET')
+# where pages too large to pass inline through the state machine are written in the work bucket
+PAGE_PREFIX = os.environ.get('PAGE_PREFIX', 'pages/')
+# hours of creation times an execution reads from the pending index, the interval of the
+# schedule, and how much further back it reads in case the previous one started late
+PENDING_WINDOW_HOURS = int(os.environ.get('PENDING_WINDOW_HOURS', 24))
+PENDING_WINDOW_OVERLAP_HOURS = int(os.environ.get('PENDING_WINDOW_OVERLAP_HOURS', 1))
+
+# ListObjectsV2 returns at most this many keys per call
+S3_MAX_KEYS = 1000
+
+# stop listing in manifest mode when less than this much of the invocation is left
+MANIFEST_TIME_RESERVE_MS = 60 * 1000
+# recordings smaller than this are left as they are, see the savings planner
+MIN_CONVERT_BYTES = int(os.environ.get('MIN_CONVERT_BYTES') or 0)
+# recordings probed per prefix in plan mode, the rest of the prefix is assumed to share their format
+PLANNER_PROBES_PER_PREFIX = int(os.environ.get('PLANNER_PROBES_PER_PREFIX', 1))
+# the format the convert Lambda writes, the converted sizes are estimated from its bitrate
+CODEC_PROFILE = get_profile()
     
 
 def recording_file_date_time_prefix_builder(input_date):
@@ -28,14 +77,61 @@ def recording_file_date_time_prefix_builder(input_date):
         return dt_year, dt_month, dt_day;
 
 
+def plan_days(request, NUM_DAYS_AGE, index_available=False):
+    # Expands the execution input into the days to convert: a list of 'dates', a
+    # 'start_date'/'end_date' range (inclusive), a 'specific_date', or else the day
+    # NUM_DAYS_AGE days ago. Dates use the %m/%d/%Y format of specific_date. 'restart'
+    # lists the days from their start instead of resuming from their listing checkpoints.
+    # 'profile' profiles every invocation of the execution, see handler_profiler.
+    # "source": "index" reads the recordings due from the pending index instead of listing
+    # the day, when there is no date in the input and the index is deployed.
+    source = SOURCE_LISTING
+    if request.get("dates"):
+        dates = [datetime.strptime(specific_date, "%m/%d/%Y") for specific_date in request["dates"]]
+    elif request.get("start_date"):
+        start_date = datetime.strptime(request["start_date"], "%m/%d/%Y")
+        end_date = datetime.strptime(request.get("end_date") or request["start_date"], "%m/%d/%Y")
+        if end_date < start_date:
+            raise ValueError(f"end_date {request['end_date']} is before start_date {request['start_date']}")
+        dates = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    elif request.get("specific_date"):
+        dates = [datetime.strptime(request["specific_date"], "%m/%d/%Y")]
+    else:
+        dates = [datetime.now() - timedelta(days=NUM_DAYS_AGE)]
+        if request.get("source") == SOURCE_INDEX:
+            if index_available:
+                source = SOURCE_INDEX
+            else:
+                logger.warning("the pending index is not deployed, the day is listed")
+    return [
+        {'date': day.strftime("%m/%d/%Y"), 'day': day.strftime("%Y-%m-%d"), 'restart': bool(request.get("restart")), 'source': source,
+            'profile': bool(request.get("profile"))}
+        for day in sorted(set(day.date() for day in dates))
+    ]
+
+
+@profiled('list')
 def lambda_handler(event, context):
     
     try:
-        
-        CONNECT_RECORDING_S3_BUCKET = os.environ['CONNECT_RECORDING_S3_BUCKET']
-        MAX_KEYS = int(os.environ['MAX_KEYS'])
-        PREFIX = os.environ['PREFIX']
-        NUM_DAYS_AGE = int(os.environ['NUM_DAYS_AGE'])
+
+        if event.get("action") == "days":
+            # the index only hands pages to the queue Lambda, manifest mode lists
+            days = plan_days(event["request"], NUM_DAYS_AGE, pending_index is not None and DISPATCH_MODE == 'sqs')
+            logger.info(f"{len(days)} days to convert")
+            return {
+                'days': days
+            }
+
+        if event.get("action") == "await_completion":
+            # every recording is enqueued, the execution resumes once they are all converted
+            run_progress.await_completion(event["run_id"], event["task_token"])
+            return {
+                'run_id': event["run_id"]
+            }
+
+        if event.get("action") == "savings_report":
+            return write_savings_report(event["run_id"])
         
         if event["specific_date"]:
             specific_date = event.get('specific_date', None)
@@ -51,52 +147,291 @@ def lambda_handler(event, context):
         FULL_PREFIX = f'{str(PREFIX)}{str(dt_year)}/{str(dt_month)}/{str(dt_day)}/'
         
         logger.info(str(CONNECT_RECORDING_S3_BUCKET + FULL_PREFIX) + " is the new prefix")
+
+        if event.get("action") == "shards" and event.get("source") == SOURCE_INDEX:
+            window_start, window_end = due_window(NUM_DAYS_AGE, PENDING_WINDOW_HOURS, PENDING_WINDOW_OVERLAP_HOURS)
+            shards = index_shards(window_start, window_end)
+            logger.info(f"recordings created from {window_start} to {window_end} read from {len(shards)} pending index shards")
+            return {
+                'shards': shards
+            }
+
+        if event.get("action") == "shards":
+            shards = plan_shards(s3, CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX,
+                SHARD_BOUNDARIES)
+            logger.info(f"{FULL_PREFIX} split into {len(shards)} shards")
+            return {
+                'shards': shards
+            }
+
+        if event.get("action") == "plan_day":
+            response = plan_day_savings(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, MAX_KEYS, event["NextContinuationToken"], event["run_id"], event["day"], context)
+            response.update(action="plan_day", specific_date=event["specific_date"], day=event["day"], run_id=event["run_id"],
+                profile=bool(event.get("profile")))
+            return response
+
+        # without a shard the whole day prefix is listed
+        listing_shard = event.get("shard") or shard(FULL_PREFIX)
+        metrics = MetricsRecord('list')
+        metrics.set_property('prefix', listing_shard['prefix'])
+        started = time.monotonic()
+        # the first page of a shard resumes after the last key an earlier execution enqueued
+        start_after = ''
+        if not event["NextContinuationToken"]:
+            start_after = resume_point(event, listing_shard)
+            if start_after:
+                metrics.set_property('resumed_after', start_after)
+
+        if DISPATCH_MODE == 'manifest':
+            manifest_prefix = f"{os.environ['MANIFEST_PREFIX']}{dt_year}/{dt_month}/{dt_day}/"
+            response = write_batch_manifests(CONNECT_RECORDING_S3_BUCKET, listing_shard, MAX_KEYS, event["NextContinuationToken"], manifest_prefix, context, metrics, start_after)
+            emit_listing_metrics(metrics, started)
+            last_key, pages_hash, pages = response.pop('last_key'), response.pop('pages_hash'), response.pop('pages')
+            if checkpoints is not None and event.get("run_id"):
+                # the manifests are written and their jobs created
+                checkpoints.advance(event["run_id"], event["day"], listing_shard, last_key, pages_hash, response['NextContinuationToken'],
+                    metrics.metrics['KeysListed'][0], metrics.metrics['KeysEnqueued'][0], pages)
+            if run_progress is not None and event.get("run_id"):
+                run_progress.add_day_counters(event["run_id"], event["day"], keys_enqueued=sum(manifest['rows'] for manifest in response['manifests']))
+            response.update(shard=listing_shard, specific_date=event["specific_date"], day=event.get("day"), run_id=event.get("run_id"),
+                profile=bool(event.get("profile")))
+            return response
         
         if event["NextContinuationToken"]:
             logger.info("Passed in the continuation token from step function. Will use it.")
-            continuation_token = event["NextContinuationToken"]
-            response = list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, MAX_KEYS,continuation_token)
         else:
             logger.info("No continuation token passed from step function.")
-            response = list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, MAX_KEYS)
-        
-        if response["KeyCount"]>0:
-            contents = json.loads(json.dumps(response["Contents"], default=str))
-            try:
-                continuation_token = response["NextContinuationToken"]
-                
-            except KeyError:
-                continuation_token =""
-                logger.info("No keys returned error.")
+        if is_index_shard(listing_shard):
+            # the recordings created in the window, nothing is listed
+            objects, continuation_token = pending_index.list_page(listing_shard, MAX_KEYS, event["NextContinuationToken"] or start_after)
+        else:
+            objects, continuation_token = list_page(CONNECT_RECORDING_S3_BUCKET, listing_shard, MAX_KEYS, event["NextContinuationToken"], start_after)
+        metrics.put_metric('KeysListed', len(objects))
+        emit_listing_metrics(metrics, started)
+        if objects:
+            # only the key, size and ETag of every object, in the compact form of listing_pages
+            page_key = f"{PAGE_PREFIX}{event.get('run_id') or 'manual'}/{event.get('day') or FULL_PREFIX.rstrip('/')}/{uuid.uuid4()}.json"
+            contents = store_page(objects, s3, WORK_BUCKET, page_key)
+            if not continuation_token:
+                logger.info("End of the shard reached.")
             
         else:
             logger.info("No object keys returned.")
             contents = ""
-            continuation_token =""
+            if checkpoints is not None and event.get("run_id"):
+                # the queue Lambda is not called for an empty page, the shard ends here
+                checkpoints.advance(event["run_id"], event["day"], listing_shard, '', page_hash([]), '', 0, 0)
             
     
         return {
             'files': contents,
-            'NextContinuationToken': continuation_token
+            'NextContinuationToken': continuation_token,
+            'shard': listing_shard,
+            'specific_date': event["specific_date"],
+            'day': event.get("day"),
+            'run_id': event.get("run_id"),
+            # the queue Lambda and the convert Lambda are profiled with the iterator
+            'profile': bool(event.get("profile"))
         }
         
     except ClientError as e:
-        logging.error(e)
-        return {
-            "convert": {
-            'statusCode': 500
-            }
-        }
+        # fails the task with the S3 error, the state machine retries it
+        logger.error(e)
+        raise
         
-def list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, MAX_KEYS,continuation_token='' ):
+def resume_point(event, listing_shard):
+    # Claims the checkpoint of the shard and returns the key to list after, '' for the start
+    if checkpoints is None or not event.get("run_id"):
+        return ''
+    checkpoint = checkpoints.start(event["run_id"], event["day"], listing_shard, event.get("restart", False))
+    if checkpoint is None:
+        return ''
+    if is_index_shard(listing_shard):
+        # index entries are continued after a sort key, the end of the window once it is read
+        if checkpoint['status'] == STATUS_LISTED:
+            return listing_shard['end_before']
+        return checkpoint['continuation_token']
+    return checkpoint['last_key']
+
+
+def emit_listing_metrics(metrics, started):
+    elapsed = time.monotonic() - started
+    metrics.put_metric('ListTime', elapsed * 1000, 'Milliseconds')
+    metrics.put_rate('KeysListedPerSecond', metrics.metrics['KeysListed'][0], elapsed)
+    metrics.emit()
+
+
+def list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, MAX_KEYS,continuation_token='', start_after='', delimiter=''):
+    # start_after and delimiter narrow the listing to one shard of the prefix
+    shard_args = {}
+    if delimiter:
+        shard_args['Delimiter'] = delimiter
     try:
         if continuation_token:
-            response =s3.list_objects_v2(Bucket=CONNECT_RECORDING_S3_BUCKET,Prefix=FULL_PREFIX,MaxKeys=MAX_KEYS,ContinuationToken=continuation_token)
+            response =s3.list_objects_v2(Bucket=CONNECT_RECORDING_S3_BUCKET,Prefix=FULL_PREFIX,MaxKeys=MAX_KEYS,ContinuationToken=continuation_token, **shard_args)
         else:
-            response = s3.list_objects_v2(Bucket=CONNECT_RECORDING_S3_BUCKET,Prefix=FULL_PREFIX,MaxKeys=MAX_KEYS)
+            if start_after:
+                shard_args['StartAfter'] = start_after
+            response = s3.list_objects_v2(Bucket=CONNECT_RECORDING_S3_BUCKET,Prefix=FULL_PREFIX,MaxKeys=MAX_KEYS, **shard_args)
             logger.info(response)
     except ClientError as e:
         logger.error("Unable to list the bucket")
         logger.error(e)
         raise
-    return response
\ No newline at end of file
+    return response
+
+
+def list_shard_in_s3(CONNECT_RECORDING_S3_BUCKET, listing_shard, MAX_KEYS, continuation_token='', start_after=''):
+    # start_after resumes the shard after the last key of a checkpoint
+    if continuation_token:
+        return list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, listing_shard['prefix'], MAX_KEYS, continuation_token,
+            delimiter=listing_shard['delimiter'])
+    return list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, listing_shard['prefix'], MAX_KEYS,
+        start_after=start_after or listing_shard['start_after'], delimiter=listing_shard['delimiter'])
+
+
+def list_page(CONNECT_RECORDING_S3_BUCKET, listing_shard, MAX_KEYS, continuation_token='', start_after=''):
+    # Lists up to MAX_KEYS keys of the shard, with as many LIST calls as it takes. Returns the
+    # objects and the token to continue from, '' once the end of the shard is reached.
+    objects = []
+    while True:
+        response = list_shard_in_s3(CONNECT_RECORDING_S3_BUCKET, listing_shard, min(MAX_KEYS - len(objects), S3_MAX_KEYS),
+            continuation_token, start_after)
+        listed, exhausted = clip_to_shard(response, listing_shard['end_before'])
+        objects.extend(listed)
+        continuation_token = "" if exhausted else response["NextContinuationToken"]
+        if not continuation_token or len(objects) >= MAX_KEYS:
+            return objects, continuation_token
+
+
+def write_batch_manifests(CONNECT_RECORDING_S3_BUCKET, listing_shard, MAX_KEYS, continuation_token, manifest_prefix, context, metrics, start_after=''):
+    # Lists as many pages as the invocation allows and streams the wav keys that still need
+    # converting into manifests. Every full manifest is submitted as an S3 Batch Operations job
+    # that invokes the convert Lambda once per row.
+    writer = S3ManifestWriter(s3, WORK_BUCKET, manifest_prefix,
+        int(os.environ['MANIFEST_CHUNK_SIZE']), on_chunk=create_batch_job)
+    key_count = 0
+    # the last key and the hashes of the pages listed, for the listing checkpoint
+    last_key = ''
+    pages_hash = ''
+    pages = 0
+    while True:
+        response = list_shard_in_s3(CONNECT_RECORDING_S3_BUCKET, listing_shard, min(MAX_KEYS, S3_MAX_KEYS), continuation_token, start_after)
+        objects, exhausted = clip_to_shard(response, listing_shard['end_before'])
+        metrics.add_metric('KeysListed', len(objects))
+        if objects:
+            last_key = objects[-1]["Key"]
+        pages_hash = chain_hash(pages_hash, page_hash(objects))
+        pages += 1
+        objects = [obj for obj in objects if obj["Key"].endswith("wav") and obj["Size"] >= MIN_CONVERT_BYTES]
+        if ledger is not None:
+            records = ledger.get_many(obj["Key"] for obj in objects)
+            objects = [obj for obj in objects if not is_converted(records.get(obj["Key"]), obj["ETag"])]
+        for obj in objects:
+            writer.add(CONNECT_RECORDING_S3_BUCKET, obj["Key"])
+        key_count += len(objects)
+        continuation_token = "" if exhausted else response["NextContinuationToken"]
+        if not continuation_token or context.get_remaining_time_in_millis() < MANIFEST_TIME_RESERVE_MS:
+            break
+    manifests = writer.close()
+    metrics.put_metric('KeysEnqueued', key_count)
+    metrics.put_metric('ManifestsWritten', len(manifests))
+    logger.info(f"wrote {key_count} keys to {len(manifests)} manifests")
+    return {
+        'files': '',
+        'NextContinuationToken': continuation_token,
+        'manifests': manifests,
+        'last_key': last_key,
+        'pages_hash': pages_hash,
+        'pages': pages
+    }
+
+
+def create_batch_job(manifest):
+    try:
+        response = s3control.create_job(
+            AccountId=os.environ['ACCOUNT_ID'],
+            ConfirmationRequired=False,
+            Operation={'LambdaInvoke': {'FunctionArn': os.environ['CONVERT_FUNCTION_ARN']}},
+            Report={
+                'Bucket': f"arn:aws:s3:::{manifest['bucket']}",
+                'Format': 'Report_CSV_20180820',
+                'Enabled': True,
+                'Prefix': os.environ['BATCH_REPORT_PREFIX'],
+                'ReportScope': 'FailedTasksOnly'
+            },
+            ClientRequestToken=str(uuid.uuid4()),
+            Manifest={
+                'Spec': {'Format': MANIFEST_FORMAT, 'Fields': MANIFEST_FIELDS},
+                'Location': {'ObjectArn': f"arn:aws:s3:::{manifest['bucket']}/{manifest['key']}", 'ETag': manifest['etag']}
+            },
+            Priority=10,
+            RoleArn=os.environ['BATCH_OPERATIONS_ROLE_ARN'],
+            Description=f"convert call recordings from {manifest['key']}"
+        )
+    except ClientError as e:
+        logger.error("Unable to create the batch job")
+        logger.error(e)
+        raise
+    manifest['job_id'] = response['JobId']
+    logger.info(f"batch job {response['JobId']} created for {manifest['rows']} keys")
+
+
+def plan_day_savings(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, MAX_KEYS, continuation_token, run_id, day, context):
+    # Dry run: lists as many pages of the day as the invocation allows and aggregates the
+    # estimated savings by key prefix into a part of the run's savings report. Nothing is
+    # converted or enqueued.
+    groups = {}
+    formats = {}
+    probes = {}
+    while True:
+        response = list_audio_files_in_s3(CONNECT_RECORDING_S3_BUCKET, FULL_PREFIX, min(MAX_KEYS, S3_MAX_KEYS), continuation_token)
+        for obj in response.get("Contents", []):
+            if not obj["Key"].endswith("wav"):
+                continue
+            prefix = obj["Key"].rpartition("/")[0] + "/"
+            if probes.get(prefix, 0) < PLANNER_PROBES_PER_PREFIX:
+                probes[prefix] = probes.get(prefix, 0) + 1
+                formats[prefix] = probe_audio_format(s3, CONNECT_RECORDING_S3_BUCKET, obj["Key"]) or formats.get(prefix)
+            group = groups.setdefault(prefix, new_group(day, prefix))
+            add_object(group, obj["Size"], formats[prefix], CODEC_PROFILE)
+        continuation_token = response.get("NextContinuationToken", "")
+        if not continuation_token or context.get_remaining_time_in_millis() < MANIFEST_TIME_RESERVE_MS:
+            break
+    part_key = f"{os.environ['REPORT_PREFIX']}{run_id}/parts/{day}/{uuid.uuid4()}.json"
+    put_json_to_s3(WORK_BUCKET, part_key, list(groups.values()))
+    logger.info(f"planned {sum(group['objects'] for group in groups.values())} keys of {FULL_PREFIX} into {part_key}")
+    return {
+        'files': '',
+        'NextContinuationToken': continuation_token
+    }
+
+
+def write_savings_report(run_id):
+    # Merges the parts written by plan_day_savings into the report of the run
+    run_prefix = f"{os.environ['REPORT_PREFIX']}{run_id}/"
+    parts = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=WORK_BUCKET, Prefix=f"{run_prefix}parts/"):
+        for obj in page.get("Contents", []):
+            parts.append(json.loads(s3.get_object(Bucket=WORK_BUCKET, Key=obj["Key"])["Body"].read()))
+    prices = dict(DEFAULT_PRICES, **json.loads(os.environ.get('PLANNER_PRICES') or '{}'))
+    report = build_report(merge_groups(parts), int(os.environ.get('PLANNER_HORIZON_MONTHS', 12)), prices)
+    report.update(run_id=run_id, codec_profile=CODEC_PROFILE['name'], generated_at=datetime.utcnow().isoformat() + 'Z')
+    report_key = f"{run_prefix}report.json"
+    put_json_to_s3(WORK_BUCKET, report_key, report)
+    logger.info(f"savings report {report_key}: {report['totals']}, suggested min convert bytes {report['suggested_min_convert_bytes']}")
+    return {
+        'report': f"s3://{WORK_BUCKET}/{report_key}",
+        'totals': report['totals'],
+        'suggested_min_convert_bytes': report['suggested_min_convert_bytes']
+    }
+
+
+def put_json_to_s3(bucket, key, body):
+    try:
+        s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(body, indent=1).encode(), ContentType='application/json')
+    except ClientError as e:
+        logger.error(f"Unable to write {key}")
+        logger.error(e)
+        raise
@@ -0,0 +1,63 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Splits a day prefix into shards that can be listed in parallel. Sub-prefixes under the day are
+# used when there are any, otherwise the key space is cut into start-after ranges on the first
+# character after the prefix (Connect names recordings after the contact id, a hex UUID).
+
+DEFAULT_SHARD_BOUNDARIES = '123456789abcdef'
+
+# sorts after any character a key can continue with, so a range starting at prefix + c also
+# includes prefix + c itself
+MAX_CHARACTER = '\U0010ffff'
+
+
+def shard(prefix, start_after='', end_before='', delimiter=''):
+    return {
+        'prefix': prefix,
+        'start_after': start_after,
+        'end_before': end_before,
+        'delimiter': delimiter,
+    }
+
+
+def range_shards(prefix, boundaries=DEFAULT_SHARD_BOUNDARIES):
+    # boundaries are the first characters of every shard but the first, in ascending order
+    shards = []
+    lower = ''
+    for boundary in sorted(set(boundaries)):
+        shards.append(shard(prefix, start_after_for(prefix, lower), prefix + boundary))
+        lower = boundary
+    shards.append(shard(prefix, start_after_for(prefix, lower)))
+    return shards
+
+
+def start_after_for(prefix, lower):
+    if not lower:
+        return ''
+    return prefix + chr(ord(lower) - 1) + MAX_CHARACTER
+
+
+def plan_shards(s3, bucket, prefix, boundaries=DEFAULT_SHARD_BOUNDARIES):
+    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter='/')
+    sub_prefixes = [common_prefix['Prefix'] for common_prefix in response.get('CommonPrefixes', [])]
+    if response.get('IsTruncated') or not sub_prefixes:
+        # flat day prefix, or too many sub-prefixes to enumerate in one call
+        return range_shards(prefix, boundaries)
+    shards = [shard(sub_prefix) for sub_prefix in sub_prefixes]
+    if response.get('Contents'):
+        # objects directly under the day prefix, next to the sub-prefixes
+        shards.append(shard(prefix, delimiter='/'))
+    return shards
+
+
+def clip_to_shard(response, end_before):
+    # Drops the keys at or past the end of the shard. Returns the remaining objects and whether
+    # the shard is exhausted.
+    contents = response.get('Contents', [])
+    if end_before:
+        inside = [obj for obj in contents if obj['Key'] < end_before]
+        if len(inside) < len(contents):
+            return inside, True
+        contents = inside
+    return contents, 'NextContinuationToken' not in response
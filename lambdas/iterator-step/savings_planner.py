@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Dry-run estimate of what converting a date range would save. Listings are aggregated by day
+# and key prefix, the converted size of every object is estimated from its size and the format
+# probed from one of the recordings in its prefix, and the report weighs the storage saved
+# against the request and compute cost of converting, which gives the object size below which
+# conversion does not pay for itself. Converted sizes follow the bitrate of the codec profile.
+
+import math
+
+from codec_profiles import is_profile_output, estimate_output_size
+from wav_format import WAVE_FORMAT_ALAW, WAVE_FORMAT_MULAW, WAVE_FORMAT_PCM
+
+# what Amazon Connect writes, assumed for prefixes whose header could not be probed
+CONNECT_WAV_FORMAT = {
+    'format_tag': WAVE_FORMAT_PCM,
+    'channels': 2,
+    'sample_rate': 8000,
+    'block_align': 4,
+    'bits_per_sample': 16,
+}
+# canonical 44 byte PCM header of the source recordings
+SOURCE_HEADER_SIZE = 44
+GB = 1024 ** 3
+
+# us-east-1 list prices in USD, override with the PLANNER_PRICES environment variable
+DEFAULT_PRICES = {
+    # source recordings, as Connect writes them
+    'source_storage_gb_month': 0.023,
+    # converted recordings in the target storage tier
+    'target_storage_gb_month': 0.004,
+    # HeadObject, header probe and the GET of the recording
+    'get_request': 0.0004 / 1000,
+    'get_requests_per_file': 3,
+    # PutObject into the target tier
+    'put_request': 0.02 / 1000,
+    'lambda_gb_second': 0.0000166667,
+    # convert Lambda memory, fixed time per file and transcode throughput
+    'lambda_memory_gb': 0.8,
+    'lambda_seconds_per_file': 0.05,
+    'lambda_bytes_per_second': 20 * 1024 * 1024,
+}
+
+
+def estimate_converted_size(size, wav_format, profile):
+    if is_profile_output(wav_format, profile):
+        return size
+    if (wav_format is None or wav_format.get('format_tag') not in (WAVE_FORMAT_PCM, WAVE_FORMAT_ALAW, WAVE_FORMAT_MULAW)
+            or not wav_format['block_align']):
+        wav_format = CONNECT_WAV_FORMAT
+    byte_rate = wav_format['sample_rate'] * wav_format['block_align']
+    seconds = max(size - SOURCE_HEADER_SIZE, 0) / byte_rate
+    return estimate_output_size(profile, seconds)
+
+
+def new_group(day, prefix):
+    return {'day': day, 'prefix': prefix, 'objects': 0, 'bytes': 0, 'converted_bytes': 0}
+
+
+def add_object(group, size, wav_format, profile):
+    group['objects'] += 1
+    group['bytes'] += size
+    group['converted_bytes'] += estimate_converted_size(size, wav_format, profile)
+
+
+def merge_groups(parts):
+    groups = {}
+    for part in parts:
+        for group in part:
+            merged = groups.setdefault((group['day'], group['prefix']), new_group(group['day'], group['prefix']))
+            for field in ('objects', 'bytes', 'converted_bytes'):
+                merged[field] += group[field]
+    return [groups[group_key] for group_key in sorted(groups)]
+
+
+def conversion_cost(objects, size, prices):
+    requests = objects * (prices['get_requests_per_file'] * prices['get_request'] + prices['put_request'])
+    seconds = objects * prices['lambda_seconds_per_file'] + size / prices['lambda_bytes_per_second']
+    return requests + seconds * prices['lambda_memory_gb'] * prices['lambda_gb_second']
+
+
+def monthly_storage_savings(size, converted_size, prices):
+    return (size * prices['source_storage_gb_month'] - converted_size * prices['target_storage_gb_month']) / GB
+
+
+def suggested_min_convert_bytes(size, converted_size, horizon_months, prices):
+    # Smallest object whose storage savings over the horizon cover the cost of converting it,
+    # assuming the average compression ratio of the report. None when nothing pays off.
+    ratio = converted_size / size if size else 0.25
+    saving_per_byte = (prices['source_storage_gb_month'] - ratio * prices['target_storage_gb_month']) / GB * horizon_months
+    compute_per_byte = prices['lambda_memory_gb'] * prices['lambda_gb_second'] / prices['lambda_bytes_per_second']
+    fixed_per_file = conversion_cost(1, 0, prices)
+    if saving_per_byte <= compute_per_byte:
+        return None
+    return math.ceil(fixed_per_file / (saving_per_byte - compute_per_byte))
+
+
+def build_report(groups, horizon_months, prices):
+    totals = new_group(None, None)
+    for group in groups:
+        for field in ('objects', 'bytes', 'converted_bytes'):
+            totals[field] += group[field]
+        summarize(group, horizon_months, prices)
+    summarize(totals, horizon_months, prices)
+    del totals['day'], totals['prefix']
+    return {
+        'horizon_months': horizon_months,
+        'prices': prices,
+        'totals': totals,
+        'suggested_min_convert_bytes': suggested_min_convert_bytes(totals['bytes'], totals['converted_bytes'], horizon_months, prices),
+        'groups': groups,
+    }
+
+
+def summarize(group, horizon_months, prices):
+    group['bytes_saved'] = group['bytes'] - group['converted_bytes']
+    group['monthly_storage_savings'] = round(monthly_storage_savings(group['bytes'], group['converted_bytes'], prices), 6)
+    group['conversion_cost'] = round(conversion_cost(group['objects'], group['bytes'], prices), 6)
+    group['net_savings'] = round(group['monthly_storage_savings'] * horizon_months - group['conversion_cost'], 6)
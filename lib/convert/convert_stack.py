@@ -1,6 +1,6 @@
 import json
 from constructs import Construct
-from aws_cdk import App, Stack,Duration, Stack
+from aws_cdk import App, Stack,Duration, Stack, ArnFormat
 
 from aws_cdk import(
     aws_stepfunctions as sfn,
@@ -12,6 +12,7 @@ from aws_cdk import(
     aws_sqs as _sqs,
     aws_lambda_destinations as _lambda_dest,
     aws_s3 as s3,
+    aws_dynamodb as dynamodb,
     Duration
 )
 
@@ -33,8 +34,71 @@ class CallRecordStack(Stack):
         NUM_DAYS_AGE = self.node.try_get_context("num_days_age")
         
         S3_STORAGE_TIER = self.node.try_get_context("s3_storage_tier")
+
+        # container, codec, sample rate, channels and bitrate of the converted recordings
+        CODEC_PROFILE = self.node.try_get_context("codec_profile") or "alaw-8k"
+
+        # shorten silence and hold music before encoding, with a sidecar index of the cuts
+        SILENCE_COMPACTION = str(self.node.try_get_context("silence_compaction") or "false")
     
         OVERWRITE_PREVIOUS_CONVERTED = self.node.try_get_context("overwrite_previous_converted")
+
+        # SQS records per convert invocation and files converted concurrently within it
+        CONVERT_BATCH_SIZE = int(self.node.try_get_context("convert_batch_size") or 10)
+
+        CONVERT_MAX_WORKERS = str(self.node.try_get_context("convert_max_workers") or 4)
+
+        # upper bound of concurrent convert invocations, also reserved for the function. Within it the
+        # throttle controller moves the event source maximum concurrency and the workers per invocation.
+        CONVERT_MAX_CONCURRENCY = int(self.node.try_get_context("convert_max_concurrency") or 20)
+
+        # concurrent tag checks and SQS batch sends in the queue Lambda
+        QUEUE_MAX_WORKERS = str(self.node.try_get_context("queue_max_workers") or 32)
+
+        # check the convert-batch tag of keys the ledger does not know, for buckets converted before the ledger
+        LEDGER_TAG_FALLBACK = str(self.node.try_get_context("ledger_tag_fallback") or "false")
+
+        # probe the WAV header of every key in the queue Lambda as well, the convert Lambda always does
+        HEADER_PROBE_QUEUE = str(self.node.try_get_context("header_probe_in_queue") or "false")
+
+        # lease every recording version in the ledger when it is queued and when it is converted,
+        # so overlapping executions and retried steps queue and convert it once
+        DEDUP_DISPATCH = str(self.node.try_get_context("dedup_dispatch") or "true")
+
+        # share of the invocations of every Lambda profiled into the work bucket, 0 profiles only on request
+        PROFILE_SAMPLE_RATE = str(self.node.try_get_context("profile_sample_rate") or 0)
+
+        # 'sqs' queues one message per recording, 'manifest' writes S3 Batch Operations manifests
+        DISPATCH_MODE = self.node.try_get_context("dispatch_mode") or "sqs"
+
+        MANIFEST_CHUNK_SIZE = str(self.node.try_get_context("manifest_chunk_size") or 100000)
+
+        # shards of a day prefix listed in parallel, and the first characters that split a flat prefix
+        LISTING_CONCURRENCY = int(self.node.try_get_context("listing_concurrency") or 8)
+
+        SHARD_BOUNDARIES = self.node.try_get_context("shard_boundaries") or ""
+
+        # keys listed into one page for the queue Lambda, large pages go through the work bucket
+        LISTING_PAGE_KEYS = str(self.node.try_get_context("listing_page_keys") or 5000)
+
+        # days of a date range backfill converted at the same time
+        BACKFILL_CONCURRENCY = int(self.node.try_get_context("backfill_concurrency") or 4)
+
+        # recordings smaller than this are not converted, the savings planner report suggests a value
+        MIN_CONVERT_BYTES = str(self.node.try_get_context("min_convert_bytes") or 0)
+
+        # how long an execution waits for the enqueued recordings to be converted before it fails
+        COMPLETION_TIMEOUT_MINUTES = int(self.node.try_get_context("completion_timeout_minutes") or 720)
+
+        # index the recordings as S3 announces them, so the scheduled execution reads the ones
+        # due from the index instead of listing the day. Only used with the sqs dispatch mode.
+        PENDING_INDEX = str(self.node.try_get_context("pending_index") or "false").lower() == "true" and DISPATCH_MODE == "sqs"
+
+        # partitions of a day in the pending index, and so shards read in parallel
+        PENDING_INDEX_PARTITIONS = str(self.node.try_get_context("pending_index_partitions") or 4)
+
+        # deliveries of a convert message before it moves to the dead letter queue
+        MAX_RECEIVE_COUNT = 5
     
         
         ##############################################################################
@@ -51,11 +115,70 @@ class CallRecordStack(Stack):
             queue_name=f'connect_audio_convert',
             visibility_timeout=Duration.minutes(90),
             dead_letter_queue=_sqs.DeadLetterQueue(
-                max_receive_count=5,
+                max_receive_count=MAX_RECEIVE_COUNT,
                 queue=dead_letter_queue
             )
             )
   
+        ##############################################################################
+        # Conversion ledger
+        ##############################################################################
+
+        # converted recordings by key prefix (the recording day) and file name, with the ETag
+        # of the converted object, so a listing page is checked with one query
+        ledger_table = dynamodb.Table(self, "connect_audio_convert_ledger",
+            table_name=f'connect_audio_convert_ledger',
+            partition_key=dynamodb.Attribute(name="prefix", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="name", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            )
+
+        # per execution progress, one item per recording day, and the recordings counted towards
+        # its completion, which expire
+        runs_table = dynamodb.Table(self, "connect_audio_convert_runs",
+            table_name=f'connect_audio_convert_runs',
+            partition_key=dynamodb.Attribute(name="run_id", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="item", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            )
+
+        # how far the listing of every recording day and shard got, so a failed or timed out
+        # execution is resumed by the next one instead of listed again from the start
+        checkpoints_table = dynamodb.Table(self, "connect_audio_convert_checkpoints",
+            table_name=f'connect_audio_convert_checkpoints',
+            partition_key=dynamodb.Attribute(name="day", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="shard", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            )
+
+        # recordings still to convert by creation day and time, written by the ingest Lambda
+        if PENDING_INDEX:
+            pending_table = dynamodb.Table(self, "connect_audio_convert_pending",
+                table_name=f'connect_audio_convert_pending',
+                partition_key=dynamodb.Attribute(name="day", type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name="created", type=dynamodb.AttributeType.STRING),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="expires_at",
+                )
+
+        # executions of the state machine, whose ARN is built from the name because the state
+        # machine depends on the Lambdas that look them up
+        EXECUTION_ARN_PREFIX = self.format_arn(service="states", resource="execution",
+            resource_name="media-batchconvert", arn_format=ArnFormat.COLON_RESOURCE_NAME)
+
+        ##############################################################################
+        # Work bucket for batch manifests and reports
+        ##############################################################################
+
+        work_bucket = s3.Bucket(self, "convert_work_bucket",
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            enforce_ssl=True,
+            lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(30))]
+            )
+
         ##############################################################################
         # Lambda Queue for Conversion Failures
         ##############################################################################
@@ -78,6 +201,21 @@ class CallRecordStack(Stack):
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
             compatible_architectures=[_lambda.Architecture.X86_64])
 
+        # x86 numpy layer for the in-process A-law transcoder
+        numpy_layer = _lambda.LayerVersion(
+            self, "numpy_layer",
+            code=_lambda.AssetCode('lambda-layers/layer-numpy/numpy_layer.zip'),
+            description="x86 numpy layer",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+            compatible_architectures=[_lambda.Architecture.X86_64])
+
+        # modules shared by the convert and iterator Lambdas
+        common_layer = _lambda.LayerVersion(
+            self, "common_layer",
+            code=_lambda.Code.from_asset('lambda-layers/layer-common'),
+            description="shared convert pipeline modules",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_9])
+
         ##############################################################################
         # Policies for Lambda
         ##############################################################################
@@ -128,24 +266,63 @@ class CallRecordStack(Stack):
             environment = {
                 'CONNECT_RECORDING_S3_BUCKET': CONNECT_BUCKET,
                 'PREFIX': CONNECT_BUCKET_PREFIX,
-                'S3_STORAGE_TIER':S3_STORAGE_TIER
+                'S3_STORAGE_TIER':S3_STORAGE_TIER,
+                'CODEC_PROFILE': CODEC_PROFILE,
+                'SILENCE_COMPACTION': SILENCE_COMPACTION,
+                'CONVERT_BACKEND': 'auto',
+                'MAX_WORKERS': CONVERT_MAX_WORKERS,
+                'LEDGER_TABLE': ledger_table.table_name,
+                'MIN_CONVERT_BYTES': MIN_CONVERT_BYTES,
+                'RUNS_TABLE': runs_table.table_name,
+                'MAX_RECEIVE_COUNT': str(MAX_RECEIVE_COUNT),
+                'DEDUP_DISPATCH': DEDUP_DISPATCH,
+                'PROFILE_SAMPLE_RATE': PROFILE_SAMPLE_RATE,
+                'PROFILE_BUCKET': work_bucket.bucket_name,
+                'MAX_CONCURRENCY': str(CONVERT_MAX_CONCURRENCY),
+                'CONVERT_QUEUE_ARN': queue.queue_arn,
+                'CONNECT_RECORDING_CONVERT_QUEUE': queue.queue_url
                 },
-            layers=[ffmpeg_layer],
+            reserved_concurrent_executions=CONVERT_MAX_CONCURRENCY,
+            layers=[ffmpeg_layer, numpy_layer, common_layer],
             on_failure=_lambda_dest.SqsDestination(lambda_convert_dest_failure_queue),
             )
 
 
         #Add SQS event source to the Lambda function
+        # batches larger than 10 need a batching window, failed records are redelivered on their own
         convert_lambda.add_event_source(SqsEventSource(queue,
-            batch_size=1,
+            batch_size=CONVERT_BATCH_SIZE,
+            max_batching_window=Duration.seconds(5) if CONVERT_BATCH_SIZE > 10 else None,
+            report_batch_item_failures=True,
+            max_concurrency=CONVERT_MAX_CONCURRENCY,
         ))
 
         # Add inline policy to the lambda
         convert_lambda.add_to_role_policy(S3ReadWritePolicyStmt)
+        # large converted files are written with a multipart upload, aborted when it fails
+        convert_lambda.add_to_role_policy(iam.PolicyStatement(
+            resources=["arn:aws:s3:::" + CONNECT_BUCKET + "/*"],
+            actions=['S3:AbortMultipartUpload']
+        ))
         convert_lambda.add_to_role_policy(S3ReadKMSPolicyStmt)
 
         # Add Permissions to lambda to write messags to queue
         lambda_convert_dest_failure_queue.grant_send_messages(convert_lambda)
+        ledger_table.grant_read_write_data(convert_lambda)
+        runs_table.grant_read_write_data(convert_lambda)
+        # profiles of the invocations profiled
+        work_bucket.grant_put(convert_lambda)
+
+        # the throttle controller lowers and raises the maximum concurrency of its own event source
+        convert_lambda.add_to_role_policy(iam.PolicyStatement(
+            resources=["*"],
+            actions=['lambda:ListEventSourceMappings']
+        ))
+        convert_lambda.add_to_role_policy(iam.PolicyStatement(
+            resources=[self.format_arn(service="lambda", resource="event-source-mapping", resource_name="*",
+                arn_format=ArnFormat.COLON_RESOURCE_NAME)],
+            actions=['lambda:UpdateEventSourceMapping']
+        ))
         
 
         ##############################################################################
@@ -162,15 +339,63 @@ class CallRecordStack(Stack):
             environment = {
             'CONNECT_RECORDING_S3_BUCKET': CONNECT_BUCKET,
             'PREFIX': CONNECT_BUCKET_PREFIX,
-            'MAX_KEYS':'1000',
+            'MAX_KEYS': LISTING_PAGE_KEYS,
             'NUM_DAYS_AGE': NUM_DAYS_AGE, 
-            }
+            'SHARD_BOUNDARIES': SHARD_BOUNDARIES,
+            'LEDGER_TABLE': ledger_table.table_name,
+            'RUNS_TABLE': runs_table.table_name,
+            'DISPATCH_MODE': DISPATCH_MODE,
+            'WORK_BUCKET': work_bucket.bucket_name,
+            'MANIFEST_PREFIX': 'manifests/',
+            'PAGE_PREFIX': 'pages/',
+            'MANIFEST_CHUNK_SIZE': MANIFEST_CHUNK_SIZE,
+            'BATCH_REPORT_PREFIX': 'batch-reports',
+            'ACCOUNT_ID': self.account,
+            'CONVERT_FUNCTION_ARN': convert_lambda.function_arn,
+            'MIN_CONVERT_BYTES': MIN_CONVERT_BYTES,
+            'REPORT_PREFIX': 'reports/savings/',
+            'CODEC_PROFILE': CODEC_PROFILE,
+            'CHECKPOINTS_TABLE': checkpoints_table.table_name,
+            'EXECUTION_ARN_PREFIX': EXECUTION_ARN_PREFIX,
+            'PROFILE_SAMPLE_RATE': PROFILE_SAMPLE_RATE,
+            'PROFILE_BUCKET': work_bucket.bucket_name,
+            },
+            layers=[common_layer]
         )
 
 
         # Add inline policy to the lambda
         step_iterator_lambda.add_to_role_policy(S3ReadWritePolicyStmt)
         step_iterator_lambda.add_to_role_policy(S3ReadKMSPolicyStmt)
+        ledger_table.grant_read_data(step_iterator_lambda)
+        runs_table.grant_read_write_data(step_iterator_lambda)
+        checkpoints_table.grant_read_write_data(step_iterator_lambda)
+        # a checkpoint is taken over once the execution that wrote it is no longer running
+        step_iterator_lambda.add_to_role_policy(iam.PolicyStatement(
+            resources=[EXECUTION_ARN_PREFIX + ":*"],
+            actions=['states:DescribeExecution']
+        ))
+        # savings planner report parts and reports, listing pages too large to inline, and the manifests in manifest mode
+        work_bucket.grant_read_write(step_iterator_lambda)
+
+        if PENDING_INDEX:
+            step_iterator_lambda.add_environment('PENDING_TABLE', pending_table.table_name)
+            step_iterator_lambda.add_environment('PENDING_INDEX_PARTITIONS', PENDING_INDEX_PARTITIONS)
+            pending_table.grant_read_data(step_iterator_lambda)
+
+        if DISPATCH_MODE == 'manifest':
+            # S3 Batch Operations invokes the convert Lambda once per manifest row
+            batch_operations_role = iam.Role(self, "batch_operations_role",
+                assumed_by=iam.ServicePrincipal("batchoperations.s3.amazonaws.com"))
+            convert_lambda.grant_invoke(batch_operations_role)
+            work_bucket.grant_read_write(batch_operations_role)
+
+            step_iterator_lambda.add_environment('BATCH_OPERATIONS_ROLE_ARN', batch_operations_role.role_arn)
+            batch_operations_role.grant_pass_role(step_iterator_lambda)
+            step_iterator_lambda.add_to_role_policy(iam.PolicyStatement(
+                resources=["*"],
+                actions=['s3:CreateJob']
+            ))
 
         
         ##############################################################################
@@ -187,8 +412,20 @@ class CallRecordStack(Stack):
             environment = {
             'CONNECT_RECORDING_CONVERT_QUEUE': queue.queue_url,
             'CONNECT_RECORDING_S3_BUCKET': CONNECT_BUCKET,
-            'OVERWRITE_PREVIOUS_CONVERTED': OVERWRITE_PREVIOUS_CONVERTED
-            }
+            'OVERWRITE_PREVIOUS_CONVERTED': OVERWRITE_PREVIOUS_CONVERTED,
+            'MAX_WORKERS': QUEUE_MAX_WORKERS,
+            'LEDGER_TABLE': ledger_table.table_name,
+            'LEDGER_TAG_FALLBACK': LEDGER_TAG_FALLBACK,
+            'RUNS_TABLE': runs_table.table_name,
+            'HEADER_PROBE': HEADER_PROBE_QUEUE,
+            'DEDUP_DISPATCH': DEDUP_DISPATCH,
+            'MIN_CONVERT_BYTES': MIN_CONVERT_BYTES,
+            'CODEC_PROFILE': CODEC_PROFILE,
+            'CHECKPOINTS_TABLE': checkpoints_table.table_name,
+            'PROFILE_SAMPLE_RATE': PROFILE_SAMPLE_RATE,
+            'PROFILE_BUCKET': work_bucket.bucket_name
+            },
+            layers=[common_layer]
         )
 
         # Add inline policy to the lambda
@@ -198,6 +435,77 @@ class CallRecordStack(Stack):
         # Add Permissions to lambda to write messags to queue
         lambda_convert_dest_failure_queue.grant_send_messages(step_queue_lambda)
         queue.grant_send_messages(step_queue_lambda)
+        ledger_table.grant_read_write_data(step_queue_lambda)
+        runs_table.grant_read_write_data(step_queue_lambda)
+        checkpoints_table.grant_read_write_data(step_queue_lambda)
+        # listing pages too large to pass inline through the state machine, and profiles
+        work_bucket.grant_read(step_queue_lambda)
+        work_bucket.grant_put(step_queue_lambda)
+
+        ##############################################################################
+        # Pending index of the recordings written, fed by S3 Object Created events
+        ##############################################################################
+
+        if PENDING_INDEX:
+            pending_ingest_dlq = _sqs.Queue(self, "connect_audio_pending_ingest_dlq",
+                queue_name=f'connect_audio_pending_ingest_dlq'
+            )
+
+            # visibility timeout 6x ingest lambda timeout
+            pending_ingest_queue = _sqs.Queue(self, "connect_audio_pending_ingest",
+                queue_name=f'connect_audio_pending_ingest',
+                visibility_timeout=Duration.minutes(6),
+                dead_letter_queue=_sqs.DeadLetterQueue(
+                    max_receive_count=MAX_RECEIVE_COUNT,
+                    queue=pending_ingest_dlq
+                )
+                )
+
+            ingest_lambda = _lambda.Function(self,'ingest-call-recording',
+                function_name=f'ingest-call-recording',
+                handler='lambda-handler.lambda_handler',
+                runtime=_lambda.Runtime.PYTHON_3_9,
+                code=_lambda.Code.from_asset('lambdas/ingest'),
+                description="adds new recordings to the pending index",
+                timeout=Duration.seconds(60),
+                environment = {
+                'PREFIX': CONNECT_BUCKET_PREFIX,
+                'NUM_DAYS_AGE': NUM_DAYS_AGE,
+                'LEDGER_TABLE': ledger_table.table_name,
+                'PENDING_TABLE': pending_table.table_name,
+                'PENDING_INDEX_PARTITIONS': PENDING_INDEX_PARTITIONS,
+                'PROFILE_SAMPLE_RATE': PROFILE_SAMPLE_RATE,
+                'PROFILE_BUCKET': work_bucket.bucket_name
+                },
+                layers=[common_layer]
+            )
+
+            # an invocation indexes up to 100 recordings, the batch is written again when it fails
+            ingest_lambda.add_event_source(SqsEventSource(pending_ingest_queue,
+                batch_size=100,
+                max_batching_window=Duration.seconds(30),
+            ))
+            ledger_table.grant_read_data(ingest_lambda)
+            pending_table.grant_write_data(ingest_lambda)
+            work_bucket.grant_put(ingest_lambda)
+
+            # S3 sends the Object Created events of the recordings bucket to EventBridge
+            s3.Bucket.from_bucket_name(self, "connect_recording_bucket", CONNECT_BUCKET).enable_event_bridge_notification()
+
+            recording_created_rule = events.Rule(
+                self, "Recording Created Rule",
+                rule_name=f'recording-convert-pending-index-rule',
+                description="Adds new call recordings to the pending index.",
+                event_pattern=events.EventPattern(
+                    source=["aws.s3"],
+                    detail_type=["Object Created"],
+                    detail={
+                        "bucket": {"name": [CONNECT_BUCKET]},
+                        "object": {"key": [{"prefix": CONNECT_BUCKET_PREFIX}]}
+                    }
+                ),
+            )
+            recording_created_rule.add_target(targets.SqsQueue(pending_ingest_queue))
 
         ##############################################################################
         # Step Function
@@ -217,11 +525,81 @@ class CallRecordStack(Stack):
             "configure",
             parameters={
                 "NextContinuationToken": "",
-                "specific_date.$": "$$.Execution.Input.specific_date"
+                "run_id.$": "$$.Execution.Name",
+                "request.$": "$$.Execution.Input"
             },
             result_path="$.iterator"
         )
 
+        # a specific_date, a start_date/end_date range or a list of dates becomes one item per day,
+        # with the restart and profile flags of the request, false when the input leaves them out
+        plan_days = sfn_tasks.LambdaInvoke(
+            self, "Expand the dates to convert",
+            lambda_function=step_iterator_lambda,
+            payload=sfn.TaskInput.from_object({
+                "action": "days",
+                "request": sfn.JsonPath.object_at("$.iterator.request")
+            }),
+            result_selector={
+                "days.$": "$.Payload.days"
+            },
+            result_path="$.schedule"
+        )
+
+        # every day runs as a child execution with its own event history, a year of listing
+        # and enqueue loops does not fit into the 25,000 events of a single execution
+        convert_days = sfn.DistributedMap(
+            self, "Convert days in parallel",
+            items_path="$.schedule.days",
+            max_concurrency=BACKFILL_CONCURRENCY,
+            map_execution_type=sfn.StateMachineType.STANDARD,
+            item_selector={
+                "iterator": {
+                    "NextContinuationToken": "",
+                    "specific_date.$": "$$.Map.Item.Value.date",
+                    "day.$": "$$.Map.Item.Value.day",
+                    "restart.$": "$$.Map.Item.Value.restart",
+                    "source.$": "$$.Map.Item.Value.source",
+                    "profile.$": "$$.Map.Item.Value.profile",
+                    "run_id.$": "$.iterator.run_id"
+                }
+            },
+            result_path=JsonPath.DISCARD
+        )
+
+        day_progress_key = {
+            "run_id": sfn_tasks.DynamoAttributeValue.from_string(sfn.JsonPath.string_at("$.iterator.run_id")),
+            "item": sfn_tasks.DynamoAttributeValue.from_string(sfn.JsonPath.format("day#{}", sfn.JsonPath.string_at("$.iterator.day")))
+        }
+
+        record_day_started = sfn_tasks.DynamoUpdateItem(
+            self, "Record day started",
+            table=runs_table,
+            key=day_progress_key,
+            update_expression="SET #status = :status, started_at = :started_at",
+            expression_attribute_names={"#status": "status"},
+            expression_attribute_values={
+                ":status": sfn_tasks.DynamoAttributeValue.from_string("listing"),
+                ":started_at": sfn_tasks.DynamoAttributeValue.from_string(sfn.JsonPath.string_at("$$.State.EnteredTime"))
+            },
+            result_path=JsonPath.DISCARD
+        )
+
+        record_day_listed = sfn_tasks.DynamoUpdateItem(
+            self, "Record day listed",
+            table=runs_table,
+            key=day_progress_key,
+            update_expression="SET #status = :status, listed_at = :listed_at",
+            expression_attribute_names={"#status": "status"},
+            expression_attribute_values={
+                ":status": sfn_tasks.DynamoAttributeValue.from_string("listed"),
+                ":listed_at": sfn_tasks.DynamoAttributeValue.from_string(sfn.JsonPath.string_at("$$.State.EnteredTime"))
+            },
+            result_path=JsonPath.DISCARD,
+            # the outputs of the child executions are collected by the map, keep them small
+            output_path="$.iterator.day"
+        )
+
         iterator = sfn_tasks.LambdaInvoke(
             self, "7 days ago recordings s3 iterator",
             input_path="$.iterator",
@@ -230,27 +608,85 @@ class CallRecordStack(Stack):
                 "iterator": {
                     "files":sfn.JsonPath.string_at("$.Payload.files"),
                     "NextContinuationToken": sfn.JsonPath.string_at("$.Payload.NextContinuationToken"),
-                    "specific_date.$": "$$.Execution.Input.specific_date"
+                    "specific_date.$": "$.Payload.specific_date",
+                    "day.$": "$.Payload.day",
+                    "run_id.$": "$.Payload.run_id",
+                    "profile.$": "$.Payload.profile",
+                    "shard.$": "$.Payload.shard"
                 }
             }
         )
 
-        get_queue_length = sfn_tasks.CallAwsService(self, "Check the convert queue length",
-            service="sqs",
-            action="getQueueAttributes",
-            iam_resources=[queue.queue_arn],
+        plan_shards = sfn_tasks.LambdaInvoke(
+            self, "Split the day into listing shards",
+            lambda_function=step_iterator_lambda,
+            payload=sfn.TaskInput.from_object({
+                "action": "shards",
+                "NextContinuationToken": "",
+                "specific_date": sfn.JsonPath.string_at("$.iterator.specific_date"),
+                "source": sfn.JsonPath.string_at("$.iterator.source"),
+                "profile": sfn.JsonPath.string_at("$.iterator.profile")
+            }),
+            result_selector={
+                "shards.$": "$.Payload.shards"
+            },
+            result_path="$.plan"
+        )
+
+        # S3 errors of the listing, SlowDown for one, are retried before they fail the execution
+        for listing_task in (iterator, plan_shards):
+            listing_task.add_retry(errors=["ClientError"], interval=Duration.seconds(5), backoff_rate=2, max_attempts=3)
+
+        # every shard runs its own list and enqueue loop
+        list_shards = sfn.Map(
+            self, "List shards in parallel",
+            items_path="$.plan.shards",
+            max_concurrency=LISTING_CONCURRENCY,
             parameters={
-                "QueueUrl": queue.queue_url,
-                "AttributeNames": [
-                "ApproximateNumberOfMessages",
-                "ApproximateNumberOfMessagesDelayed",
-                "ApproximateNumberOfMessagesNotVisible"
-                ]
-            }
+                "iterator": {
+                    "NextContinuationToken": "",
+                    "specific_date.$": "$.iterator.specific_date",
+                    "day.$": "$.iterator.day",
+                    "restart.$": "$.iterator.restart",
+                    "profile.$": "$.iterator.profile",
+                    "run_id.$": "$.iterator.run_id",
+                    "shard.$": "$$.Map.Item.Value"
+                }
+            },
+            result_path=JsonPath.DISCARD
+        )
+
+        shard_listed = sfn.Succeed(
+            self, "Shard listed.",
+            comment='Shard listed'
         )
 
-        wait_60m=sfn.Wait(self,"Wait 60 Seconds",
-            time=sfn.WaitTime.duration(Duration.seconds(60)))
+        # resumed by the Lambda that sees the converted and failed counts reach the enqueued count
+        await_completion = sfn_tasks.LambdaInvoke(
+            self, "Wait for the recordings to convert",
+            lambda_function=step_iterator_lambda,
+            integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            payload=sfn.TaskInput.from_object({
+                "action": "await_completion",
+                "run_id": sfn.JsonPath.string_at("$.iterator.run_id"),
+                "task_token": sfn.JsonPath.task_token
+            }),
+            result_path="$.completion",
+            timeout=Duration.minutes(COMPLETION_TIMEOUT_MINUTES)
+        )
+
+        fail_incomplete_job = sfn.Fail(
+            self, "Conversion did not complete.",
+            error="ConversionTimeout",
+            cause="Not every enqueued recording was converted before the completion timeout"
+        )
+        await_completion.add_catch(fail_incomplete_job, errors=["States.Timeout"])
+
+        fail_convert_job = sfn.Fail(
+            self, "Some recordings failed to convert.",
+            error="ConversionFailed",
+            cause="Recordings were moved to the connect_audio_convert_dlq dead letter queue"
+        )
 
         convert_recordings = sfn_tasks.LambdaInvoke(
             self, "Add files to convert Queue",
@@ -258,36 +694,126 @@ class CallRecordStack(Stack):
             result_path=JsonPath.DISCARD,
             lambda_function=step_queue_lambda,
         )
-    
-        catch_convert_error = sfn.Pass(
-            self,
-            "catch an error",
-            result_path=JsonPath.DISCARD
-        )
 
-        # catch error and retry
-        convert_recordings.add_catch(catch_convert_error, errors=['States.ALL'],result_path='$.error')
+        # A page that still fails fails the execution, the keys of the page that were not sent are
+        # released. A new execution resumes from the checkpoint before the page.
         convert_recordings.add_retry(backoff_rate=1.05,interval=Duration.seconds(5),errors=["ConvertRetry"])
         
 
-        # check the sqs queue
-        wait_60m.next(get_queue_length).next(sfn.Choice(self, 'Queue length?')\
-            .when(sfn.Condition.string_equals('$.Attributes.ApproximateNumberOfMessagesDelayed', '0'), succeed_convert_job)\
-            .otherwise(wait_60m)
-            .afterwards())
-            
+        # report the recordings SQS gave up on
+        await_completion.next(sfn.Choice(self, 'All recordings converted?')\
+            .when(sfn.Condition.number_greater_than('$.completion.failed', 0), fail_convert_job)\
+            .otherwise(succeed_convert_job))
+
+        ##############################################################################
+        # Savings planner, a dry run started with "mode": "plan" in the execution input
+        ##############################################################################
+
+        plan_savings_days = sfn.DistributedMap(
+            self, "Plan days in parallel",
+            items_path="$.schedule.days",
+            max_concurrency=BACKFILL_CONCURRENCY,
+            map_execution_type=sfn.StateMachineType.STANDARD,
+            item_selector={
+                "iterator": {
+                    "action": "plan_day",
+                    "NextContinuationToken": "",
+                    "specific_date.$": "$$.Map.Item.Value.date",
+                    "day.$": "$$.Map.Item.Value.day",
+                    "profile.$": "$$.Map.Item.Value.profile",
+                    "run_id.$": "$.iterator.run_id"
+                }
+            },
+            result_path=JsonPath.DISCARD
+        )
+
+        plan_day = sfn_tasks.LambdaInvoke(
+            self, "Estimate the savings of the day",
+            input_path="$.iterator",
+            lambda_function=step_iterator_lambda,
+            result_selector={
+                "iterator": {
+                    "action.$": "$.Payload.action",
+                    "NextContinuationToken": sfn.JsonPath.string_at("$.Payload.NextContinuationToken"),
+                    "specific_date.$": "$.Payload.specific_date",
+                    "day.$": "$.Payload.day",
+                    "profile.$": "$.Payload.profile",
+                    "run_id.$": "$.Payload.run_id"
+                }
+            }
+        )
+
+        plan_day.add_retry(errors=["ClientError"], interval=Duration.seconds(5), backoff_rate=2, max_attempts=3)
+
+        day_planned = sfn.Succeed(
+            self, "Day planned.",
+            comment='Day planned',
+            output_path="$.iterator.day"
+        )
+
+        savings_report = sfn_tasks.LambdaInvoke(
+            self, "Write the savings report",
+            lambda_function=step_iterator_lambda,
+            payload=sfn.TaskInput.from_object({
+                "action": "savings_report",
+                "run_id": sfn.JsonPath.string_at("$.iterator.run_id")
+            }),
+            result_selector={
+                "report.$": "$.Payload.report",
+                "totals.$": "$.Payload.totals",
+                "suggested_min_convert_bytes.$": "$.Payload.suggested_min_convert_bytes"
+            },
+            result_path="$.savings"
+        )
+
+        succeed_savings_plan = sfn.Succeed(
+            self, "Savings report written.",
+            comment='Dry run succeeded'
+        )
+
+        plan_savings_days.item_processor(plan_day\
+            .next(sfn.Choice(self, 'More of the day to plan?')\
+            .when(sfn.Condition.string_equals('$.iterator.NextContinuationToken', ''), day_planned)\
+            .otherwise(plan_day)))
+
+        is_dry_run = sfn.Condition.and_(
+            sfn.Condition.is_present('$.iterator.request.mode'),
+            sfn.Condition.string_equals('$.iterator.request.mode', 'plan'))
+
         # convert steps 
-        definition = configure.next(iterator)\
-            .next(sfn.Choice(self, 'Has Files To Process?')\
-            .when(sfn.Condition.string_equals('$.iterator.files', ''), succeed_nothing_to_job)\
-            .otherwise(convert_recordings)\
-            .afterwards())\
-            .next(sfn.Choice(self, 'More files to process?')\
-            .when(sfn.Condition.string_equals('$.iterator.NextContinuationToken', ''), wait_60m)\
-            .otherwise(iterator))
+        if DISPATCH_MODE == 'manifest':
+            # the iterator writes manifests and submits the batch jobs itself
+            succeed_manifest_job = sfn.Succeed(
+                self, "Manifests submitted.",
+                comment='Batch jobs created'
+            )
+            list_shards.iterator(iterator\
+                .next(sfn.Choice(self, 'More files to process?')\
+                .when(sfn.Condition.string_equals('$.iterator.NextContinuationToken', ''), shard_listed)\
+                .otherwise(iterator)))
+            convert_days.item_processor(record_day_started.next(plan_shards).next(list_shards).next(record_day_listed))
+            convert_steps = convert_days.next(succeed_manifest_job)
+        else:
+            list_shards.iterator(iterator\
+                .next(sfn.Choice(self, 'Has Files To Process?')\
+                .when(sfn.Condition.string_equals('$.iterator.files', ''), succeed_nothing_to_job)\
+                .otherwise(convert_recordings)\
+                .afterwards())\
+                .next(sfn.Choice(self, 'More files to process?')\
+                .when(sfn.Condition.string_equals('$.iterator.NextContinuationToken', ''), shard_listed)\
+                .otherwise(iterator)))
+            convert_days.item_processor(record_day_started.next(plan_shards).next(list_shards).next(record_day_listed))
+            convert_steps = convert_days.next(await_completion)
+
+        definition = configure.next(plan_days).next(sfn.Choice(self, 'Dry run?')\
+            .when(is_dry_run, plan_savings_days.next(savings_report).next(succeed_savings_plan))\
+            .otherwise(convert_steps))
             
         # set default empty specific day which then uses the NUM_DAYS_AGE delta from current date
         json_input = "{\"specific_date\": \"\"}"
+        if PENDING_INDEX:
+            # the recordings due are read from the pending index
+            json_input = "{\"specific_date\": \"\", \"source\": \"index\"}"
 
         step_event_parameter = events.RuleTargetInput.from_object(json.loads(json_input))
         
@@ -299,6 +825,19 @@ class CallRecordStack(Stack):
             timeout=Duration.minutes(1800),
             tracing_enabled=True,
         )
+
+        # The convert and iterator Lambdas resume the execution waiting for its recordings. The ARN
+        # is built from the name because the state machine already depends on both functions.
+        SendTaskResultPolicyStmt = iam.PolicyStatement(
+                                resources=[self.format_arn(service="states", resource="stateMachine",
+                                    resource_name="media-batchconvert", arn_format=ArnFormat.COLON_RESOURCE_NAME)],
+                                actions=[
+                                    'states:SendTaskSuccess',
+                                    'states:SendTaskFailure',
+                                ]
+                            )
+        convert_lambda.add_to_role_policy(SendTaskResultPolicyStmt)
+        step_iterator_lambda.add_to_role_policy(SendTaskResultPolicyStmt)
  
         
         ##############################################################################
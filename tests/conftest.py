@@ -0,0 +1,32 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The Lambdas import the common layer and their own directory as top level modules, as they do
+# in Lambda. The handlers all live in lambda-handler.py and read their configuration when they
+# are loaded, so load_handler loads one under its own name once its environment is set.
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, path) for path in (
+    'lambda-layers/layer-common/python', 'lambdas/convert', 'lambdas/iterator-step', 'benchmarks', 'tools')]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# no embedded metric records in the test output
+os.environ['EMIT_METRICS'] = 'false'
+
+
+@pytest.fixture
+def load_handler(monkeypatch):
+    def load(directory, **environment):
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        path = os.path.join(REPO_ROOT, 'lambdas', directory, 'lambda-handler.py')
+        spec = importlib.util.spec_from_file_location(f"{directory.replace('-', '_')}_handler", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
@@ -0,0 +1,74 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import alaw_transcoder
+from alaw_transcoder import (alaw_to_linear, ulaw_to_linear, build_xlaw_table, encode_g711, encode_blocks,
+    read_pcm_blocks, LINEAR_TO_ALAW, LINEAR_TO_ULAW)
+from corpus import make_recording
+from wav_format import read_wav_format
+
+# the ffmpeg of the layer, or one on the PATH
+FFMPEG = next((path for path in ('/opt/bin/ffmpeg', shutil.which('ffmpeg')) if path and os.path.exists(path)), None)
+
+
+def test_xlaw_tables_match_the_module_tables():
+    assert (build_xlaw_table(alaw_to_linear, 0xd5) == LINEAR_TO_ALAW).all()
+    assert (build_xlaw_table(ulaw_to_linear, 0xff) == LINEAR_TO_ULAW).all()
+
+
+@pytest.mark.parametrize('xlaw_to_linear, table, codes', [
+    (alaw_to_linear, LINEAR_TO_ALAW, range(256)),
+    # mu-law has two codes for zero, 0x7f decodes to 0 like 0xff and 0 encodes to 0xff
+    (ulaw_to_linear, LINEAR_TO_ULAW, [code for code in range(256) if code != 0x7f]),
+])
+def test_every_code_survives_a_decode_and_encode(xlaw_to_linear, table, codes):
+    levels = np.array([xlaw_to_linear(code) for code in codes])
+    assert list(encode_g711(levels, table)) == list(codes)
+
+
+def test_encoding_is_monotonic_in_the_decoded_level():
+    samples = np.arange(-32768, 32768)
+    decoded = np.array([alaw_to_linear(int(code)) for code in encode_g711(samples)])
+    assert (np.diff(decoded) >= 0).all()
+    assert decoded[0] == alaw_to_linear(0x2a) and decoded[-1] == alaw_to_linear(0xaa)
+
+
+def stereo_fixture(seconds=3, seed=7):
+    # noise, full scale peaks and silence, the cases where rounding and clipping differ
+    recording = bytearray(make_recording(seconds, random.Random(seed)))
+    data = np.frombuffer(recording, dtype='<i2', offset=44).copy()
+    data[:16] = [32767, 32767, -32768, -32768, 32767, -32768, -32768, 32767, 0, 0, 1, -1, -1, 1, 3, 4]
+    data[16:4016] = 0
+    recording[44:] = data.tobytes()
+    return bytes(recording)
+
+
+def numpy_alaw(recording, chunk_frames=alaw_transcoder.CHUNK_FRAMES):
+    stream = io.BytesIO(recording)
+    wav_format = read_wav_format(stream)
+    return b''.join(encode_blocks(read_pcm_blocks(stream, wav_format, chunk_frames)))
+
+
+def test_block_size_does_not_change_the_output():
+    recording = stereo_fixture()
+    assert numpy_alaw(recording, chunk_frames=1000) == numpy_alaw(recording)
+
+
+@pytest.mark.skipif(FFMPEG is None, reason='ffmpeg is not installed')
+def test_matches_ffmpeg_pcm_alaw_byte_for_byte(tmp_path):
+    recording = stereo_fixture()
+    source = tmp_path / 'stereo.wav'
+    source.write_bytes(recording)
+    ffmpeg_output = subprocess.run([FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', str(source),
+        '-ac', '1', '-ar', '8000', '-c:a', 'pcm_alaw', '-f', 'alaw', '-'], check=True, stdout=subprocess.PIPE).stdout
+    assert numpy_alaw(recording) == ffmpeg_output
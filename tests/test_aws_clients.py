@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from types import SimpleNamespace
+
+import pytest
+
+import aws_clients
+from aws_clients import shared_client, register_event_handler, LazyClient
+
+
+class FakeEvents:
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, event_name, handler):
+        self.registered.append((event_name, handler))
+
+
+class FakeClient:
+
+    def __init__(self, service, config):
+        self.service = service
+        self.config = config
+        self.meta = SimpleNamespace(events=FakeEvents())
+
+    def list_buckets(self):
+        return self.service
+
+
+@pytest.fixture
+def built(monkeypatch):
+    # the clients boto3 was asked for, in order
+    built = []
+
+    def client(service, config=None):
+        built.append(FakeClient(service, config))
+        return built[-1]
+    monkeypatch.setattr(aws_clients.boto3, 'client', client)
+    monkeypatch.setattr(aws_clients, '_clients', {})
+    monkeypatch.setattr(aws_clients, '_event_handlers', [])
+    return built
+
+
+def test_clients_are_shared_per_configuration(built):
+    assert shared_client('s3') is shared_client('s3')
+    assert shared_client('s3', max_pool_connections=50) is shared_client('s3', max_pool_connections=50)
+    assert shared_client('s3', max_pool_connections=50) is not shared_client('s3')
+    assert shared_client('sqs') is not shared_client('s3')
+    assert [client.service for client in built] == ['s3', 's3', 'sqs']
+    assert built[1].config.max_pool_connections == 50
+
+
+def test_lazy_client_is_built_on_first_call(built):
+    client = LazyClient('s3')
+    assert built == []
+    assert client.list_buckets() == 's3'
+    assert client.list_buckets() == 's3'
+    assert len(built) == 1
+    # it is the shared client of its configuration
+    assert shared_client('s3') is built[0]
+
+
+def test_lazy_client_registers_its_own_event_handlers(built):
+    def on_response(**kwargs):
+        pass
+    LazyClient('s3', event_handlers={'response-received': on_response}).list_buckets()
+    assert built[0].meta.events.registered == [('response-received', on_response)]
+
+
+def test_event_handlers_reach_existing_and_later_clients(built):
+    def on_call(**kwargs):
+        pass
+    existing = shared_client('s3')
+    register_event_handler('before-call', on_call)
+    later = shared_client('sqs')
+    assert existing.meta.events.registered == [('before-call', on_call)]
+    assert later.meta.events.registered == [('before-call', on_call)]
@@ -0,0 +1,85 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from conversion_ledger import (STATUS_CONVERTED, STATUS_ALREADY_TARGET, STATUS_QUEUED, STATUS_CONVERTING, SQLiteLedger,
+    ledger_record, lease_record, can_claim, is_converted, dispatch_key)
+
+KEY = 'connect/instance/CallRecordings/2024/05/01/contact.wav'
+NOW = 1_700_000_000
+
+
+def lease(status, owner, expires_at, etag='"1"'):
+    return dict(lease_record(KEY, etag, status, owner, 0, 100), lease_expires_at=expires_at)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+
+
+def test_unrecorded_or_changed_recording_can_be_claimed():
+    assert can_claim(None, '"1"', STATUS_QUEUED, 'run-1', NOW)
+    assert can_claim(ledger_record(KEY, '"1"', STATUS_CONVERTED, 100, 25), '"2"', STATUS_QUEUED, 'run-1', NOW)
+    assert can_claim(lease(STATUS_CONVERTING, 'message-1', NOW + 60), '"2"', STATUS_CONVERTING, 'message-2', NOW)
+
+
+@pytest.mark.parametrize('status', [STATUS_CONVERTED, STATUS_ALREADY_TARGET])
+def test_done_recording_is_not_claimed_again(status):
+    record = ledger_record(KEY, '"1"', status, 100, 25)
+    assert is_converted(record, '"1"')
+    assert not can_claim(record, '"1"', STATUS_QUEUED, 'run-1', NOW)
+    assert not can_claim(record, '"1"', STATUS_CONVERTING, 'message-1', NOW)
+
+
+def test_owner_claims_its_own_lease_again():
+    assert can_claim(lease(STATUS_QUEUED, 'run-1', NOW + 60), '"1"', STATUS_QUEUED, 'run-1', NOW)
+    assert can_claim(lease(STATUS_CONVERTING, 'message-1', NOW + 60), '"1"', STATUS_CONVERTING, 'message-1', NOW)
+
+
+def test_lease_of_another_owner_holds_until_it_expires():
+    assert not can_claim(lease(STATUS_QUEUED, 'run-1', NOW + 60), '"1"', STATUS_QUEUED, 'run-2', NOW)
+    assert not can_claim(lease(STATUS_CONVERTING, 'message-1', NOW), '"1"', STATUS_CONVERTING, 'message-2', NOW)
+    assert can_claim(lease(STATUS_CONVERTING, 'message-1', NOW - 1), '"1"', STATUS_CONVERTING, 'message-2', NOW)
+    assert can_claim(lease(STATUS_QUEUED, 'run-1', None), '"1"', STATUS_QUEUED, 'run-2', NOW)
+
+
+def test_queued_recording_is_taken_over_by_the_first_converter():
+    assert can_claim(lease(STATUS_QUEUED, 'run-1', NOW + 60), '"1"', STATUS_CONVERTING, 'message-1', NOW)
+    # a converting one is not queued again
+    assert not can_claim(lease(STATUS_CONVERTING, 'message-1', NOW + 60), '"1"', STATUS_QUEUED, 'run-2', NOW)
+
+
+def test_sqlite_ledger_claims_and_releases(ledger):
+    assert ledger.claim(KEY, '"1"', STATUS_QUEUED, 'run-1', 60, 100)
+    assert not ledger.claim(KEY, '"1"', STATUS_QUEUED, 'run-2', 60, 100)
+    assert ledger.claim(KEY, '"1"', STATUS_CONVERTING, 'message-1', 60, 100)
+    assert not ledger.claim(KEY, '"1"', STATUS_CONVERTING, 'message-2', 60, 100)
+    # only the owner releases its lease
+    ledger.release(KEY, '"1"', 'message-2')
+    assert ledger.get_many([KEY])[KEY]['lease_owner'] == 'message-1'
+    ledger.release(KEY, '"1"', 'message-1')
+    assert ledger.get_many([KEY]) == {}
+    assert ledger.claim(KEY, '"1"', STATUS_CONVERTING, 'message-2', 60, 100)
+
+
+def test_sqlite_ledger_keeps_converted_records(ledger):
+    assert ledger.claim(KEY, '"1"', STATUS_CONVERTING, 'message-1', 60, 100)
+    ledger.put(ledger_record(KEY, '"2"', STATUS_CONVERTED, 100, 25))
+    ledger.release(KEY, '"1"', 'message-1')
+    assert ledger.get_many([KEY])[KEY]['status'] == STATUS_CONVERTED
+    assert not ledger.claim(KEY, '"2"', STATUS_QUEUED, 'run-1', 60, 25)
+
+
+def test_expired_lease_is_taken_over(ledger):
+    assert ledger.claim(KEY, '"1"', STATUS_CONVERTING, 'message-1', -1, 100)
+    assert ledger.claim(KEY, '"1"', STATUS_CONVERTING, 'message-2', 60, 100)
+    assert ledger.get_many([KEY])[KEY]['lease_owner'] == 'message-2'
+
+
+def test_dispatch_key_names_one_version_of_a_recording():
+    assert dispatch_key(KEY, '"1"') == dispatch_key(KEY, '"1"')
+    assert dispatch_key(KEY, '"1"') != dispatch_key(KEY, '"2"')
+    assert dispatch_key(KEY, '"1"') != dispatch_key(f"{KEY}.bak", '"1"')
+    assert len(dispatch_key(KEY, '"1"')) == 32
@@ -0,0 +1,186 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from codec_profiles import get_profile
+from conversion_ledger import SQLiteLedger, STATUS_CONVERTING, dispatch_key
+from convert_pipeline import convert_recording, ConvertError
+from embedded_metrics import MetricsRecord
+from fake_aws import FakeS3, FakeSQS, client_error
+from recording_storage import S3Storage, upload_audio_stream_to_s3
+from corpus import connect_wav_header
+
+BUCKET = 'recordings'
+KEY = 'connect/instance/CallRecordings/2024/05/01/contact.wav'
+RECORDING = connect_wav_header(8000) + b'\x01\x00' * 4000
+
+
+@pytest.fixture
+def handler(load_handler):
+    return load_handler('convert', CONNECT_RECORDING_S3_BUCKET=BUCKET, S3_STORAGE_TIER='STANDARD_IA', CONVERT_MODE='tmp')
+
+
+@pytest.fixture
+def fake_s3(handler, monkeypatch):
+    fake_s3 = FakeS3()
+    fake_s3.add_object(BUCKET, KEY, RECORDING, ContentType='audio/wav', Metadata={})
+    monkeypatch.setattr(handler, 's3', fake_s3)
+    return fake_s3
+
+
+def storage(fake_s3):
+    return S3Storage(fake_s3, BUCKET, 'STANDARD_IA', 8 * 1024 * 1024, 64 * 1024 * 1024, 8 * 1024 * 1024, 4)
+
+
+def fake_ffmpeg(exit_status, output):
+    def convert_audio_file(url, input_file_path, output_file_path, profile):
+        if output is not None:
+            with open(output_file_path, 'wb') as f:
+                f.write(output)
+        return exit_status
+    return convert_audio_file
+
+
+@pytest.mark.parametrize('exit_status, output', [(1, b'partial'), (1, None), (0, None), (0, b'')])
+def test_failed_tmp_conversion_is_not_uploaded_or_recorded(handler, fake_s3, monkeypatch, tmp_path, exit_status, output):
+    monkeypatch.setattr(handler, 'convert_audio_file', fake_ffmpeg(exit_status, output))
+    ledger = SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+    with pytest.raises(ConvertError):
+        convert_recording(storage(fake_s3), KEY, get_profile('alaw-8k'), MetricsRecord('convert'), ledger,
+            {'header_probe': False}, handler.convert_through_tmp, 'message-1')
+    assert 'PutObject' not in fake_s3.requests
+    assert fake_s3.objects[(BUCKET, KEY)]['Body'] == RECORDING
+    # the lease is released, the redelivered message converts the recording
+    assert ledger.get_many([KEY]) == {}
+
+
+def test_tmp_conversion_records_the_uploaded_object(handler, fake_s3, monkeypatch, tmp_path):
+    monkeypatch.setattr(handler, 'convert_audio_file', fake_ffmpeg(0, b'converted'))
+    ledger = SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+    result = convert_recording(storage(fake_s3), KEY, get_profile('alaw-8k'), MetricsRecord('convert'), ledger,
+        {'header_probe': False}, handler.convert_through_tmp, 'message-1')
+    assert result['outcome'] == 'converted'
+    assert fake_s3.objects[(BUCKET, KEY)]['Body'] == b'converted'
+    record = ledger.get_many([KEY])[KEY]
+    assert (record['status'], record['etag'], record['converted_size']) == ('converted', result['etag'], len(b'converted'))
+
+
+KMS_SOURCE = {'ServerSideEncryption': 'aws:kms', 'SSEKMSKeyId': 'arn:aws:kms:us-east-1:111122223333:key/recordings',
+    'BucketKeyEnabled': True}
+
+
+def kms_recording(fake_s3, monkeypatch):
+    # the fake keeps only some attributes of a write, the arguments of every write are kept here
+    fake_s3.add_object(BUCKET, KEY, RECORDING, ContentType='audio/wav', Metadata={}, **KMS_SOURCE)
+    writes = []
+    for operation in ('put_object', 'upload_file', 'create_multipart_upload'):
+        def record(*args, _write=getattr(fake_s3, operation), _operation=operation, **kwargs):
+            writes.append((_operation, kwargs.get('ExtraArgs', kwargs)))
+            return _write(*args, **kwargs)
+        monkeypatch.setattr(fake_s3, operation, record)
+    return writes
+
+
+def test_tmp_conversion_of_a_kms_recording_with_a_bucket_key(handler, fake_s3, monkeypatch, tmp_path):
+    writes = kms_recording(fake_s3, monkeypatch)
+    monkeypatch.setattr(handler, 'convert_audio_file', fake_ffmpeg(0, b'converted'))
+    result = convert_recording(storage(fake_s3), KEY, get_profile('alaw-8k'), MetricsRecord('convert'), None,
+        {'header_probe': False}, handler.convert_through_tmp)
+    assert result['outcome'] == 'converted'
+    [(operation, extra_args)] = writes
+    assert operation == 'upload_file'
+    assert extra_args['ServerSideEncryption'] == 'aws:kms'
+    assert extra_args['SSEKMSKeyId'] == KMS_SOURCE['SSEKMSKeyId']
+    assert 'BucketKeyEnabled' not in extra_args
+
+
+def test_streamed_conversion_of_a_kms_recording_keeps_the_bucket_key(handler, fake_s3, monkeypatch):
+    pytest.importorskip('numpy')
+    writes = kms_recording(fake_s3, monkeypatch)
+    result = convert_recording(storage(fake_s3), KEY, get_profile('alaw-8k'), MetricsRecord('convert'), None,
+        {'header_probe': False})
+    assert result['outcome'] == 'converted'
+    [(operation, arguments)] = writes
+    assert operation == 'put_object'
+    assert {name: arguments[name] for name in KMS_SOURCE} == KMS_SOURCE
+
+
+def test_failed_multipart_upload_raises_its_own_error_when_the_abort_fails(fake_s3, monkeypatch):
+    def upload_part(*args, **kwargs):
+        raise client_error('SlowDown', 'UploadPart')
+
+    def abort_multipart_upload(*args, **kwargs):
+        fake_s3.count('AbortMultipartUpload')
+        raise client_error('AccessDenied', 'AbortMultipartUpload')
+    monkeypatch.setattr(fake_s3, 'upload_part', upload_part)
+    monkeypatch.setattr(fake_s3, 'abort_multipart_upload', abort_multipart_upload)
+    chunks = [b'\x01' * 4096] * 4
+    with pytest.raises(ClientError) as error:
+        upload_audio_stream_to_s3(fake_s3, chunks, BUCKET, KEY, 4096, {}, None, get_profile('alaw-8k'))
+    assert error.value.response['Error']['Code'] == 'SlowDown'
+    assert fake_s3.requests['AbortMultipartUpload'] == 1
+    assert fake_s3.objects[(BUCKET, KEY)]['Body'] == RECORDING
+
+
+@pytest.fixture
+def queued(handler, fake_s3, monkeypatch, tmp_path):
+    # the handler with a ledger, a queue and a working ffmpeg
+    monkeypatch.setattr(handler, 'ledger', SQLiteLedger(str(tmp_path / 'ledger.sqlite')))
+    monkeypatch.setattr(handler, 'sqs', FakeSQS())
+    monkeypatch.setattr(handler, 'convert_audio_file', fake_ffmpeg(0, b'converted'))
+    return handler
+
+
+def message(message_id, etag, receive_count=1):
+    return {'messageId': message_id, 'receiptHandle': f"handle-{message_id}", 'body': json.dumps(KEY),
+        'messageAttributes': {'dispatch_key': {'stringValue': dispatch_key(KEY, etag), 'dataType': 'String'}},
+        'attributes': {'ApproximateReceiveCount': str(receive_count)}}
+
+
+def test_message_of_a_version_leased_elsewhere_is_kept_until_the_lease_ends(queued, fake_s3):
+    etag = fake_s3.objects[(BUCKET, KEY)]['ETag']
+    assert queued.ledger.claim(KEY, etag, STATUS_CONVERTING, 'message-a', 600, len(RECORDING))
+    response = queued.lambda_handler({'Records': [message('message-b', etag)]}, None)
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'message-b'}]
+    assert dispatch_key(KEY, etag) not in queued.completed_versions
+    assert 1 <= queued.sqs.visibility['handle-message-b'] <= 600
+    assert fake_s3.objects[(BUCKET, KEY)]['Body'] == RECORDING
+    # the holder fails, the message it left behind converts the recording
+    queued.ledger.release(KEY, etag, 'message-a')
+    response = queued.lambda_handler({'Records': [message('message-b', etag, 2)]}, None)
+    assert response['batchItemFailures'] == []
+    assert fake_s3.objects[(BUCKET, KEY)]['Body'] == b'converted'
+    assert queued.ledger.get_many([KEY])[KEY]['status'] == 'converted'
+
+
+def test_expired_lease_brings_the_message_back_at_once(queued, fake_s3):
+    etag = fake_s3.objects[(BUCKET, KEY)]['ETag']
+    queued.ledger.claim(KEY, etag, STATUS_CONVERTING, 'message-a', 600, len(RECORDING))
+    queued.delay_record(message('message-b', etag), 1, time.time() - 10)
+    assert queued.sqs.visibility['handle-message-b'] == 1
+
+
+def test_second_message_of_a_version_in_a_batch_waits_for_the_first(queued, fake_s3):
+    etag = fake_s3.objects[(BUCKET, KEY)]['ETag']
+    response = queued.lambda_handler({'Records': [message('message-a', etag), message('message-b', etag)]}, None)
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'message-b'}]
+    assert 'handle-message-b' in queued.sqs.visibility
+    assert fake_s3.objects[(BUCKET, KEY)]['Body'] == b'converted'
+    # back after the first is converted, it is dropped without a request
+    requests = dict(fake_s3.requests)
+    response = queued.lambda_handler({'Records': [message('message-b', etag, 2)]}, None)
+    assert response['batchItemFailures'] == []
+    assert fake_s3.requests == requests
+
+
+def test_failed_conversion_is_not_remembered(queued, fake_s3, monkeypatch):
+    etag = fake_s3.objects[(BUCKET, KEY)]['ETag']
+    monkeypatch.setattr(queued, 'convert_audio_file', fake_ffmpeg(1, None))
+    response = queued.lambda_handler({'Records': [message('message-a', etag)]}, None)
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'message-a'}]
+    assert dispatch_key(KEY, etag) not in queued.completed_versions
@@ -0,0 +1,54 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import random
+
+import pytest
+
+pytest.importorskip('numpy')
+
+import convert_local
+from codec_profiles import get_profile, is_profile_output, read_audio_format
+from conversion_ledger import SQLiteLedger
+from corpus import make_recording
+
+
+@pytest.fixture
+def tree(tmp_path):
+    rng = random.Random(1)
+    source = tmp_path / 'recordings'
+    (source / '2024' / '05').mkdir(parents=True)
+    recordings = {f"2024/05/{name}.wav": make_recording(2, rng) for name in ('a', 'b')}
+    for key, body in recordings.items():
+        (source / key).write_bytes(body)
+    (source / '2024' / 'notes.txt').write_text('not a recording')
+    return source, recordings
+
+
+def test_converts_a_tree_into_an_output_tree_and_skips_it_on_a_rerun(tree, tmp_path, capsys):
+    source, recordings = tree
+    output = tmp_path / 'converted'
+    assert convert_local.main([str(source), '--output', str(output), '--workers', '1']) == 0
+    profile = get_profile('alaw-8k')
+    for key, body in recordings.items():
+        converted = (output / key).read_bytes()
+        assert is_profile_output(read_audio_format(converted), profile)
+        # 16-bit stereo to 8-bit mono, a quarter of the samples' bytes
+        assert len(converted) < len(body) / 3
+        # the originals are left as they are
+        assert (source / key).read_bytes() == body
+    assert not (output / '2024' / 'notes.txt').exists()
+    ledger = SQLiteLedger(str(output / convert_local.LEDGER_FILE))
+    assert {record['status'] for record in ledger.get_many(list(recordings)).values()} == {'converted'}
+    capsys.readouterr()
+
+    outputs = {key: (output / key).stat().st_mtime_ns for key in recordings}
+    assert convert_local.main([str(source), '--output', str(output), '--workers', '1']) == 0
+    assert outputs == {key: (output / key).stat().st_mtime_ns for key in recordings}
+
+
+def test_converts_in_place(tree):
+    source, recordings = tree
+    assert convert_local.main([str(source), '--workers', '1']) == 0
+    for key in recordings:
+        assert is_profile_output(read_audio_format((source / key).read_bytes()), get_profile('alaw-8k'))
@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import gzip
+import json
+
+import pytest
+
+import aws_clients
+import handler_profiler
+from handler_profiler import profile_requested
+from fake_aws import FakeS3, FakeSQS
+
+BUCKET = 'recordings'
+DAY_PREFIX = 'connect/instance/CallRecordings/2024/05/01/'
+
+
+def test_profile_is_requested_by_the_event_the_iterator_output_or_a_message():
+    assert profile_requested({'profile': True})
+    assert profile_requested({'iterator': {'files': '', 'profile': True}})
+    assert profile_requested({'Records': [{'messageAttributes': {}},
+        {'messageAttributes': {'profile': {'stringValue': 'True', 'dataType': 'String'}}}]})
+
+
+@pytest.mark.parametrize('event', [None, [], {}, {'profile': False}, {'iterator': {'profile': False}}, {'iterator': ''},
+    {'Records': [{'messageAttributes': {'profile': {'stringValue': 'false', 'dataType': 'String'}}}]}, {'Records': None}])
+def test_profile_is_not_requested(event):
+    assert not profile_requested(event)
+
+
+def test_execution_input_asks_every_day_to_be_profiled(load_handler):
+    iterator = load_handler('iterator-step')
+    days = iterator.plan_days({'start_date': '05/01/2024', 'end_date': '05/02/2024', 'profile': True}, 0)
+    assert [day['profile'] for day in days] == [True, True]
+    assert not iterator.plan_days({'specific_date': '05/01/2024'}, 0)[0]['profile']
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(handler_profiler, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(handler_profiler, 'PROFILE_BUCKET', None)
+    # the hooks of the profile are registered on clients of this test only
+    monkeypatch.setattr(handler_profiler, '_hooks_registered', False)
+    monkeypatch.setattr(aws_clients, '_event_handlers', [])
+    return tmp_path
+
+
+@pytest.fixture
+def queue(load_handler, monkeypatch):
+    queue = load_handler('iterator-queue', CONNECT_RECORDING_S3_BUCKET=BUCKET, CONNECT_RECORDING_CONVERT_QUEUE='convert')
+    monkeypatch.setattr(queue, 's3', FakeS3())
+    monkeypatch.setattr(queue, 'sqs', FakeSQS())
+    return queue
+
+
+@pytest.fixture
+def files(queue):
+    # the page of the iterator, two recordings not converted yet
+    files = []
+    for name in ('a.wav', 'b.wav'):
+        queue.s3.add_object(BUCKET, f"{DAY_PREFIX}{name}", b'RIFF')
+        files.append({'Key': f"{DAY_PREFIX}{name}", 'Size': 4, 'ETag': queue.s3.objects[(BUCKET, f"{DAY_PREFIX}{name}")]['ETag']})
+    return files
+
+
+def iterator_output(files, profile):
+    return {'iterator': {'files': files, 'NextContinuationToken': '', 'specific_date': '05/01/2024', 'day': '2024-05-01',
+        'run_id': 'run-1', 'profile': profile, 'shard': {'prefix': DAY_PREFIX, 'start_after': '', 'end_before': '', 'delimiter': ''}}}
+
+
+def test_profiled_execution_profiles_the_queue_lambda_and_its_messages(queue, files, profile_dir):
+    assert queue.lambda_handler(iterator_output(files, True), None)['key_count'] == 2
+    messages = queue.sqs.receive_messages(10)
+    assert [message['messageAttributes']['run_id']['stringValue'] for message in messages] == ['run-1', 'run-1']
+    assert profile_requested({'Records': messages})
+    [path] = profile_dir.glob('enqueue/*/*/*/*.json.gz')
+    with gzip.open(path) as f:
+        artifact = json.load(f)
+    assert (artifact['stage'], artifact['trigger']) == ('enqueue', 'event')
+
+
+def test_execution_without_profile_sends_plain_messages(queue, files, profile_dir):
+    queue.lambda_handler(iterator_output(files, False), None)
+    messages = queue.sqs.receive_messages(10)
+    assert len(messages) == 2
+    assert not profile_requested({'Records': messages})
+    assert list(profile_dir.iterdir()) == []
@@ -0,0 +1,158 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import re
+
+import pytest
+from botocore.exceptions import ClientError
+
+from listing_checkpoints import ListingCheckpoints, STATUS_LISTED, page_hash, chain_hash, shard_id, serialize, deserialize
+from listing_shards import shard
+from pending_index import index_shard
+
+DAY = '2024-05-01'
+SHARD = shard('connect/instance/CallRecordings/2024/05/01/', '', '')
+PAGE = [{'Key': 'a.wav', 'ETag': '"1"'}, {'Key': 'b.wav', 'ETag': '"2"'}]
+NEXT_PAGE = [{'Key': 'c.wav', 'ETag': '"3"'}]
+
+
+class FakeCheckpointTable:
+    # The checkpoint table, with the condition and update expressions ListingCheckpoints writes
+
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get(self.key(Key))
+        return {'Item': serialize(item)} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None):
+        item = deserialize(Item)
+        if ConditionExpression and self.key(Item) in self.items:
+            raise conditional_check_failed()
+        self.items[self.key(Item)] = item
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues,
+            ExpressionAttributeNames=None, ReturnValues=None):
+        item = self.items[self.key(Key)]
+        values = deserialize(ExpressionAttributeValues)
+        names = ExpressionAttributeNames or {}
+        for name, value in re.findall(r'(\w+) = (:\w+)', ConditionExpression):
+            if item.get(name) != values[value]:
+                raise conditional_check_failed()
+        if '<> :page' in ConditionExpression and item.get('last_page_hash') == values[':page']:
+            raise conditional_check_failed()
+        assignments, _, additions = UpdateExpression.removeprefix('SET ').partition(' ADD ')
+        for assignment in assignments.split(', '):
+            name, value = assignment.split(' = ')
+            item[names.get(name, name)] = values[value]
+        for addition in filter(None, additions.split(', ')):
+            name, value = addition.split(' ')
+            item[name] = item.get(name, 0) + values[value]
+        return {'Attributes': serialize(item)}
+
+    @staticmethod
+    def key(values):
+        return tuple(value['S'] for name, value in sorted(values.items()) if name in ('day', 'shard'))
+
+
+class FakeStepFunctions:
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def describe_execution(self, executionArn):
+        return {'status': self.statuses[executionArn.rsplit(':', 1)[1]]}
+
+
+def conditional_check_failed():
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}, 'UpdateItem')
+
+
+@pytest.fixture
+def table():
+    return FakeCheckpointTable()
+
+
+def open_checkpoints(table, statuses=None):
+    return ListingCheckpoints('checkpoints', 'arn:aws:states:us-east-1:123456789012:execution:iterator', table,
+        FakeStepFunctions(statuses or {}))
+
+
+def test_first_execution_lists_the_shard_from_its_start(table):
+    checkpoint = open_checkpoints(table).start('run-1', DAY, SHARD)
+    assert checkpoint['run_id'] == 'run-1'
+    assert checkpoint['last_key'] == ''
+    assert table.items[(DAY, shard_id(SHARD))]['status'] == 'listing'
+
+
+def test_advance_counts_each_page_once(table):
+    checkpoints = open_checkpoints(table)
+    checkpoints.start('run-1', DAY, SHARD)
+    assert checkpoints.advance('run-1', DAY, SHARD, 'b.wav', page_hash(PAGE), 'token', 2, 2)
+    # a retried step enqueues the same page again
+    assert not checkpoints.advance('run-1', DAY, SHARD, 'b.wav', page_hash(PAGE), 'token', 2, 2)
+    assert checkpoints.advance('run-1', DAY, SHARD, 'c.wav', page_hash(NEXT_PAGE), '', 1, 1)
+    item = table.items[(DAY, shard_id(SHARD))]
+    assert (item['keys_listed'], item['keys_enqueued'], item['pages']) == (3, 3, 2)
+    assert item['status'] == STATUS_LISTED
+    assert item['last_key'] == 'c.wav'
+    assert item['page_chain'] == chain_hash(chain_hash('', page_hash(PAGE)), page_hash(NEXT_PAGE))
+
+
+def test_execution_resumes_after_the_last_key_of_a_finished_one(table):
+    open_checkpoints(table).start('run-1', DAY, SHARD)
+    open_checkpoints(table).advance('run-1', DAY, SHARD, 'b.wav', page_hash(PAGE), 'token', 2, 2)
+    checkpoints = open_checkpoints(table, {'run-1': 'TIMED_OUT'})
+    checkpoint = checkpoints.start('run-2', DAY, SHARD)
+    assert checkpoint['run_id'] == 'run-2'
+    assert checkpoint['resumed_from'] == 'run-1'
+    assert checkpoint['last_key'] == 'b.wav'
+    # the earlier execution no longer advances it
+    assert not checkpoints.advance('run-1', DAY, SHARD, 'c.wav', page_hash(NEXT_PAGE), '', 1, 1)
+    assert checkpoints.advance('run-2', DAY, SHARD, 'c.wav', page_hash(NEXT_PAGE), '', 1, 1)
+
+
+def test_running_execution_keeps_its_checkpoint(table):
+    open_checkpoints(table).start('run-1', DAY, SHARD)
+    assert open_checkpoints(table, {'run-1': 'RUNNING'}).start('run-2', DAY, SHARD) is None
+    assert table.items[(DAY, shard_id(SHARD))]['run_id'] == 'run-1'
+
+
+def test_retried_step_gets_its_own_checkpoint_back(table):
+    checkpoints = open_checkpoints(table)
+    checkpoints.start('run-1', DAY, SHARD)
+    checkpoints.advance('run-1', DAY, SHARD, 'b.wav', page_hash(PAGE), 'token', 2, 2)
+    assert checkpoints.start('run-1', DAY, SHARD)['last_key'] == 'b.wav'
+
+
+def test_restart_lists_the_shard_again(table):
+    checkpoints = open_checkpoints(table)
+    checkpoints.start('run-1', DAY, SHARD)
+    checkpoints.advance('run-1', DAY, SHARD, 'b.wav', page_hash(PAGE), '', 2, 2)
+    checkpoint = checkpoints.start('run-2', DAY, SHARD, restart=True)
+    assert checkpoint['last_key'] == ''
+    assert table.items[(DAY, shard_id(SHARD))]['keys_listed'] == 0
+
+
+@pytest.fixture
+def iterator(load_handler, monkeypatch, table):
+    iterator = load_handler('iterator-step')
+    monkeypatch.setattr(iterator, 'checkpoints', open_checkpoints(table, {'run-1': 'FAILED'}))
+    return iterator
+
+
+def test_listing_shard_resumes_after_the_last_key(iterator):
+    iterator.checkpoints.start('run-1', DAY, SHARD)
+    iterator.checkpoints.advance('run-1', DAY, SHARD, 'b.wav', page_hash(PAGE), 'token', 2, 2)
+    assert iterator.resume_point({'run_id': 'run-2', 'day': DAY}, SHARD) == 'b.wav'
+    assert iterator.resume_point({'day': DAY}, SHARD) == ''
+
+
+def test_index_shard_resumes_after_the_sort_key_and_skips_once_listed(iterator):
+    index = index_shard(f"{DAY}#0", '2024-05-01T00:00:00Z', '2024-05-02T00:00:00Z')
+    iterator.checkpoints.start('run-1', DAY, index)
+    iterator.checkpoints.advance('run-1', DAY, index, 'b.wav', page_hash(PAGE), '2024-05-01T08:00:00Z#b.wav', 2, 2)
+    assert iterator.resume_point({'run_id': 'run-2', 'day': DAY}, index) == '2024-05-01T08:00:00Z#b.wav'
+    iterator.checkpoints.advance('run-2', DAY, index, 'c.wav', page_hash(NEXT_PAGE), '', 1, 1)
+    assert iterator.resume_point({'run_id': 'run-2', 'day': DAY}, index) == index['end_before']
@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+from fake_aws import FakeS3
+from listing_pages import PAGE_FORMAT, encode_page, decode_page, store_page, load_page, page_count
+
+DAY_PREFIX = 'connect/instance/CallRecordings/2024/05/01/'
+OBJECTS = [
+    {'Key': f"{DAY_PREFIX}0a1b.wav", 'Size': 320044, 'ETag': '"9e107d9d372bb6826bd81d3542a419d6"'},
+    {'Key': f"{DAY_PREFIX}0a1c.wav", 'Size': 44, 'ETag': '"e4d909c290d0fb1ca068ffaddf22cbd0"'},
+    {'Key': f"{DAY_PREFIX}0a1c.wav.bak", 'Size': 0, 'ETag': '"d41d8cd98f00b204e9800998ecf8427e"'},
+    {'Key': 'connect/other/ä.wav', 'Size': 7, 'ETag': '"d41d8cd98f00b204e9800998ecf8427e-2"'},
+]
+
+
+def test_page_round_trips():
+    assert decode_page(encode_page(OBJECTS)) == OBJECTS
+    assert decode_page(encode_page([])) == []
+
+
+def test_keys_are_front_coded_and_etags_unquoted():
+    page = encode_page(OBJECTS)
+    assert page['format'] == PAGE_FORMAT
+    assert page['count'] == 4
+    assert page['shared'] == [0, len(DAY_PREFIX) + 3, len(DAY_PREFIX) + 8, len('connect/')]
+    assert page['suffixes'][:3] == [f"{DAY_PREFIX}0a1b.wav", 'c.wav', '.bak']
+    assert page['etags'][0] == '9e107d9d372bb6826bd81d3542a419d6'
+
+
+def test_small_page_is_inline():
+    s3 = FakeS3()
+    page = store_page(OBJECTS, s3, 'work', 'pages/run/1.json')
+    assert 'location' not in page
+    assert s3.objects == {}
+    assert load_page(page, s3) == OBJECTS
+    assert page_count(page) == 4
+
+
+def test_large_page_is_written_to_the_work_bucket():
+    s3 = FakeS3()
+    page = store_page(OBJECTS, s3, 'work', 'pages/run/1.json', inline_limit=100)
+    assert page == {'format': PAGE_FORMAT, 'count': 4, 'location': {'bucket': 'work', 'key': 'pages/run/1.json'}}
+    assert json.loads(s3.objects[('work', 'pages/run/1.json')]['Body']) == encode_page(OBJECTS)
+    assert load_page(page, s3) == OBJECTS
+    assert page_count(page) == 4
+
+
+def test_large_page_stays_inline_without_a_work_bucket():
+    s3 = FakeS3()
+    page = store_page(OBJECTS, s3, None, 'pages/run/1.json', inline_limit=100)
+    assert 'location' not in page
+    assert s3.objects == {}
+
+
+def test_plain_list_from_before_the_compact_form_is_read_as_is():
+    assert load_page(OBJECTS, None) is OBJECTS
+    assert page_count(OBJECTS) == 4
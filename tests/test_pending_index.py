@@ -0,0 +1,164 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import pending_index
+from conversion_ledger import STATUS_CONVERTED, STATUS_CONVERTING, ledger_record, lease_record
+from pending_index import (PendingIndex, PENDING_INDEX_PARTITIONS, PENDING_RETENTION_DAYS, due_window, index_shards,
+    pending_entry, partition_of, format_time, parse_time)
+
+PREFIX = 'connect/instance/CallRecordings/'
+NOW = datetime(2024, 5, 8, 9, 42, 17, tzinfo=timezone.utc)
+
+
+class FakePendingTable:
+    # The pending index table, with the key condition PendingIndex queries it with
+
+    def __init__(self, unprocessed=0):
+        self.partitions = {}
+        self.batch_sizes = []
+        # the number of requests that leave their last item unprocessed
+        self.unprocessed = unprocessed
+
+    def batch_write_item(self, RequestItems):
+        [(table_name, requests)] = RequestItems.items()
+        self.batch_sizes.append(len(requests))
+        written, left = requests, []
+        if self.unprocessed:
+            self.unprocessed -= 1
+            written, left = requests[:-1], requests[-1:]
+        for request in written:
+            item = request['PutRequest']['Item']
+            self.partitions.setdefault(item['day']['S'], {})[item['created']['S']] = item
+        return {'UnprocessedItems': {table_name: left} if left else {}}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, Limit,
+            ExclusiveStartKey=None):
+        values = ExpressionAttributeValues
+        items = self.partitions.get(values[':day']['S'], {})
+        keys = sorted(key for key in items if values[':start']['S'] <= key <= values[':end']['S'])
+        if ExclusiveStartKey:
+            keys = [key for key in keys if key > ExclusiveStartKey['created']['S']]
+        response = {'Items': [items[key] for key in keys[:Limit]]}
+        if len(keys) > Limit:
+            response['LastEvaluatedKey'] = {'day': values[':day'], 'created': {'S': keys[Limit - 1]}}
+        return response
+
+
+def created(moment):
+    return format_time(moment)
+
+
+def add_recordings(index, times):
+    entries = [pending_entry(f"{PREFIX}{i:03d}.wav", 1000 + i, f'"{i}"', created(moment), 7) for i, moment in enumerate(times)]
+    index.add(entries)
+    return entries
+
+
+def read_shard(index, listing_shard, max_keys):
+    # every page of a shard, as the iterator reads them
+    pages, token = [], ''
+    while True:
+        objects, token = index.list_page(listing_shard, max_keys, token)
+        pages.append(objects)
+        if not token:
+            return pages
+
+
+def test_due_window_ends_at_the_hour_age_days_ago():
+    start, end = due_window(7, 24, 1, NOW)
+    assert end == datetime(2024, 5, 1, 9, tzinfo=timezone.utc)
+    assert start == end - timedelta(hours=25)
+
+
+def test_index_shards_cover_every_partition_of_every_day_touched():
+    start, end = due_window(7, 24, 1, NOW)
+    shards = index_shards(start, end)
+    assert [shard['partition'] for shard in shards] == [f"{day}#{number}"
+        for day in ('2024-04-30', '2024-05-01') for number in range(PENDING_INDEX_PARTITIONS)]
+    assert {(shard['start_after'], shard['end_before']) for shard in shards} == {('2024-04-30T08:00:00Z', '2024-05-01T09:00:00Z')}
+
+
+def test_window_ending_at_midnight_stays_in_its_day():
+    shards = index_shards(datetime(2024, 5, 1, tzinfo=timezone.utc), datetime(2024, 5, 2, tzinfo=timezone.utc))
+    assert {shard['partition'][:10] for shard in shards} == {'2024-05-01'}
+
+
+def test_entry_is_partitioned_by_day_and_sorted_by_creation_time():
+    entry = pending_entry(f"{PREFIX}a.wav", 1000, '"1"', '2024-05-01T08:30:00Z', 7)
+    assert entry['day'] == partition_of(f"{PREFIX}a.wav", '2024-05-01T08:30:00Z')
+    assert entry['day'].startswith('2024-05-01#')
+    assert entry['created'] == f"2024-05-01T08:30:00Z#{PREFIX}a.wav"
+    assert entry['expires_at'] == int((parse_time('2024-05-01T08:30:00Z') + timedelta(days=7 + PENDING_RETENTION_DAYS)).timestamp())
+
+
+@pytest.fixture
+def single_partition(monkeypatch):
+    monkeypatch.setattr(pending_index, 'PENDING_INDEX_PARTITIONS', 1)
+
+
+def test_window_is_read_from_its_start_up_to_its_end(single_partition):
+    index = PendingIndex('pending', FakePendingTable())
+    start, end = due_window(7, 24, 0, NOW)
+    times = [start - timedelta(seconds=1), start, start + timedelta(hours=3), end - timedelta(seconds=1), end, end + timedelta(hours=1)]
+    entries = add_recordings(index, times)
+    # the window crosses midnight, its start is in the partition of the day before
+    objects = [obj for shard in index_shards(start, end) for page in read_shard(index, shard, 100) for obj in page]
+    assert [obj['Key'] for obj in objects] == [entry['key'] for entry in entries[1:4]]
+    assert objects[0] == {'Key': entries[1]['key'], 'Size': 1001, 'ETag': '"1"'}
+
+
+def test_shard_is_read_in_pages_of_max_keys(single_partition):
+    index = PendingIndex('pending', FakePendingTable())
+    start, end = due_window(7, 6, 0, NOW)
+    entries = add_recordings(index, [start + timedelta(minutes=7 * i) for i in range(11)])
+    [shard] = index_shards(start, end)
+    pages = read_shard(index, shard, 4)
+    assert [len(page) for page in pages] == [4, 4, 3]
+    assert [obj['Key'] for page in pages for obj in page] == [entry['key'] for entry in entries]
+    # a checkpoint continues after the sort key it recorded
+    objects, _ = index.list_page(shard, 100, entries[8]['created'])
+    assert [obj['Key'] for obj in objects] == [entry['key'] for entry in entries[9:]]
+
+
+def test_entries_are_written_25_at_a_time_until_all_are_processed(single_partition):
+    table = FakePendingTable(unprocessed=1)
+    index = PendingIndex('pending', table)
+    start, end = due_window(7, 24, 0, NOW)
+    entries = add_recordings(index, [start + timedelta(seconds=i) for i in range(30)])
+    assert table.batch_sizes == [25, 1, 5]
+    assert sum(len(items) for items in table.partitions.values()) == len(entries)
+
+
+def test_key_written_twice_in_one_second_keeps_the_later_etag(single_partition):
+    table = FakePendingTable()
+    moment = created(NOW)
+    PendingIndex('pending', table).add([pending_entry(f"{PREFIX}a.wav", 1, '"1"', moment, 7), pending_entry(f"{PREFIX}a.wav", 2, '"2"', moment, 7)])
+    assert table.batch_sizes == [1]
+    [item] = table.partitions[f"{moment[:10]}#0"].values()
+    assert item['etag'] == {'S': '"2"'}
+
+
+@pytest.fixture
+def ingest(load_handler):
+    return load_handler('ingest')
+
+
+def test_converted_recording_is_an_own_write(ingest):
+    key = f"{PREFIX}a.wav"
+    assert not ingest.is_own_write(None, '"1"', 0)
+    assert ingest.is_own_write(ledger_record(key, '"2"', STATUS_CONVERTED, 100, 25), '"2"', 0)
+    # a recording written again after it was converted is new work
+    assert not ingest.is_own_write(ledger_record(key, '"2"', STATUS_CONVERTED, 100, 25), '"3"', 0)
+
+
+def test_write_under_a_convert_lease_is_an_own_write_until_it_expires(ingest):
+    record = lease_record(f"{PREFIX}a.wav", '"1"', STATUS_CONVERTING, 'message-1', 0, 100)
+    expires_at = record['lease_expires_at']
+    assert ingest.is_own_write(record, '"2"', expires_at)
+    assert not ingest.is_own_write(record, '"2"', expires_at + 1)
+    # the original itself, announced again, is not
+    assert not ingest.is_own_write(record, '"1"', expires_at)
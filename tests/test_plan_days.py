@@ -0,0 +1,43 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def iterator(load_handler):
+    return load_handler('iterator-step')
+
+
+def test_range_is_expanded_with_both_ends(iterator):
+    days = iterator.plan_days({'start_date': '02/27/2024', 'end_date': '03/01/2024'}, 7)
+    assert [day['day'] for day in days] == ['2024-02-27', '2024-02-28', '2024-02-29', '2024-03-01']
+    assert [day['date'] for day in days][0] == '02/27/2024'
+
+
+def test_range_without_an_end_is_its_start_day(iterator):
+    assert [day['day'] for day in iterator.plan_days({'start_date': '05/01/2024'}, 7)] == ['2024-05-01']
+
+
+def test_inverted_range_is_rejected(iterator):
+    with pytest.raises(ValueError, match='end_date 04/30/2024 is before start_date 05/01/2024'):
+        iterator.plan_days({'start_date': '05/01/2024', 'end_date': '04/30/2024'}, 7)
+
+
+def test_dates_are_sorted_and_deduplicated(iterator):
+    days = iterator.plan_days({'dates': ['05/02/2024', '05/01/2024', '05/02/2024'], 'restart': True}, 7)
+    assert [(day['day'], day['restart']) for day in days] == [('2024-05-01', True), ('2024-05-02', True)]
+
+
+def test_no_date_is_the_day_num_days_age_ago(iterator):
+    [day] = iterator.plan_days({'specific_date': ''}, 7)
+    assert day['day'] == (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+    assert day['source'] == 'listing'
+
+
+def test_index_is_read_only_for_the_scheduled_day_when_deployed(iterator):
+    assert iterator.plan_days({'specific_date': '', 'source': 'index'}, 7, index_available=True)[0]['source'] == 'index'
+    assert iterator.plan_days({'specific_date': '', 'source': 'index'}, 7)[0]['source'] == 'listing'
+    assert iterator.plan_days({'specific_date': '05/01/2024', 'source': 'index'}, 7, index_available=True)[0]['source'] == 'listing'
@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import re
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conversion_ledger import SQLiteLedger
+from corpus import connect_wav_header
+from fake_aws import FakeS3, FakeSQS
+from run_progress import RunProgress, run_key
+
+BUCKET = 'recordings'
+DAY_PREFIX = 'connect/instance/CallRecordings/2024/05/01/'
+RECORDING = connect_wav_header(8000) + b'\x01\x00' * 4000
+
+
+class FakeRunsTable:
+    # The runs table, with the update and condition expressions RunProgress writes
+
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+            ConditionExpression=None, ReturnValues='NONE'):
+        names = ExpressionAttributeNames or {}
+        item = self.items.setdefault(self.key(Key), dict(Key))
+        self.check(item, ConditionExpression, names)
+        old = {}
+        for action, clause in re.findall(r'(ADD|SET) (.*?)(?= ADD | SET |$)', UpdateExpression):
+            for assignment in clause.split(', '):
+                name, value = re.split(r' = | ', assignment)
+                name, value = names.get(name, name), ExpressionAttributeValues[value]
+                if name in item:
+                    old[name] = item[name]
+                if action == 'SET':
+                    item[name] = value
+                elif 'SS' in value:
+                    item[name] = {'SS': sorted(set(item.get(name, {'SS': []})['SS']) | set(value['SS']))}
+                else:
+                    item[name] = {'N': str(int(item.get(name, {'N': '0'})['N']) + int(value['N']))}
+        return {'Attributes': dict(item) if ReturnValues == 'ALL_NEW' else old}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None):
+        self.check(self.items.get(self.key(Item)), ConditionExpression, ExpressionAttributeNames or {})
+        self.items[self.key(Item)] = dict(Item)
+
+    def check(self, item, condition, names):
+        for name in re.findall(r'attribute_not_exists\((#?\w+)\)', condition or ''):
+            if item is not None and names.get(name, name) in item:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}, 'UpdateItem')
+
+    def counts(self, run_id):
+        item = self.items.get(self.key(run_key(run_id)), {})
+        return {name: int(item.get(name, {'N': '0'})['N']) for name in ('expected', 'completed', 'failed')}
+
+    @staticmethod
+    def key(values):
+        return values['run_id']['S'], values['item']['S']
+
+
+class FakeStepFunctions:
+
+    def __init__(self):
+        self.task_successes = []
+
+    def send_task_success(self, taskToken, output):
+        self.task_successes.append(json.loads(output))
+
+
+@pytest.fixture
+def table():
+    return FakeRunsTable()
+
+
+@pytest.fixture
+def progress(table):
+    return RunProgress('runs', table, FakeStepFunctions())
+
+
+def test_versions_sent_again_are_expected_once(progress, table):
+    progress.add_expected_versions('run-1', 'page-1', ['a', 'b', 'c'])
+    progress.add_expected_versions('run-1', 'page-1', ['b', 'c', 'd'])
+    progress.add_expected_versions('run-1', 'page-2', [])
+    assert table.counts('run-1')['expected'] == 4
+
+
+def test_versions_finished_again_are_counted_once(progress, table):
+    progress.finish_versions('run-1', {'a': 'completed', 'b': 'failed'})
+    progress.finish_versions('run-1', {'a': 'completed', 'b': 'completed', 'c': 'completed'})
+    progress.finish_versions('run-2', {'a': 'completed'})
+    assert table.counts('run-1') == {'expected': 0, 'completed': 2, 'failed': 1}
+    assert table.counts('run-2')['completed'] == 1
+
+
+def test_execution_resumes_once_every_expected_version_finished(progress):
+    progress.add_expected_versions('run-1', 'page-1', ['a', 'b'])
+    progress.await_completion('run-1', 'token')
+    progress.finish_versions('run-1', {'a': 'completed'})
+    progress.finish_versions('run-1', {'a': 'completed'})
+    assert progress.stepfunctions.task_successes == []
+    progress.finish_versions('run-1', {'b': 'completed'})
+    assert progress.stepfunctions.task_successes == [{'expected': 2, 'completed': 2, 'failed': 0}]
+
+
+class FlakySQS(FakeSQS):
+    # rejects the batch holding one key once, which fails the queue step
+
+    def __init__(self, rejected_body):
+        super().__init__()
+        self.rejected_body = rejected_body
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if any(entry['MessageBody'] == self.rejected_body for entry in Entries):
+            self.rejected_body = None
+            return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidParameterValue'}
+                for entry in Entries]}
+        return super().send_message_batch(QueueUrl, Entries)
+
+
+def test_retried_queue_step_does_not_end_the_execution_early(load_handler, monkeypatch, tmp_path, table, progress):
+    keys = [f"{DAY_PREFIX}{i:03d}.wav" for i in range(25)]
+    fake_s3, fake_sqs = FakeS3(), FlakySQS(json.dumps(keys[15]))
+    for key in keys:
+        fake_s3.add_object(BUCKET, key, RECORDING, ContentType='audio/wav', Metadata={})
+    queue = load_handler('iterator-queue', CONNECT_RECORDING_S3_BUCKET=BUCKET, CONNECT_RECORDING_CONVERT_QUEUE='convert')
+    convert = load_handler('convert', CONNECT_RECORDING_S3_BUCKET=BUCKET, S3_STORAGE_TIER='STANDARD_IA', CONVERT_MODE='tmp')
+    for handler in (queue, convert):
+        monkeypatch.setattr(handler, 's3', fake_s3)
+        monkeypatch.setattr(handler, 'sqs', fake_sqs)
+        monkeypatch.setattr(handler, 'run_progress', progress)
+    monkeypatch.setattr(convert, 'ledger', SQLiteLedger(str(tmp_path / 'ledger.sqlite')))
+
+    def convert_audio_file(url, input_file_path, output_file_path, profile):
+        with open(output_file_path, 'wb') as f:
+            f.write(b'converted')
+        return 0
+    monkeypatch.setattr(convert, 'convert_audio_file', convert_audio_file)
+
+    files = [{'Key': key, 'Size': len(RECORDING), 'ETag': fake_s3.objects[(BUCKET, key)]['ETag']} for key in keys]
+    event = {'iterator': {'files': files, 'NextContinuationToken': '', 'day': '2024-05-01', 'run_id': 'run-1',
+        'shard': {'prefix': DAY_PREFIX, 'start_after': '', 'end_before': '', 'delimiter': ''}}}
+    with pytest.raises(queue.ConvertRetry):
+        queue.lambda_handler(event, None)
+    # the state machine retries the step, which sends the page again
+    queue.lambda_handler(event, None)
+    progress.await_completion('run-1', 'token')
+    assert table.counts('run-1')['expected'] == 25
+    assert len(fake_sqs.messages) > 25
+
+    while fake_sqs.messages:
+        assert progress.stepfunctions.task_successes == []
+        records = fake_sqs.receive_messages(10)
+        failures = {failure['itemIdentifier'] for failure in convert.lambda_handler({'Records': records}, None)['batchItemFailures']}
+        # the messages left in the queue are delivered again
+        for record in records:
+            if record['messageId'] in failures:
+                record['attributes']['ApproximateReceiveCount'] = str(int(record['attributes']['ApproximateReceiveCount']) + 1)
+                fake_sqs.messages.append(record)
+    assert all(fake_s3.objects[(BUCKET, key)]['Body'] == b'converted' for key in keys)
+    assert progress.stepfunctions.task_successes == [{'expected': 25, 'completed': 25, 'failed': 0}]
@@ -0,0 +1,88 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from codec_profiles import get_profile, header_size
+from savings_planner import (CONNECT_WAV_FORMAT, DEFAULT_PRICES, GB, estimate_converted_size, new_group, add_object,
+    merge_groups, conversion_cost, monthly_storage_savings, suggested_min_convert_bytes, build_report)
+from wav_format import WAVE_FORMAT_ALAW
+
+ALAW = get_profile('alaw-8k')
+# ten seconds of what Connect writes, 8 kHz 16 bit stereo
+SOURCE_SIZE = 44 + 10 * 8000 * 4
+ALAW_FORMAT = {'format_tag': WAVE_FORMAT_ALAW, 'channels': 1, 'sample_rate': 8000, 'block_align': 1, 'bits_per_sample': 8}
+
+
+def test_connect_recording_shrinks_to_a_quarter():
+    assert estimate_converted_size(SOURCE_SIZE, CONNECT_WAV_FORMAT, ALAW) == header_size(ALAW) + 10 * 8000
+
+
+def test_unprobed_and_unknown_formats_are_estimated_as_connect_recordings():
+    expected = estimate_converted_size(SOURCE_SIZE, CONNECT_WAV_FORMAT, ALAW)
+    assert estimate_converted_size(SOURCE_SIZE, None, ALAW) == expected
+    assert estimate_converted_size(SOURCE_SIZE, dict(CONNECT_WAV_FORMAT, format_tag=0x55), ALAW) == expected
+    assert estimate_converted_size(SOURCE_SIZE, dict(CONNECT_WAV_FORMAT, block_align=0), ALAW) == expected
+
+
+def test_converted_recordings_keep_their_size():
+    assert estimate_converted_size(12345, ALAW_FORMAT, ALAW) == 12345
+
+
+def test_header_only_recording_estimates_an_empty_output():
+    assert estimate_converted_size(44, None, ALAW) == header_size(ALAW)
+
+
+def test_merge_groups_sums_and_sorts_by_day_and_prefix():
+    first, second = new_group('2024-05-02', 'b/'), new_group('2024-05-01', 'a/')
+    add_object(first, SOURCE_SIZE, None, ALAW)
+    add_object(second, SOURCE_SIZE, ALAW_FORMAT, ALAW)
+    again = new_group('2024-05-02', 'b/')
+    add_object(again, SOURCE_SIZE, None, ALAW)
+    merged = merge_groups([[first, second], [again]])
+    assert [(group['day'], group['prefix'], group['objects']) for group in merged] == [('2024-05-01', 'a/', 1), ('2024-05-02', 'b/', 2)]
+    assert merged[1]['bytes'] == 2 * SOURCE_SIZE
+    assert merged[1]['converted_bytes'] == 2 * estimate_converted_size(SOURCE_SIZE, None, ALAW)
+
+
+def test_conversion_cost_counts_requests_and_lambda_time():
+    prices = dict(DEFAULT_PRICES, get_request=1, get_requests_per_file=3, put_request=2, lambda_seconds_per_file=1,
+        lambda_bytes_per_second=10, lambda_memory_gb=2, lambda_gb_second=0.5)
+    # 2 files of 5 requests each, 2 seconds fixed and 3 of transcoding at 1 per second
+    assert conversion_cost(2, 30, prices) == pytest.approx(10 + 5)
+
+
+def test_monthly_storage_savings_weighs_both_tiers():
+    prices = dict(DEFAULT_PRICES, source_storage_gb_month=0.02, target_storage_gb_month=0.01)
+    assert monthly_storage_savings(4 * GB, GB, prices) == pytest.approx(0.08 - 0.01)
+
+
+def test_suggested_min_convert_bytes_pays_for_the_conversion():
+    converted = estimate_converted_size(SOURCE_SIZE, None, ALAW)
+    threshold = suggested_min_convert_bytes(SOURCE_SIZE, converted, 12, DEFAULT_PRICES)
+    ratio = converted / SOURCE_SIZE
+
+    def net(size):
+        return monthly_storage_savings(size, size * ratio, DEFAULT_PRICES) * 12 - conversion_cost(1, size, DEFAULT_PRICES)
+    assert net(threshold) >= 0 > net(threshold - 1)
+
+
+def test_suggested_min_convert_bytes_is_none_when_nothing_pays_off():
+    prices = dict(DEFAULT_PRICES, target_storage_gb_month=DEFAULT_PRICES['source_storage_gb_month'])
+    assert suggested_min_convert_bytes(SOURCE_SIZE, SOURCE_SIZE, 12, prices) is None
+
+
+def test_build_report_totals_the_groups():
+    groups = [new_group('2024-05-01', 'a/'), new_group('2024-05-02', 'a/')]
+    for group, count in zip(groups, (3, 5)):
+        for _ in range(count):
+            add_object(group, SOURCE_SIZE, None, ALAW)
+    report = build_report(groups, 6, DEFAULT_PRICES)
+    totals = report['totals']
+    assert totals['objects'] == 8
+    assert totals['bytes'] == 8 * SOURCE_SIZE
+    assert totals['bytes_saved'] == sum(group['bytes_saved'] for group in groups)
+    assert totals['monthly_storage_savings'] == pytest.approx(sum(group['monthly_storage_savings'] for group in groups), abs=1e-5)
+    assert totals['net_savings'] == pytest.approx(totals['monthly_storage_savings'] * 6 - totals['conversion_cost'])
+    assert 'day' not in totals and 'prefix' not in totals
+    assert report['suggested_min_convert_bytes'] == suggested_min_convert_bytes(totals['bytes'], totals['converted_bytes'], 6, DEFAULT_PRICES)
@@ -0,0 +1,71 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Synthesizes the stack in a copy of the tree, with empty zips in place of the layers that are
+# built by build_layer_x86.sh.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from conftest import REPO_ROOT
+
+pytest.importorskip('aws_cdk')
+
+# the context cdk deploy is given, see the README
+DEPLOY_CONTEXT = {
+    'bucket_name': 'connect-recordings',
+    'kms_key_arn': 'arn:aws:kms:us-east-1:111111111111:key/recordings',
+    'bucket_prefix': 'connect/instance/CallRecordings/',
+    'num_days_age': '7',
+    's3_storage_tier': 'GLACIER_IR',
+    'overwrite_previous_converted': 'false',
+}
+
+
+# the relative asset paths of the stack are resolved by the jsii runtime, in the directory
+# its first import started it in
+SYNTH = """
+import json, sys
+from aws_cdk import App, assertions
+from lib.convert.convert_stack import CallRecordStack
+app = App(context=json.loads(sys.argv[1]), outdir='cdk.out')
+template = assertions.Template.from_stack(CallRecordStack(app, 'callrecording-compression'))
+print(json.dumps(template.find_resources('AWS::StepFunctions::StateMachine')))
+"""
+
+
+def state_machine_definition(tmp_path, **context):
+    for path in ('lambdas', 'lambda-layers'):
+        shutil.copytree(os.path.join(REPO_ROOT, path), tmp_path / path)
+    for layer in ('ffmpeg', 'numpy'):
+        with zipfile.ZipFile(tmp_path / 'lambda-layers' / f'layer-{layer}' / f'{layer}_layer.zip', 'w') as layer_zip:
+            layer_zip.writestr('python/.keep', '')
+
+    environment = dict(os.environ, PYTHONPATH=REPO_ROOT, JSII_SILENCE_WARNING_DEPRECATED_NODE_VERSION='1')
+    synth = subprocess.run([sys.executable, '-c', SYNTH, json.dumps(dict(DEPLOY_CONTEXT, **context))], cwd=tmp_path, env=environment,
+                           capture_output=True, text=True, check=True)
+    state_machines = json.loads(synth.stdout)
+    assert len(state_machines) == 1
+    definition = next(iter(state_machines.values()))['Properties']['DefinitionString']
+    # the definition is joined around the ARNs of the functions and the table
+    return json.loads(''.join(part if isinstance(part, str) else 'arn' for part in definition['Fn::Join'][1]))
+
+
+@pytest.mark.parametrize('dispatch_mode', ['sqs', 'manifest'])
+def test_every_day_is_a_child_execution(tmp_path, dispatch_mode):
+    definition = state_machine_definition(tmp_path, dispatch_mode=dispatch_mode)
+    states = definition['States']
+    days = states['Dry run?']['Default']
+    assert days == 'Convert days in parallel'
+
+    for name in (days, 'Plan days in parallel'):
+        assert states[name]['ItemProcessor']['ProcessorConfig'] == {'Mode': 'DISTRIBUTED', 'ExecutionType': 'STANDARD'}
+    # the shards of a day share the history of the day
+    shards = states[days]['ItemProcessor']['States']['List shards in parallel']
+    assert shards['Type'] == 'Map' and 'ProcessorConfig' not in shards['Iterator']
@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conversion_ledger import SQLiteLedger, STATUS_QUEUED
+from corpus import connect_wav_header
+from fake_aws import FakeS3, FakeSQS, client_error
+
+BUCKET = 'recordings'
+DAY_PREFIX = 'connect/instance/CallRecordings/2024/05/01/'
+RECORDING = connect_wav_header(8000) + b'\x01\x00' * 4000
+
+
+def test_listing_error_fails_the_iterator_task(load_handler, monkeypatch):
+    iterator = load_handler('iterator-step', CONNECT_RECORDING_S3_BUCKET=BUCKET, PREFIX='connect/instance/CallRecordings/')
+    fake_s3 = FakeS3()
+
+    def list_objects_v2(**kwargs):
+        raise client_error('SlowDown', 'ListObjectsV2')
+    monkeypatch.setattr(fake_s3, 'list_objects_v2', list_objects_v2)
+    monkeypatch.setattr(iterator, 's3', fake_s3)
+    monkeypatch.setattr(iterator, 'checkpoints', None)
+    with pytest.raises(ClientError, match='SlowDown'):
+        iterator.lambda_handler({'specific_date': '05/01/2024', 'day': '2024-05-01', 'NextContinuationToken': ''}, None)
+
+
+class FailingSQS(FakeSQS):
+    # fails the request of the batch holding one key
+
+    def __init__(self, failing_body):
+        super().__init__()
+        self.failing_body = failing_body
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if any(entry['MessageBody'] == self.failing_body for entry in Entries):
+            raise client_error('InternalError', 'SendMessageBatch')
+        return super().send_message_batch(QueueUrl, Entries)
+
+
+@pytest.fixture
+def page(load_handler, monkeypatch, tmp_path):
+    keys = [f"{DAY_PREFIX}{i:03d}.wav" for i in range(25)]
+    queue = load_handler('iterator-queue', CONNECT_RECORDING_S3_BUCKET=BUCKET, CONNECT_RECORDING_CONVERT_QUEUE='convert')
+    fake_s3 = FakeS3()
+    for key in keys:
+        fake_s3.add_object(BUCKET, key, RECORDING, ContentType='audio/wav', Metadata={})
+    monkeypatch.setattr(queue, 's3', fake_s3)
+    monkeypatch.setattr(queue, 'sqs', FailingSQS(json.dumps(keys[15])))
+    monkeypatch.setattr(queue, 'ledger', SQLiteLedger(str(tmp_path / 'ledger.sqlite')))
+    monkeypatch.setattr(queue, 'run_progress', None)
+    monkeypatch.setattr(queue, 'checkpoints', None)
+    files = [{'Key': key, 'Size': len(RECORDING), 'ETag': fake_s3.objects[(BUCKET, key)]['ETag']} for key in keys]
+    event = {'iterator': {'files': files, 'NextContinuationToken': '', 'day': '2024-05-01', 'run_id': 'run-1',
+        'shard': {'prefix': DAY_PREFIX, 'start_after': '', 'end_before': '', 'delimiter': ''}}}
+    return queue, keys, event
+
+
+def test_send_error_fails_the_queue_step_and_releases_the_keys_not_sent(page):
+    queue, keys, event = page
+    with pytest.raises(queue.ConvertRetry, match='InternalError'):
+        queue.lambda_handler(event, None)
+    # the batch of keys 10 to 19 was not sent, the others are queued for the run
+    records = queue.ledger.get_many(keys)
+    assert sorted(records) == keys[:10] + keys[20:]
+    assert all(record['status'] == STATUS_QUEUED and record['lease_owner'] == 'run-1' for record in records.values())
+    assert len(queue.sqs.messages) == 15
+
+
+def test_retried_queue_step_sends_the_released_keys(page):
+    queue, keys, event = page
+    with pytest.raises(queue.ConvertRetry):
+        queue.lambda_handler(event, None)
+    queue.sqs.failing_body = None
+    assert queue.lambda_handler(event, None)['key_count'] == 25
+    assert sorted(queue.ledger.get_many(keys)) == keys
@@ -0,0 +1,161 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Merges the invocation profiles written by handler_profiler into one set of collapsed stacks,
+# the input of flamegraph.pl, speedscope or any flame graph viewer, and summarizes their spans
+# and cProfiles. Profiles are read from the work bucket or from local directories:
+#
+#   python tools/aggregate_profiles.py s3://<work bucket>/profiles/convert/2024/05/ --output convert.folded
+#   flamegraph.pl convert.folded > convert.svg
+#   python tools/aggregate_profiles.py ./profiles --stage list --spans --cprofile
+#
+# Stacks are weighted in milliseconds of wall clock time by default, so profiles sampled at
+# different intervals add up. Every stack starts with the thread group it was sampled in.
+
+import argparse
+import gzip
+import json
+import os
+import sys
+from datetime import datetime
+
+PROFILE_FORMAT = 'handler-profile-v1'
+PROFILE_SUFFIXES = ('.json.gz', '.json')
+
+
+def read_profiles(sources):
+    for source in sources:
+        if source.startswith('s3://'):
+            yield from read_s3_profiles(source)
+        elif os.path.isdir(source):
+            for directory, subdirectories, files in os.walk(source):
+                subdirectories.sort()
+                for name in sorted(files):
+                    if name.endswith(PROFILE_SUFFIXES):
+                        with open(os.path.join(directory, name), 'rb') as f:
+                            yield decode_profile(f.read())
+        else:
+            with open(source, 'rb') as f:
+                yield decode_profile(f.read())
+
+
+def read_s3_profiles(url):
+    import boto3
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    s3 = boto3.client('s3')
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(PROFILE_SUFFIXES):
+                yield decode_profile(s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read())
+
+
+def decode_profile(body):
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+def selected(profile, args):
+    if profile.get('format') != PROFILE_FORMAT:
+        return False
+    if args.stage and profile['stage'] not in args.stage:
+        return False
+    if args.trigger and profile['trigger'] != args.trigger:
+        return False
+    if args.since and datetime.fromisoformat(profile['started_at']).date() < args.since:
+        return False
+    return True
+
+
+class Aggregate:
+
+    def __init__(self, units, thread):
+        self.units = units
+        self.thread = thread
+        self.profiles = 0
+        self.wall_ms = 0
+        self.stacks = {}
+        self.spans = {}
+        self.functions = {}
+
+    def add(self, profile):
+        self.profiles += 1
+        self.wall_ms += profile['wall_ms']
+        weight = profile['interval_ms'] if self.units == 'ms' else 1
+        for stack, count in profile['samples'].items():
+            if self.thread and not stack.startswith(self.thread):
+                continue
+            self.stacks[stack] = self.stacks.get(stack, 0) + count * weight
+        for category, name, _, milliseconds, thread, *attributes in profile['spans']:
+            span = self.spans.setdefault(f"{category}:{name}", {'durations': [], 'bench': {}})
+            span['durations'].append(milliseconds)
+            for field, value in (attributes[0] if attributes else {}).items():
+                if field in ('utime', 'stime', 'rtime', 'maxrss'):
+                    span['bench'].setdefault(field, []).append(value)
+        for function, primitive_calls, calls, own, cumulative in profile['cprofile']:
+            totals = self.functions.setdefault(function, [0, 0, 0])
+            totals[0] += calls
+            totals[1] += own
+            totals[2] += cumulative
+
+    def write_collapsed(self, out):
+        for stack, weight in sorted(self.stacks.items(), key=lambda item: item[1], reverse=True):
+            out.write(f"{stack} {round(weight)}\n")
+
+    def span_table(self):
+        lines = [f"{'span':<48} {'count':>7} {'total ms':>11} {'p50 ms':>9} {'p99 ms':>9}  ffmpeg -benchmark means"]
+        for name, span in sorted(self.spans.items(), key=lambda item: sum(item[1]['durations']), reverse=True):
+            durations = sorted(span['durations'])
+            bench = ', '.join(f"{field}={sum(values) / len(values):.3f}" for field, values in sorted(span['bench'].items()))
+            lines.append(f"{name:<48} {len(durations):>7} {sum(durations):>11.1f} {percentile(durations, 0.5):>9.1f} "
+                f"{percentile(durations, 0.99):>9.1f}  {bench}")
+        return '\n'.join(lines)
+
+    def cprofile_table(self, limit):
+        lines = [f"{'function':<72} {'calls':>10} {'own s':>10} {'cumulative s':>13}"]
+        for function, (calls, own, cumulative) in sorted(self.functions.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+            lines.append(f"{function[:72]:<72} {calls:>10} {own:>10.3f} {cumulative:>13.3f}")
+        return '\n'.join(lines)
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merges handler profiles into collapsed stacks for a flame graph.')
+    parser.add_argument('sources', nargs='+', help='s3://bucket/prefix, directories or files of profiles')
+    parser.add_argument('--output', help='write the collapsed stacks here instead of to stdout')
+    parser.add_argument('--stage', action='append', choices=('ingest', 'list', 'enqueue', 'convert'), help='only the profiles of this handler, repeatable')
+    parser.add_argument('--trigger', choices=('event', 'sampled'), help='only the profiles requested by an event, or only the sampled ones')
+    parser.add_argument('--since', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(), help='only the profiles from this day on, YYYY-MM-DD')
+    parser.add_argument('--thread', help='only the stacks of this thread group, like MainThread or ThreadPoolExecutor')
+    parser.add_argument('--units', default='ms', choices=('ms', 'samples'), help='weight of a stack, milliseconds of wall clock time or samples')
+    parser.add_argument('--spans', action='store_true', help='print the AWS call and ffmpeg spans')
+    parser.add_argument('--cprofile', type=int, nargs='?', const=30, default=0, metavar='N',
+        help='print the N functions with the most own time in the merged cProfiles')
+    args = parser.parse_args(argv)
+
+    aggregate = Aggregate(args.units, args.thread)
+    for profile in read_profiles(args.sources):
+        if selected(profile, args):
+            aggregate.add(profile)
+    if args.output:
+        with open(args.output, 'w') as out:
+            aggregate.write_collapsed(out)
+    elif not (args.spans or args.cprofile):
+        aggregate.write_collapsed(sys.stdout)
+    # the summary goes to stderr when the stacks go to stdout
+    report = sys.stdout if args.output or args.spans or args.cprofile else sys.stderr
+    report.write(f"{aggregate.profiles} profiles, {aggregate.wall_ms / 1000:.1f} s of invocations, {len(aggregate.stacks)} distinct stacks\n")
+    if args.spans:
+        report.write(aggregate.span_table() + '\n')
+    if args.cprofile:
+        report.write(aggregate.cprofile_table(args.cprofile) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
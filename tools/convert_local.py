@@ -0,0 +1,205 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Converts a directory tree of recordings on every core of the machine, for archives that are
+# on disk rather than in S3, or to convert a bucket synced down once and back up again. Every
+# recording goes through the same pipeline as the convert Lambda, so the converted files are
+# byte for byte what the Lambda would have written:
+#
+#   python tools/convert_local.py /data/recordings
+#   python tools/convert_local.py /data/recordings --output /data/converted --workers 16
+#
+# Files are converted in place unless --output names a second tree, which then gets every
+# recording, converted or copied as it is. Converted files keep their name, as in S3. A SQLite
+# ledger in the output tree records what is done, so an interrupted run picks up where it
+# stopped when started again with the same arguments.
+
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, 'lambda-layers', 'layer-common', 'python'), os.path.join(REPO_ROOT, 'lambdas', 'convert')]
+
+from codec_profiles import get_profile, PROFILES, DEFAULT_PROFILE
+from conversion_ledger import SQLiteLedger, ledger_record, is_converted, STATUS_CONVERTED, STATUS_ALREADY_TARGET
+from embedded_metrics import MetricsRecord
+from recording_storage import LocalStorage
+import convert_pipeline
+
+LEDGER_FILE = '.convert-ledger.sqlite'
+RECORDING_EXTENSIONS = ('.wav',)
+# recordings handed to the pool ahead of the ones being converted, per worker
+QUEUE_DEPTH = 4
+PROGRESS_INTERVAL = 1.0
+
+logger = logging.getLogger()
+
+# set once in every worker process
+worker_state = {}
+
+
+def find_recordings(root):
+    # keys relative to root, in a stable order so that runs can be compared
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = sorted(name for name in subdirectories if not name.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.') or not name.lower().endswith(RECORDING_EXTENSIONS):
+                continue
+            yield os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/')
+
+
+def pending_recordings(storage, keys, ledger, in_place):
+    # The recordings the ledger has no current record for. In place the record holds the ETag of
+    # the converted file, otherwise the ETag of the source and the output has to exist too.
+    records = ledger.get_many(keys)
+    for key in keys:
+        record = records.get(key)
+        if record is not None and is_converted(record, storage.stat(key)['ETag']) \
+                and (in_place or os.path.exists(storage.output_path(key))):
+            continue
+        yield key
+
+
+def init_worker(source, output, profile_name, options, ffmpeg, log_level):
+    logging.basicConfig(level=log_level, format='%(levelname)s %(processName)s %(message)s')
+    if ffmpeg:
+        convert_pipeline.FFMPEG_PATH = ffmpeg
+    worker_state['storage'] = LocalStorage(source, output)
+    worker_state['profile'] = get_profile(profile_name)
+    worker_state['options'] = options
+
+
+def convert_one(key):
+    # runs in a worker, the ledger is only written by the parent
+    storage = worker_state['storage']
+    metrics = MetricsRecord('convert-local', Backend='none')
+    try:
+        result = convert_pipeline.convert_recording(storage, key, worker_state['profile'], metrics, None, worker_state['options'])
+        if result['outcome'] != STATUS_CONVERTED:
+            # the output tree gets the recordings left as they are too
+            storage.copy(key)
+    except Exception as e:
+        logger.error(f"unable to convert {storage.describe(key)}: {e}")
+        return {'key': key, 'outcome': 'failed', 'error': str(e), 'input_bytes': 0, 'output_bytes': 0}
+    return dict(result, key=key, backend=metrics.dimensions['Backend'])
+
+
+class Progress:
+
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.started = time.monotonic()
+        self.last_report = 0
+        self.done = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.outcomes = {}
+        # a line rewritten in place on a terminal, one every ten intervals in a log
+        self.interval = PROGRESS_INTERVAL if stream.isatty() else PROGRESS_INTERVAL * 10
+
+    def add(self, result):
+        self.done += 1
+        self.input_bytes += result['input_bytes']
+        self.output_bytes += result['output_bytes']
+        self.outcomes[result['outcome']] = self.outcomes.get(result['outcome'], 0) + 1
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def elapsed(self, now=None):
+        return max((now or time.monotonic()) - self.started, 0.001)
+
+    def report(self, now=None):
+        elapsed = self.elapsed(now)
+        line = (f"{self.done}/{self.total} recordings, {self.done / elapsed:.1f} files/s, "
+            f"{self.input_bytes / elapsed / 1e6:.1f} MB/s")
+        if self.stream.isatty():
+            self.stream.write(f"\r{line}\033[K")
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def summary(self, skipped):
+        elapsed = self.elapsed()
+        if self.stream.isatty() and self.done:
+            self.stream.write('\n')
+        lines = [f"{self.done} recordings in {elapsed:.1f} s, {skipped} already converted by an earlier run"]
+        for outcome, count in sorted(self.outcomes.items()):
+            lines.append(f"  {outcome:<18} {count:>8}")
+        ratio = self.input_bytes / self.output_bytes if self.output_bytes else 0
+        lines.append(f"{self.input_bytes / 1e6:.1f} MB read, {self.output_bytes / 1e6:.1f} MB written, {ratio:.2f}x smaller")
+        lines.append(f"{self.done / elapsed:.1f} files/s, {self.input_bytes / elapsed / 1e6:.1f} MB/s of source recordings")
+        return '\n'.join(lines)
+
+
+def convert_tree(args):
+    profile = get_profile(args.codec_profile)
+    storage = LocalStorage(args.source, args.output)
+    in_place = storage.output_root == storage.root
+    os.makedirs(storage.output_root, exist_ok=True)
+    ledger = SQLiteLedger(args.ledger or os.path.join(storage.output_root, LEDGER_FILE))
+    keys = list(find_recordings(storage.root))
+    pending = list(pending_recordings(storage, keys, ledger, in_place))
+    options = {
+        'backend': args.backend,
+        'header_probe': args.header_probe,
+        'min_convert_bytes': args.min_convert_bytes,
+        'silence_compaction': {} if args.silence_compaction else None,
+    }
+    progress = Progress(len(pending))
+    failures = []
+    initargs = (storage.root, storage.output_root, profile['name'], options, args.ffmpeg, logger.level)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=initargs) as executor:
+        remaining = iter(pending)
+        in_flight = set()
+        while True:
+            # a bounded number of recordings queued ahead, a large tree is never submitted at once
+            for key in remaining:
+                in_flight.add(executor.submit(convert_one, key))
+                if len(in_flight) >= args.workers * QUEUE_DEPTH:
+                    break
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                progress.add(result)
+                if result['outcome'] == 'failed':
+                    failures.append(result)
+                elif result['outcome'] in (STATUS_CONVERTED, STATUS_ALREADY_TARGET):
+                    # in place the file is now the converted one, otherwise the source is what a rerun finds
+                    etag = result['etag'] if in_place else result['source_etag']
+                    ledger.put(ledger_record(result['key'], etag, result['outcome'], result['input_bytes'], result['output_bytes']))
+    print(progress.summary(len(keys) - len(pending)))
+    for failure in failures:
+        print(f"failed: {failure['key']}: {failure['error']}")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts a directory tree of call recordings on every core.')
+    parser.add_argument('source', help='directory tree of recordings')
+    parser.add_argument('--output', help='write the converted tree here instead of converting in place')
+    parser.add_argument('--codec-profile', default=DEFAULT_PROFILE, choices=sorted(PROFILES))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes, one per core by default')
+    parser.add_argument('--ledger', help=f'SQLite ledger of converted recordings, {LEDGER_FILE} in the output tree by default')
+    parser.add_argument('--backend', default='auto', choices=('auto', 'ffmpeg'))
+    parser.add_argument('--ffmpeg', help='ffmpeg binary, needed for the ffmpeg backend and the Opus profiles')
+    parser.add_argument('--silence-compaction', action='store_true', help='shorten silence and hold music before encoding')
+    parser.add_argument('--min-convert-bytes', type=int, default=0, help='leave smaller recordings as they are')
+    parser.add_argument('--no-header-probe', dest='header_probe', action='store_false',
+        help='convert recordings already in the format of the codec profile again')
+    parser.add_argument('--verbose', action='store_true', help='log every recording')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(levelname)s %(message)s')
+    return convert_tree(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())